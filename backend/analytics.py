@@ -0,0 +1,221 @@
+"""Análises vetorizadas das sessões de estudo: mapa de calor diário, sequências, médias móveis e distribuição
+
+As sessões concluídas chegam do storage em colunas e são repartidas nas viradas de dia (UTC) com
+operações numpy antes de qualquer agregação, então uma sessão das 23h à 1h conta uma hora para
+cada dia. Todo o resto parte da matriz dias × disciplinas resultante.
+"""
+
+from collections import OrderedDict
+from datetime import date, timedelta
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Sessions that started this long before the range may still spill into its first day
+MARGEM_INICIO = timedelta(days=1)
+
+UM_SEGUNDO = np.timedelta64(1, "s")
+UM_DIA = np.timedelta64(1, "D")
+
+
+def dividir_por_dia(colunas: Dict[str, List[Any]], de: date, ate: date) -> pd.DataFrame:
+    """Segundos estudados por (disciplina_id, dia) em [de, ate], repartindo as sessões que atravessam a meia-noite"""
+    if not colunas["inicio"]:
+        return pd.DataFrame({
+            "disciplina_id": pd.Series(dtype=object),
+            "dia": pd.Series(dtype="datetime64[ns]"),
+            "segundos": pd.Series(dtype="int64"),
+        })
+
+    disciplina = np.asarray(colunas["disciplina_id"], dtype=object)
+    inicio = pd.to_datetime(pd.Series(colunas["inicio"]), format="ISO8601").to_numpy().astype("datetime64[s]")
+    duracao = np.nan_to_num(np.asarray(colunas["duracao_segundos"], dtype="float64")).astype("int64").clip(min=0)
+    fim = inicio + duracao * UM_SEGUNDO
+
+    # Days each session touches; one ending exactly at midnight doesn't touch the next day
+    primeiro = inicio.astype("datetime64[D]")
+    ultimo = np.maximum(primeiro, (fim - UM_SEGUNDO).astype("datetime64[D]"))
+    quantos = (ultimo - primeiro).astype("int64") + 1
+
+    # One row per (session, day): repeat each session once per day, then offset the day
+    sessao = np.repeat(np.arange(len(inicio)), quantos)
+    deslocamento = np.arange(len(sessao)) - np.repeat(np.cumsum(quantos) - quantos, quantos)
+    dia = primeiro[sessao] + deslocamento * UM_DIA
+    comeco = np.maximum(inicio[sessao], dia.astype("datetime64[s]"))
+    termino = np.minimum(fim[sessao], (dia + UM_DIA).astype("datetime64[s]"))
+    segundos = (termino - comeco).astype("int64")
+
+    no_intervalo = (dia >= np.datetime64(de, "D")) & (dia <= np.datetime64(ate, "D"))
+    pedacos = pd.DataFrame({
+        "disciplina_id": disciplina[sessao][no_intervalo],
+        "dia": dia[no_intervalo].astype("datetime64[ns]"),
+        "segundos": segundos[no_intervalo],
+    })
+    return pedacos.groupby(["disciplina_id", "dia"], as_index=False, sort=True)["segundos"].sum()
+
+
+def matriz_diaria(por_dia: pd.DataFrame, de: date, ate: date) -> pd.DataFrame:
+    """Dias × disciplinas com os segundos estudados, incluindo os dias sem estudo"""
+    calendario = pd.date_range(de, ate, freq="D")
+    if por_dia.empty:
+        return pd.DataFrame(index=calendario, dtype="int64")
+    matriz = por_dia.pivot_table(index="dia", columns="disciplina_id", values="segundos", aggfunc="sum", fill_value=0)
+    return matriz.reindex(calendario, fill_value=0).astype("int64")
+
+
+def matriz_do_intervalo(colunas: Dict[str, List[Any]], de: date, ate: date) -> pd.DataFrame:
+    """Matriz diária direto das colunas de sessões (o que o memo guarda)"""
+    return matriz_diaria(dividir_por_dia(colunas, de, ate), de, ate)
+
+
+def _dias_iso(indice: pd.DatetimeIndex) -> List[str]:
+    return list(indice.strftime("%Y-%m-%d"))
+
+
+def mapa_de_calor(matriz: pd.DataFrame) -> Dict[str, Any]:
+    """Total estudado por dia, com um nível de 0 a 4 proporcional ao dia de maior estudo"""
+    totais = matriz.sum(axis=1).to_numpy(dtype="int64")
+    maximo = int(totais.max()) if len(totais) else 0
+    niveis = np.ceil(4 * totais / maximo).astype("int64") if maximo else np.zeros(len(totais), dtype="int64")
+    return {
+        "dias": _dias_iso(matriz.index),
+        "segundos": totais.tolist(),
+        "niveis": niveis.tolist(),
+        "total_segundos": int(totais.sum()),
+        "maximo_segundos": maximo,
+        "dias_estudados": int((totais > 0).sum()),
+    }
+
+
+def _sequencia(dias: pd.DatetimeIndex, inicio: int, fim: int) -> Dict[str, Any]:
+    return {"dias": int(fim - inicio), "inicio": dias[inicio].date().isoformat(), "fim": dias[fim - 1].date().isoformat()}
+
+
+def sequencias(matriz: pd.DataFrame, minimo_segundos: int, hoje: date) -> Dict[str, Any]:
+    """Sequência atual e maior sequência de dias com pelo menos `minimo_segundos` de estudo"""
+    estudou = (matriz.sum(axis=1).to_numpy() >= max(minimo_segundos, 1)).astype("int8")
+    # Runs of study days start where the padded series steps up and end where it steps down
+    degraus = np.diff(np.concatenate(([0], estudou, [0])))
+    inicios = np.flatnonzero(degraus == 1)
+    fins = np.flatnonzero(degraus == -1)
+    comprimentos = fins - inicios
+
+    maior = None
+    if len(comprimentos):
+        i = int(np.argmax(comprimentos))
+        maior = _sequencia(matriz.index, inicios[i], fins[i])
+
+    # The current streak is still alive if it reaches the last day, or the day before when that is today
+    atual = None
+    if len(fins):
+        ultimo_dia = matriz.index[-1].date()
+        if fins[-1] == len(estudou) or (ultimo_dia == hoje and fins[-1] == len(estudou) - 1):
+            atual = _sequencia(matriz.index, inicios[-1], fins[-1])
+
+    return {
+        "minimo_segundos": minimo_segundos,
+        "dias_no_periodo": len(estudou),
+        "dias_estudados": int(estudou.sum()),
+        "atual": atual or {"dias": 0, "inicio": None, "fim": None},
+        "maior": maior or {"dias": 0, "inicio": None, "fim": None},
+    }
+
+
+def medias_moveis(matriz: pd.DataFrame, janela: int, nomes: Dict[str, str]) -> Dict[str, Any]:
+    """Média móvel diária por disciplina e tendência linear (segundos por dia, a cada dia)"""
+    matriz = matriz.loc[:, matriz.sum(axis=0) > 0]
+    medias = matriz.rolling(janela, min_periods=1).mean()
+
+    # Least-squares slope for every discipline at once: cov(x, y) / var(x)
+    x = np.arange(len(matriz), dtype="float64")
+    x -= x.mean()
+    variancia = float(x @ x)
+    tendencias = (x @ matriz.to_numpy(dtype="float64")) / variancia if variancia else np.zeros(matriz.shape[1])
+
+    return {
+        "janela": janela,
+        "dias": _dias_iso(matriz.index),
+        "disciplinas": [
+            {
+                "disciplina_id": disciplina_id,
+                "nome_disciplina": nomes.get(disciplina_id),
+                "total_segundos": int(matriz[disciplina_id].sum()),
+                "media_diaria_segundos": round(float(matriz[disciplina_id].mean()), 2),
+                "tendencia_segundos_por_dia": round(float(tendencia), 4),
+                "media_movel_segundos": np.round(medias[disciplina_id].to_numpy(), 2).tolist(),
+            }
+            for disciplina_id, tendencia in zip(matriz.columns, tendencias)
+        ],
+    }
+
+
+def distribuicao(matriz: pd.DataFrame, por: str, nomes: Dict[str, str]) -> Dict[str, Any]:
+    """Segundos por disciplina em cada dia ou semana (segunda-feira), já repartidos nas viradas"""
+    if por == "semana":
+        segundas = matriz.index - pd.to_timedelta(matriz.index.weekday, unit="D")
+        matriz = matriz.groupby(segundas).sum()
+    matriz = matriz.loc[:, matriz.sum(axis=0) > 0]
+    return {
+        "por": por,
+        "periodos": _dias_iso(matriz.index),
+        "totais_segundos": matriz.sum(axis=1).astype("int64").tolist(),
+        "disciplinas": [
+            {
+                "disciplina_id": disciplina_id,
+                "nome_disciplina": nomes.get(disciplina_id),
+                "segundos": matriz[disciplina_id].astype("int64").tolist(),
+            }
+            for disciplina_id in matriz.columns
+        ],
+    }
+
+
+class MemoAnalitico:
+    """Matrizes dias × disciplinas já calculadas, por (usuário, intervalo, versão dos rollups), em LRU
+
+    A versão dos rollups avança a cada sessão encerrada, reconstrução ou importação, então
+    uma entrada nunca fica desatualizada: ela só deixa de ser pedida. O limite é em bytes, já que
+    uma matriz de dez anos de um usuário com muitas disciplinas pesa milhares de vezes a de uma semana.
+    """
+
+    def __init__(self, maximo_bytes: int = 64 * 1024 * 1024):
+        self.maximo_bytes = maximo_bytes
+        self.bytes = 0
+        self._entradas: "OrderedDict[Hashable, Tuple[pd.DataFrame, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def obter(self, chave: Hashable) -> Optional[pd.DataFrame]:
+        entrada = self._entradas.get(chave)
+        if entrada is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entradas.move_to_end(chave)
+        return entrada[0]
+
+    def guardar(self, chave: Hashable, matriz: pd.DataFrame):
+        tamanho = int(matriz.memory_usage(index=True, deep=True).sum())
+        if chave in self._entradas:
+            self.bytes -= self._entradas.pop(chave)[1]
+        # One matrix over the whole budget would only evict everything else
+        if tamanho > self.maximo_bytes:
+            return
+        self._entradas[chave] = (matriz, tamanho)
+        self.bytes += tamanho
+        while self.bytes > self.maximo_bytes:
+            _, (_, liberado) = self._entradas.popitem(last=False)
+            self.bytes -= liberado
+
+    def estatisticas(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entradas": len(self._entradas),
+            "bytes": self.bytes,
+            "maximo_bytes": self.maximo_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,95 @@
+"""Cache de curta duração com coalescência (single-flight) para as agregações mais pedidas
+
+Requisições idênticas e simultâneas compartilham uma única execução em voo, e o resultado fica
+guardado por `ttl` segundos ou até uma escrita do usuário invalidá-lo. O cache é por processo:
+com vários workers, o TTL limita por quanto tempo um deles serve um resultado que outro alterou.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from metrics import AGGREGATE_CACHE_REQUESTS
+
+
+class CacheCoalescente:
+    def __init__(self, nome: str, ttl: float, maximo: int = 1000):
+        self.nome = nome
+        self.ttl = ttl
+        # Users kept, least recently used evicted first
+        self.maximo = maximo
+        self._entradas: "OrderedDict[str, Dict[Hashable, Tuple[float, Any]]]" = OrderedDict()
+        self._em_voo: Dict[str, Dict[Hashable, asyncio.Task]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalescidas = 0
+        self.invalidacoes = 0
+
+    async def obter(self, usuario_id: str, chave: Hashable, produzir: Callable[[], Awaitable[Any]]) -> Any:
+        """Valor em cache de (usuario_id, chave), o da execução em voo, ou o de uma nova chamada a `produzir`"""
+        entrada = self._entradas.get(usuario_id, {}).get(chave)
+        if entrada and entrada[0] > time.monotonic():
+            self._contar("hit")
+            self._entradas.move_to_end(usuario_id)
+            return entrada[1]
+
+        voos = self._em_voo.setdefault(usuario_id, {})
+        tarefa = voos.get(chave)
+        if tarefa is not None:
+            self._contar("coalesced")
+        else:
+            self._contar("miss")
+            # Its own task, so a requester that disconnects doesn't cancel it for the others
+            tarefa = asyncio.ensure_future(produzir())
+            voos[chave] = tarefa
+            tarefa.add_done_callback(lambda concluida: self._pousar(usuario_id, chave, concluida))
+        return await asyncio.shield(tarefa)
+
+    def _pousar(self, usuario_id: str, chave: Hashable, tarefa: asyncio.Task):
+        voos = self._em_voo.get(usuario_id)
+        if not voos or voos.get(chave) is not tarefa:
+            # Invalidated while in flight: its waiters get the value, the cache doesn't
+            return
+        del voos[chave]
+        if not voos:
+            del self._em_voo[usuario_id]
+        if tarefa.cancelled() or tarefa.exception() is not None or self.ttl <= 0:
+            return
+        agora = time.monotonic()
+        entradas = self._entradas.setdefault(usuario_id, {})
+        for expirada in [k for k, (expira, _) in entradas.items() if expira <= agora]:
+            del entradas[expirada]
+        entradas[chave] = (agora + self.ttl, tarefa.result())
+        self._entradas.move_to_end(usuario_id)
+        while len(self._entradas) > self.maximo:
+            self._entradas.popitem(last=False)
+
+    def invalidar(self, usuario_id: str):
+        """Descartar os valores do usuário; execuções já em voo não são mais guardadas nem compartilhadas"""
+        self._entradas.pop(usuario_id, None)
+        self._em_voo.pop(usuario_id, None)
+        self.invalidacoes += 1
+
+    def _contar(self, resultado: str):
+        if resultado == "hit":
+            self.hits += 1
+        elif resultado == "miss":
+            self.misses += 1
+        else:
+            self.coalescidas += 1
+        AGGREGATE_CACHE_REQUESTS.labels(self.nome, resultado).inc()
+
+    def estatisticas(self) -> Dict[str, Any]:
+        total = self.hits + self.misses + self.coalescidas
+        return {
+            "ttl_segundos": self.ttl,
+            "usuarios": len(self._entradas),
+            "em_voo": sum(len(voos) for voos in self._em_voo.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalescidas": self.coalescidas,
+            "invalidacoes": self.invalidacoes,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "taxa_coalescencia": round(self.coalescidas / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,139 @@
+"""Métricas Prometheus: latência por rota HTTP, duração dos comandos MongoDB e cache de agregados"""
+
+import threading
+import time
+from typing import Any, Dict, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from pymongo import monitoring
+from starlette.routing import Match
+
+
+REGISTRY = CollectorRegistry()
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Latência das requisições HTTP por rota",
+    ["method", "route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    registry=REGISTRY,
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "Requisições HTTP em andamento por rota",
+    ["method", "route"],
+    registry=REGISTRY,
+)
+HTTP_REQUESTS = Counter(
+    "http_requests",
+    "Requisições HTTP concluídas por rota e status",
+    ["method", "route", "status"],
+    registry=REGISTRY,
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "Duração dos comandos MongoDB por coleção e comando",
+    ["collection", "command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+    registry=REGISTRY,
+)
+AGGREGATE_CACHE_REQUESTS = Counter(
+    "aggregate_cache_requests",
+    "Leituras de agregados em cache por cache e resultado (hit, miss ou coalesced)",
+    ["cache", "result"],
+    registry=REGISTRY,
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongodb_command_failures",
+    "Comandos MongoDB que falharam por coleção e comando",
+    ["collection", "command"],
+    registry=REGISTRY,
+)
+
+# Only data commands are timed; handshakes, heartbeats and sessions would just add noise
+MONGO_COMMANDS = {
+    "find", "getMore", "aggregate", "insert", "update", "delete", "findAndModify",
+    "count", "distinct", "createIndexes", "listIndexes", "explain",
+}
+
+
+def metricas_prometheus() -> Tuple[bytes, str]:
+    """Corpo e content-type da exposição no formato texto do Prometheus"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def rota_do_scope(scope) -> str:
+    """Template da rota que atende a requisição (ex.: /api/timer/status/{disciplina_id})"""
+    # Label by route template so path parameters don't explode the label cardinality
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "<unmatched>"
+
+
+class PrometheusMiddleware:
+    """Middleware ASGI que mede cada requisição pelo template da rota"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = rota_do_scope(scope)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.labels(method, route).inc()
+        inicio = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Measured until the body is fully sent, so streamed exports and SSE count in full
+            HTTP_REQUEST_DURATION.labels(method, route).observe(time.perf_counter() - inicio)
+            HTTP_REQUESTS.labels(method, route, str(status)).inc()
+            HTTP_REQUESTS_IN_PROGRESS.labels(method, route).dec()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Listener do pymongo que registra a duração de cada comando por coleção"""
+
+    def __init__(self):
+        # Succeeded/failed events don't carry the command, so remember the collection at start
+        self._em_andamento: Dict[Tuple[Any, int, int], str] = {}
+        self._lock = threading.Lock()
+
+    def _chave(self, event) -> Tuple[Any, int, int]:
+        return (event.connection_id, event.request_id, event.operation_id)
+
+    def started(self, event):
+        if event.command_name not in MONGO_COMMANDS:
+            return
+        colecao = event.command.get("collection") if event.command_name == "getMore" \
+            else event.command.get(event.command_name)
+        with self._lock:
+            self._em_andamento[self._chave(event)] = colecao if isinstance(colecao, str) else "<database>"
+
+    def _finalizar(self, event) -> Any:
+        with self._lock:
+            return self._em_andamento.pop(self._chave(event), None)
+
+    def succeeded(self, event):
+        colecao = self._finalizar(event)
+        if colecao is not None:
+            MONGO_COMMAND_DURATION.labels(colecao, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        colecao = self._finalizar(event)
+        if colecao is not None:
+            MONGO_COMMAND_DURATION.labels(colecao, event.command_name).observe(event.duration_micros / 1e6)
+            MONGO_COMMAND_FAILURES.labels(colecao, event.command_name).inc()
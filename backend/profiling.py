@@ -0,0 +1,218 @@
+"""Diagnóstico opcional: perfis cProfile por requisição e log de comandos MongoDB lentos
+
+Nada aqui é instalado quando desligado (PROFILE_SAMPLE_RATE=0, sem PROFILE_TOKEN, sem SLOW_QUERY_MS),
+então o caminho normal das requisições não paga nenhum custo.
+"""
+
+import asyncio
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import marshal
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from bson import json_util
+from pymongo import monitoring
+
+from metrics import rota_do_scope
+from storage import estagios_do_plano
+
+
+logger = logging.getLogger(__name__)
+
+# Route template of the request being served; Motor copies the context into its executor threads
+rota_atual: contextvars.ContextVar[str] = contextvars.ContextVar("rota_atual", default="<sem rota>")
+
+PROFILE_HEADER = b"x-profile"
+
+
+class PerfisRequisicao:
+    """Perfis cProfile das requisições amostradas, guardados em memória para download"""
+
+    def __init__(self, taxa_amostragem: float = 0.0, token: Optional[str] = None, maximo: int = 50):
+        self.taxa_amostragem = taxa_amostragem
+        self.token = token.encode() if token else None
+        self.perfis: deque = deque(maxlen=maximo)
+        # Only one cProfile can be active per thread, and every request shares the event loop thread
+        self._ativo = False
+
+    @property
+    def habilitado(self) -> bool:
+        return self.taxa_amostragem > 0 or self.token is not None
+
+    def deve_perfilar(self, scope) -> bool:
+        if self._ativo:
+            return False
+        if self.token is not None and (PROFILE_HEADER, self.token) in scope["headers"]:
+            return True
+        return self.taxa_amostragem > 0 and random.random() < self.taxa_amostragem
+
+    def iniciar(self) -> cProfile.Profile:
+        self._ativo = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def registrar(self, profiler: cProfile.Profile, perfil_id: str, metodo: str, rota: str, caminho: str,
+                  status: int, duracao: float):
+        profiler.disable()
+        self._ativo = False
+        texto = io.StringIO()
+        estatisticas = pstats.Stats(profiler, stream=texto)
+        estatisticas.sort_stats("cumulative").print_stats(40)
+        self.perfis.appendleft({
+            "id": perfil_id,
+            "capturado_em": datetime.utcnow(),
+            "metodo": metodo,
+            "rota": rota,
+            "caminho": caminho,
+            "status": status,
+            "duracao_ms": round(duracao * 1000, 3),
+            # Same format as pstats.Stats.dump_stats, so snakeviz/pstats can open the download
+            "pstats": marshal.dumps(estatisticas.stats),
+            "texto": texto.getvalue(),
+        })
+
+    def listar(self) -> List[Dict[str, Any]]:
+        return [{k: v for k, v in perfil.items() if k not in ("pstats", "texto")} for perfil in self.perfis]
+
+    def obter(self, perfil_id: str) -> Optional[Dict[str, Any]]:
+        return next((perfil for perfil in self.perfis if perfil["id"] == perfil_id), None)
+
+
+class DiagnosticoMiddleware:
+    """Middleware ASGI que guarda a rota atual para o log de lentidão e perfila as requisições escolhidas
+
+    O cProfile mede a thread do event loop inteira: outras requisições intercaladas com a perfilada
+    também aparecem no perfil, e o tempo gasto nas threads do Motor aparece como espera.
+    """
+
+    def __init__(self, app, perfis: PerfisRequisicao):
+        self.app = app
+        self.perfis = perfis
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        rota = rota_do_scope(scope)
+        token = rota_atual.set(rota)
+        try:
+            if not self.perfis.deve_perfilar(scope):
+                await self.app(scope, receive, send)
+                return
+
+            perfil_id = str(uuid.uuid4())
+            status = 500
+
+            async def send_wrapper(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    message["headers"] = [*message.get("headers", []), (b"x-profile-id", perfil_id.encode())]
+                await send(message)
+
+            inicio = time.perf_counter()
+            profiler = self.perfis.iniciar()
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                self.perfis.registrar(profiler, perfil_id, scope["method"], rota, scope["path"], status,
+                                      time.perf_counter() - inicio)
+        finally:
+            rota_atual.reset(token)
+
+
+def para_json(valor: Any) -> Any:
+    """Converter tipos BSON (Timestamp, Regex...) de comandos e planos em JSON estendido"""
+    return json.loads(json_util.dumps(valor))
+
+
+# Commands the server can explain(); the others are logged without a plan
+COMANDOS_EXPLICAVEIS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+COMANDOS_REGISTRADOS = COMANDOS_EXPLICAVEIS | {"insert", "getMore"}
+# Session/transport fields the driver adds, which explain rejects
+CAMPOS_DE_TRANSPORTE = {"lsid", "txnNumber", "$db", "$clusterTime", "$readPreference", "readConcern", "writeConcern"}
+
+
+class ConsultasLentas(monitoring.CommandListener):
+    """Listener do pymongo que guarda os comandos acima de `limite_ms`, com a rota de origem e o explain()"""
+
+    def __init__(self, limite_ms: float, maximo: int = 200):
+        self.limite_micros = limite_ms * 1000
+        self.consultas: deque = deque(maxlen=maximo)
+        self._em_andamento: Dict[Tuple[Any, int, int], Tuple[Dict[str, Any], str]] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._explicar: Optional[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = None
+
+    def conectar(self, loop: asyncio.AbstractEventLoop,
+                 explicar: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]):
+        """Permitir que o listener, chamado nas threads do driver, agende explain() no event loop"""
+        self._loop = loop
+        self._explicar = explicar
+
+    def _chave(self, event) -> Tuple[Any, int, int]:
+        return (event.connection_id, event.request_id, event.operation_id)
+
+    def started(self, event):
+        if event.command_name not in COMANDOS_REGISTRADOS:
+            return
+        comando = {k: v for k, v in event.command.items() if k not in CAMPOS_DE_TRANSPORTE}
+        with self._lock:
+            self._em_andamento[self._chave(event)] = (comando, rota_atual.get())
+
+    def _finalizar(self, event) -> Optional[Tuple[Dict[str, Any], str]]:
+        with self._lock:
+            return self._em_andamento.pop(self._chave(event), None)
+
+    def succeeded(self, event):
+        self._registrar(event, self._finalizar(event), falhou=False)
+
+    def failed(self, event):
+        self._registrar(event, self._finalizar(event), falhou=True)
+
+    def _registrar(self, event, inicio, falhou: bool):
+        if inicio is None or event.duration_micros < self.limite_micros:
+            return
+        comando, rota = inicio
+        consulta = {
+            "registrado_em": datetime.utcnow(),
+            "rota": rota,
+            "comando": event.command_name,
+            "colecao": comando.get(event.command_name) if event.command_name != "getMore" else comando.get("collection"),
+            "duracao_ms": round(event.duration_micros / 1000, 3),
+            "falhou": falhou,
+            "filtro": para_json(next(
+                (comando[k] for k in ("filter", "pipeline", "query", "updates", "deletes") if k in comando), None
+            )),
+            "explain": None,
+        }
+        self.consultas.appendleft(consulta)
+        logger.warning(f"Slow Mongo {event.command_name} on {consulta['colecao']} "
+                       f"({consulta['duracao_ms']} ms) from {rota}")
+        if event.command_name in COMANDOS_EXPLICAVEIS and self._loop is not None and not self._loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._anexar_explain(consulta, comando), self._loop)
+
+    async def _anexar_explain(self, consulta: Dict[str, Any], comando: Dict[str, Any]):
+        try:
+            explain = await self._explicar(comando)
+            consulta["explain"] = {
+                "estagios": estagios_do_plano(explain),
+                "queryPlanner": para_json(explain.get("queryPlanner")),
+            }
+        except Exception as e:
+            consulta["explain"] = {"erro": str(e)}
+
+    def listar(self) -> List[Dict[str, Any]]:
+        return list(self.consultas)
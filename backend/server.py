@@ -1,30 +1,122 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
 import os
+import re
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
+import io
+import csv
+import json
+import time
+import base64
+import codecs
+import hashlib
+import hmac
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime, date, timedelta, timedelta
 
+from analytics import (
+    MARGEM_INICIO, MemoAnalitico, distribuicao, mapa_de_calor, matriz_do_intervalo, medias_moveis, sequencias,
+)
+from cache import CacheCoalescente
+from metrics import MongoCommandMetrics, PrometheusMiddleware, metricas_prometheus
+from profiling import ConsultasLentas, DiagnosticoMiddleware, PerfisRequisicao
+from storage import (
+    USUARIO_PADRAO, DadosUsuario, DocumentosRecusados, SessaoAtivaExistente, criar_storage, posicao_sessao,
+)
+from sync import PlanoSync, incrementos_rollup
+
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Opt-in diagnostics: per-request cProfile (sampled or via the X-Profile header) and slow Mongo command log
+perfis = PerfisRequisicao(float(os.environ.get('PROFILE_SAMPLE_RATE', '0')), os.environ.get('PROFILE_TOKEN'))
+consultas_lentas = ConsultasLentas(float(os.environ['SLOW_QUERY_MS'])) if os.environ.get('SLOW_QUERY_MS') else None
+
+# Motor pool and timeout settings; unset variables keep the driver defaults
+MONGO_OPCOES_AMBIENTE = {
+    'MONGO_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGO_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGO_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+    'MONGO_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGO_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+}
+mongo_options = {opcao: int(os.environ[var]) for var, opcao in MONGO_OPCOES_AMBIENTE.items() if os.environ.get(var)}
+
+# Storage backend: MongoDB by default, or the embedded store (STORAGE_BACKEND=sqlite|memory).
+# Building it does no I/O: Motor connects on first use, inside the startup phases below.
+storage = criar_storage(
+    os.environ.get('STORAGE_BACKEND', 'mongo'),
+    mongo_url=os.environ.get('MONGO_URL'),
+    db_name=os.environ.get('DB_NAME'),
+    sqlite_path=os.environ.get('SQLITE_PATH', str(ROOT_DIR / 'estudos.db')),
+    event_listeners=[MongoCommandMetrics(), *([consultas_lentas] if consultas_lentas else [])],
+    **mongo_options,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Inicialização em fases cronometradas; /api/health/ready só fica pronto quando todas terminam"""
+    inicializacao = {"pronto": False, "fases_ms": {}, "total_ms": None}
+    app.state.inicializacao = inicializacao
+    inicio = time.perf_counter()
+    fases = [
+        ("storage", initialize_storage),
+        ("disciplinas", initialize_disciplines),
+        ("catalogo", load_catalog),
+        ("rollups", backfill_rollups),
+    ]
+    for nome, fase in fases:
+        inicio_fase = time.perf_counter()
+        await fase()
+        inicializacao["fases_ms"][nome] = round((time.perf_counter() - inicio_fase) * 1000, 1)
+    inicializacao["total_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    inicializacao["pronto"] = True
+    logger.info(f"Startup finished in {inicializacao['total_ms']} ms: {inicializacao['fases_ms']}")
+
+    periodicas = [
+        (COMPACTACAO_INTERVALO_SEGUNDOS, lambda: compactar_sessoes_antigas(COMPACTAR_APOS_DIAS), "Session compaction"),
+        (REAPER_INTERVALO_SEGUNDOS, lambda: encerrar_sessoes_abandonadas(SINAL_EXPIRA_SEGUNDOS), "Session reaper"),
+    ]
+    tarefas_de_fundo = [
+        asyncio.create_task(executar_periodicamente(intervalo, tarefa, nome))
+        for intervalo, tarefa, nome in periodicas if intervalo > 0
+    ]
+    
+    yield
+    
+    for tarefa in tarefas_de_fundo:
+        tarefa.cancel()
+    await asyncio.gather(*tarefas_de_fundo, return_exceptions=True)
+    storage.fechar()
 
 # Create the main app without a prefix
-app = FastAPI(title="Sistema de Planejamento de Estudos")
+app = FastAPI(title="Sistema de Planejamento de Estudos", lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Lossy maintenance actions and cross-tenant diagnostics live on their own router and need
+# X-Admin-Token to match ADMIN_TOKEN; with ADMIN_TOKEN unset they are refused
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+async def exigir_token_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Ação administrativa: envie X-Admin-Token válido")
+
+admin_router = APIRouter(prefix="/api/admin", dependencies=[Depends(exigir_token_admin)])
+
 
 # Define Models for Study Planning System
 class Disciplina(BaseModel):
@@ -38,6 +130,9 @@ class DisciplinaUpdate(BaseModel):
     horario_inicio: Optional[str] = None
     horario_fim: Optional[str] = None
 
+class DisciplinaUpdateLote(DisciplinaUpdate):
+    id: str
+
 class TarefaDiaria(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     horario: str                          # Format: "09:00"
@@ -48,6 +143,11 @@ class TarefaDiariaCreate(BaseModel):
     horario: str
     descricao: str
 
+class TarefaDiariaUpdate(BaseModel):
+    horario: Optional[str] = None
+    descricao: Optional[str] = None
+    concluida: Optional[bool] = None
+
 class SessaoEstudo(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     disciplina_id: str
@@ -56,6 +156,10 @@ class SessaoEstudo(BaseModel):
     duracao_segundos: Optional[int] = None
     ativa: bool = True
     criado_em: datetime = Field(default_factory=datetime.utcnow)
+    # Last heartbeat; set only by clients that send them
+    visto_em: Optional[datetime] = None
+    # Id of the reaper run that closed the session at its last heartbeat
+    encerramento_automatico: Optional[str] = None
 
 class SessaoEstudoCreate(BaseModel):
     disciplina_id: str
@@ -78,6 +182,9 @@ class DesempenhoSemanal(BaseModel):
     sabado: List[TarefaDiaria] = []
     domingo: List[TarefaDiaria] = []
     criado_em: datetime = Field(default_factory=datetime.utcnow)
+    versao: int = 0
+
+DIAS_SEMANA = ["segunda", "terca", "quarta", "quinta", "sexta", "sabado", "domingo"]
 
 class PlanoEstudos(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -89,6 +196,19 @@ class PlanoEstudosCreate(BaseModel):
     nome: str
     disciplinas_ids: List[str] = []
 
+class EventoSync(BaseModel):
+    chave: str                            # Idempotency key chosen by the client
+    tipo: str                             # "iniciar", "parar" or "tarefa"
+    em: datetime                          # When it happened on the client
+    disciplina_id: Optional[str] = None
+    semana_inicio: Optional[date] = None
+    dia: Optional[str] = None
+    tarefa_id: Optional[str] = None
+    concluida: Optional[bool] = None      # Omitted: toggle the task
+
+class LoteSync(BaseModel):
+    eventos: List[EventoSync]
+
 class StatusCheck(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     client_name: str
@@ -111,6 +231,40 @@ def serialize_obj(obj):
     else:
         return obj
 
+# Fast response path: encode documents read from our own collections straight to JSON,
+# without the serialize_obj walk or another round of pydantic validation
+def json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def encode_json(content: Any) -> bytes:
+    return json.dumps(content, default=json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class MongoJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return encode_json(content)
+
+# Conditional GET: clients revalidate with If-None-Match and get a bodiless 304 when nothing changed
+def etag_de(*partes: Any) -> str:
+    return '"' + hashlib.sha1("|".join(str(parte) for parte in partes).encode()).hexdigest() + '"'
+
+def nao_modificado(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    # If-None-Match uses weak comparison, so W/ prefixes added by proxies still match
+    candidatos = {candidato.strip().removeprefix("W/") for candidato in if_none_match.split(",")}
+    return etag in candidatos or "*" in candidatos
+
+def cabecalhos_cache(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+def resposta_304(etag: str) -> Response:
+    return Response(status_code=304, headers=cabecalhos_cache(etag))
+
 # Initialize 19 Brazilian Law Disciplines
 DISCIPLINAS_BRASILEIRAS = [
     {"nome": "Direito Constitucional"},
@@ -134,21 +288,306 @@ DISCIPLINAS_BRASILEIRAS = [
     {"nome": "Filosofia do Direito"}
 ]
 
-# Startup event to initialize disciplines
-@app.on_event("startup")
+# Startup phases, run in order by lifespan()
+# Create indexes (MongoDB) or tables (embedded) before anything reads them
+async def initialize_storage():
+    await storage.inicializar()
+    if consultas_lentas and storage.nome == "mongo":
+        consultas_lentas.conectar(asyncio.get_running_loop(), storage.explicar_comando)
+
+def disciplinas_iniciais() -> List[Dict[str, Any]]:
+    return [Disciplina(**disc_data).dict() for disc_data in DISCIPLINAS_BRASILEIRAS]
+
 async def initialize_disciplines():
-    # Check if disciplines already exist
-    existing_count = await db.disciplinas.count_documents({})
-    if existing_count == 0:
-        # Insert the 19 Brazilian law disciplines
-        disciplinas_to_insert = []
-        for disc_data in DISCIPLINAS_BRASILEIRAS:
-            disciplina = Disciplina(**disc_data)
-            disciplinas_to_insert.append(disciplina.dict())
-        
-        if disciplinas_to_insert:
-            await db.disciplinas.insert_many(disciplinas_to_insert)
-            print(f"Initialized {len(disciplinas_to_insert)} disciplines")
+    # Upsert the 19 Brazilian law disciplines by name for the default user: existing ones are
+    # left untouched, and concurrent cold starts can't duplicate them. Other users are seeded
+    # on first use by their catalog
+    criadas = await storage.do_usuario(USUARIO_PADRAO).disciplinas.semear(disciplinas_iniciais())
+    if criadas:
+        print(f"Initialized {criadas} disciplines")
+
+# In-memory discipline catalog of one user (19 rarely-changing rows), reloaded when its version moves
+class CatalogoDisciplinas:
+    def __init__(self, usuario: DadosUsuario):
+        self.usuario = usuario
+        self.versao = 0
+        self._versao_carregada = -1
+        self._disciplinas: List[Disciplina] = []
+        self._por_id: Dict[str, Disciplina] = {}
+        self._json: bytes = b"[]"
+        self._json_por_id: Dict[str, bytes] = {}
+        self._etag = etag_de(self._json)
+        self._etag_por_id: Dict[str, str] = {}
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    async def _garantir_carregado(self):
+        if self._versao_carregada == self.versao:
+            self.hits += 1
+            return
+        self.misses += 1
+        async with self._lock:
+            if self._versao_carregada == self.versao:
+                return
+            versao = self.versao
+            documentos = await self.usuario.disciplinas.listar()
+            if not documentos:
+                # Disciplines are seeded per user on first use
+                await self.usuario.disciplinas.semear(disciplinas_iniciais())
+                documentos = await self.usuario.disciplinas.listar()
+            disciplinas = [Disciplina(**documento) for documento in documentos]
+            self._disciplinas = disciplinas
+            self._por_id = {disciplina.id: disciplina for disciplina in disciplinas}
+            # Response bodies are encoded once per catalog version
+            self._json = encode_json([disciplina.dict() for disciplina in disciplinas])
+            self._json_por_id = {disciplina.id: encode_json(disciplina.dict()) for disciplina in disciplinas}
+            # Strong ETags hash the exact bytes served, so they survive restarts and multiple workers
+            self._etag = etag_de(self._json)
+            self._etag_por_id = {disciplina_id: etag_de(corpo) for disciplina_id, corpo in self._json_por_id.items()}
+            self._versao_carregada = versao
+    
+    async def todas(self) -> List[Disciplina]:
+        await self._garantir_carregado()
+        return self._disciplinas
+    
+    async def obter(self, disciplina_id: str) -> Optional[Disciplina]:
+        await self._garantir_carregado()
+        return self._por_id.get(disciplina_id)
+    
+    async def json_todas(self) -> Tuple[bytes, str]:
+        """Corpo pré-codificado do catálogo e seu ETag"""
+        await self._garantir_carregado()
+        return self._json, self._etag
+    
+    async def json_por_id(self, disciplina_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+        await self._garantir_carregado()
+        return self._json_por_id.get(disciplina_id), self._etag_por_id.get(disciplina_id)
+    
+    def invalidar(self):
+        self.versao += 1
+    
+    def estatisticas(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "versao": self.versao,
+            "disciplinas": len(self._disciplinas),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+class CatalogosPorUsuario:
+    """Catálogos dos usuários usados mais recentemente (LRU)"""
+    def __init__(self, maximo: int = 1000):
+        self.maximo = maximo
+        self._catalogos: "OrderedDict[str, CatalogoDisciplinas]" = OrderedDict()
+    
+    def de(self, usuario: DadosUsuario) -> CatalogoDisciplinas:
+        catalogo = self._catalogos.get(usuario.usuario_id)
+        if catalogo is None:
+            catalogo = self._catalogos[usuario.usuario_id] = CatalogoDisciplinas(usuario)
+            if len(self._catalogos) > self.maximo:
+                self._catalogos.popitem(last=False)
+        else:
+            self._catalogos.move_to_end(usuario.usuario_id)
+        return catalogo
+    
+    def __len__(self) -> int:
+        return len(self._catalogos)
+
+catalogos = CatalogosPorUsuario(int(os.environ.get('CATALOGOS_EM_MEMORIA', '1000')))
+
+# Dashboard aggregates: concurrent identical requests share one query and the result is kept
+# briefly; every write that changes them invalidates the user's entries
+CACHE_AGREGADOS_TTL_SEGUNDOS = float(os.environ.get('CACHE_AGREGADOS_TTL_SEGUNDOS', '5'))
+cache_resumos = CacheCoalescente("resumo", CACHE_AGREGADOS_TTL_SEGUNDOS)
+cache_desempenho = CacheCoalescente("desempenho", CACHE_AGREGADOS_TTL_SEGUNDOS)
+
+async def load_catalog():
+    await catalogos.de(storage.do_usuario(USUARIO_PADRAO)).todas()
+
+# Daily study-time rollups: one document per (usuario_id, disciplina_id, dia), maintained on timer stop
+async def registrar_rollup(usuario: DadosUsuario, disciplina_id: str, inicio: datetime, duracao_segundos: int):
+    await usuario.rollups.incrementar(disciplina_id, inicio.date().isoformat(), duracao_segundos)
+
+async def verificar_rollups(usuario: DadosUsuario, de: date, ate: date) -> Dict[str, Any]:
+    """Comparar os rollups do usuário com as sessões brutas no intervalo [de, ate]"""
+    sessoes = await usuario.sessoes.totais_por_dia(
+        datetime.combine(de, datetime.min.time()),
+        datetime.combine(ate, datetime.max.time())
+    )
+    brutos = {(r["disciplina_id"], r["dia"]): r for r in sessoes}
+    rollups = {
+        (r["disciplina_id"], r["dia"]): r
+        for r in await usuario.rollups.listar(de.isoformat(), ate.isoformat())
+    }
+    
+    divergencias = []
+    for chave in sorted(set(brutos) | set(rollups)):
+        bruto = brutos.get(chave, {})
+        rollup = rollups.get(chave, {})
+        if (bruto.get("total_segundos", 0), bruto.get("sessoes", 0)) != (rollup.get("total_segundos", 0), rollup.get("sessoes", 0)):
+            divergencias.append({
+                "disciplina_id": chave[0],
+                "dia": chave[1],
+                "sessoes_total_segundos": bruto.get("total_segundos", 0),
+                "rollup_total_segundos": rollup.get("total_segundos", 0),
+                "sessoes_quantidade": bruto.get("sessoes", 0),
+                "rollup_quantidade": rollup.get("sessoes", 0),
+            })
+    
+    return {
+        "de": de.isoformat(),
+        "ate": ate.isoformat(),
+        "dias_verificados": len(set(brutos) | set(rollups)),
+        "divergencias": divergencias,
+        "consistente": not divergencias,
+    }
+
+async def backfill_rollups():
+    # Build every user's rollups once for databases that predate them
+    total = await storage.preencher_rollups()
+    if total:
+        print(f"Backfilled {total} study rollups")
+
+# Completed sessions older than this move to the monthly buckets; reads stay transparent
+COMPACTAR_APOS_DIAS = int(os.environ.get('COMPACTAR_APOS_DIAS', '180'))
+COMPACTACAO_INTERVALO_SEGUNDOS = int(os.environ.get('COMPACTACAO_INTERVALO_SEGUNDOS', '21600'))
+ultima_compactacao: Dict[str, Any] = {}
+
+async def compactar_sessoes_antigas(dias: int) -> Dict[str, Any]:
+    antes = (datetime.utcnow() - timedelta(days=dias)).replace(hour=0, minute=0, second=0, microsecond=0)
+    inicio = time.perf_counter()
+    resultado = await storage.compactar_sessoes(antes)
+    ultima_compactacao.clear()
+    ultima_compactacao.update(
+        resultado,
+        antes=antes.isoformat(),
+        em=datetime.utcnow().isoformat(),
+        duracao_ms=round((time.perf_counter() - inicio) * 1000, 1),
+    )
+    if resultado["sessoes"]:
+        logger.info(f"Compacted {resultado['sessoes']} sessions of {resultado['usuarios']} users "
+                    f"into {resultado['buckets']} buckets")
+    return dict(ultima_compactacao)
+
+async def executar_periodicamente(intervalo: int, tarefa, nome: str):
+    # Runs off the startup path: the first pass waits one interval
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            await tarefa()
+        except Exception:
+            logger.exception(f"{nome} failed")
+
+# In-process pub/sub for timer state changes, consumed by the SSE stream. Event ids and the
+# replay history are shared, but each user only receives and replays their own events
+class TimerBroadcaster:
+    def __init__(self, historico: int = 500, fila: int = 100):
+        self._boot = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._historico = deque(maxlen=historico)
+        self._assinantes: Dict[str, set] = {}
+        self._tamanho_fila = fila
+    
+    def publicar(self, usuario_id: str, dados: Dict[str, Any]):
+        self._seq += 1
+        evento = (f"{self._boot}-{self._seq}", dados)
+        self._historico.append((usuario_id, evento))
+        for fila in self._assinantes.get(usuario_id, ()):
+            try:
+                fila.put_nowait(evento)
+            except asyncio.QueueFull:
+                # Slow consumer: drop its backlog and make it resynchronise from a snapshot
+                while not fila.empty():
+                    fila.get_nowait()
+                fila.put_nowait(None)
+    
+    def assinar(self, usuario_id: str) -> asyncio.Queue:
+        fila = asyncio.Queue(maxsize=self._tamanho_fila)
+        self._assinantes.setdefault(usuario_id, set()).add(fila)
+        return fila
+    
+    def cancelar(self, usuario_id: str, fila: asyncio.Queue):
+        filas = self._assinantes.get(usuario_id, set())
+        filas.discard(fila)
+        if not filas:
+            self._assinantes.pop(usuario_id, None)
+    
+    def eventos_desde(self, usuario_id: str, ultimo_id: Optional[str]):
+        """Eventos do usuário posteriores a `ultimo_id`, ou None se ele não estiver mais no histórico"""
+        if not ultimo_id:
+            return None
+        ids = [evento[0] for _, evento in self._historico]
+        if ultimo_id == f"{self._boot}-{self._seq}":
+            return []
+        if ultimo_id not in ids:
+            return None
+        return [evento for dono, evento in list(self._historico)[ids.index(ultimo_id) + 1:] if dono == usuario_id]
+    
+    @property
+    def ultimo_id(self) -> str:
+        return f"{self._boot}-{self._seq}"
+
+timer_broadcaster = TimerBroadcaster()
+
+# Abandoned timers: a session whose client stopped sending heartbeats is closed at the last one.
+# Sessions that never sent any (older clients) are only closed after SESSAO_SEM_SINAL_EXPIRA_HORAS,
+# at their start, so an unknown duration never inflates the summaries
+SINAL_EXPIRA_SEGUNDOS = int(os.environ.get('SINAL_EXPIRA_SEGUNDOS', '300'))
+SESSAO_SEM_SINAL_EXPIRA_HORAS = int(os.environ.get('SESSAO_SEM_SINAL_EXPIRA_HORAS', '24'))
+REAPER_INTERVALO_SEGUNDOS = int(os.environ.get('REAPER_INTERVALO_SEGUNDOS', '60'))
+
+async def encerrar_sessoes_abandonadas(sinal_expira_segundos: int, usuario_id: Optional[str] = None) -> Dict[str, Any]:
+    agora = datetime.utcnow()
+    sem_sinal_ate = agora - timedelta(hours=SESSAO_SEM_SINAL_EXPIRA_HORAS) if SESSAO_SEM_SINAL_EXPIRA_HORAS > 0 else None
+    por_usuario = await storage.encerrar_abandonadas(
+        agora - timedelta(seconds=sinal_expira_segundos), sem_sinal_ate, usuario_id
+    )
+    for usuario_id, sessoes in por_usuario.items():
+        await storage.do_usuario(usuario_id).rollups.incrementar_muitos(incrementos_rollup(sessoes))
+        cache_resumos.invalidar(usuario_id)
+        for sessao in sessoes:
+            timer_broadcaster.publicar(usuario_id, {
+                "disciplina_id": sessao["disciplina_id"], **status_sessao(None),
+                "duracao_segundos": sessao["duracao_segundos"], "encerramento_automatico": True,
+            })
+    total = sum(len(sessoes) for sessoes in por_usuario.values())
+    if total:
+        logger.info(f"Closed {total} abandoned sessions of {len(por_usuario)} users")
+    return {"usuarios": len(por_usuario), "sessoes": total}
+
+SSE_HEARTBEAT_SEGUNDOS = 15
+
+def evento_sse(evento: str, dados: Any, evento_id: Optional[str] = None) -> str:
+    linhas = []
+    if evento_id:
+        linhas.append(f"id: {evento_id}")
+    linhas.append(f"event: {evento}")
+    linhas.append(f"data: {json.dumps(dados)}")
+    return "\n".join(linhas) + "\n\n"
+
+def parse_data(valor: str) -> date:
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de data inválido. Use YYYY-MM-DD")
+
+# Tenancy: study routes work on the data of the user named by X-Usuario-Id, set by the
+# authenticating proxy in front of the API; requests without it use the default user.
+# The header is only trusted with TRUST_USER_HEADER set, i.e. when such a proxy strips and
+# overwrites it; otherwise any client could name another user
+USUARIO_ID_VALIDO = re.compile(r"[A-Za-z0-9_-]{1,64}")
+CONFIAR_CABECALHO_USUARIO = os.environ.get('TRUST_USER_HEADER', '').lower() in ('1', 'true', 'yes')
+
+async def usuario_atual(x_usuario_id: Optional[str] = Header(None)) -> DadosUsuario:
+    if x_usuario_id is not None and not CONFIAR_CABECALHO_USUARIO:
+        raise HTTPException(status_code=403, detail="Cabeçalho X-Usuario-Id não aceito: defina TRUST_USER_HEADER")
+    usuario_id = x_usuario_id or USUARIO_PADRAO
+    if not USUARIO_ID_VALIDO.fullmatch(usuario_id):
+        raise HTTPException(status_code=400, detail="Cabeçalho X-Usuario-Id inválido")
+    return storage.do_usuario(usuario_id)
 
 # API Routes
 
@@ -162,132 +601,427 @@ async def root():
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
     status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    await storage.status_checks.inserir(status_obj.dict())
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
 async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
+    status_checks = await storage.status_checks.listar()
     return [StatusCheck(**status_check) for status_check in status_checks]
 
+@admin_router.get("/indices")
+async def relatorio_indices():
+    """Relatório de índices ausentes/não utilizados e planos das consultas canônicas"""
+    return await storage.verificar_indices()
+
+@admin_router.post("/rollups/reconstruir")
+async def reconstruir_rollups_endpoint(usuario: DadosUsuario = Depends(usuario_atual)):
+    """Reconstruir os rollups diários do usuário a partir de todas as suas sessões concluídas"""
+    total = await usuario.rollups.reconstruir()
+    cache_resumos.invalidar(usuario.usuario_id)
+    return {"message": "Rollups reconstruídos com sucesso", "rollups": total}
+
+@api_router.get("/admin/rollups/verificar")
+async def verificar_rollups_endpoint(de: Optional[str] = None, ate: Optional[str] = None,
+                                     usuario: DadosUsuario = Depends(usuario_atual)):
+    """Verificar a consistência dos rollups contra as sessões brutas (padrão: últimos 30 dias)"""
+    data_ate = parse_data(ate) if ate else datetime.utcnow().date()
+    data_de = parse_data(de) if de else data_ate - timedelta(days=30)
+    return await verificar_rollups(usuario, data_de, data_ate)
+
+@admin_router.get("/compactacao")
+async def relatorio_compactacao():
+    """Tamanho das camadas de sessões (brutas e compactadas), redução obtida e última execução"""
+    return {
+        "compactar_apos_dias": COMPACTAR_APOS_DIAS,
+        "intervalo_segundos": COMPACTACAO_INTERVALO_SEGUNDOS,
+        "ultima_execucao": ultima_compactacao or None,
+        "camadas": await storage.relatorio_compactacao(),
+    }
+
+@admin_router.post("/compactacao")
+async def compactar_agora(dias: Optional[int] = None, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Compactar agora as sessões concluídas do usuário há mais de `dias` dias (padrão: COMPACTAR_APOS_DIAS)
+
+    Os buckets guardam só id, início e duração, então `dias` não pode ficar abaixo de COMPACTAR_APOS_DIAS
+    """
+    dias = COMPACTAR_APOS_DIAS if dias is None else dias
+    if dias < COMPACTAR_APOS_DIAS:
+        raise HTTPException(status_code=400, detail=f"dias deve ser maior ou igual a {COMPACTAR_APOS_DIAS}")
+    antes = (datetime.utcnow() - timedelta(days=dias)).replace(hour=0, minute=0, second=0, microsecond=0)
+    resultado = await usuario.sessoes.compactar(antes)
+    return {
+        "message": "Compactação concluída",
+        **resultado,
+        "antes": antes.isoformat(),
+        "camadas": await storage.relatorio_compactacao(),
+    }
+
+@api_router.post("/admin/sessoes/encerrar-abandonadas")
+async def encerrar_abandonadas_agora(segundos: Optional[int] = None, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Encerrar agora as sessões do usuário sem sinal há mais de `segundos` segundos (padrão: SINAL_EXPIRA_SEGUNDOS)
+
+    Só as do próprio usuário: as dos demais ficam com o reaper periódico, que usa SINAL_EXPIRA_SEGUNDOS
+    """
+    segundos = SINAL_EXPIRA_SEGUNDOS if segundos is None else segundos
+    if segundos < 0:
+        raise HTTPException(status_code=400, detail="segundos deve ser maior ou igual a zero")
+    resultado = await encerrar_sessoes_abandonadas(segundos, usuario.usuario_id)
+    return {"message": "Sessões abandonadas encerradas", **resultado}
+
+@api_router.get("/admin/cache")
+async def estatisticas_cache(usuario: DadosUsuario = Depends(usuario_atual)):
+    """Contadores de acerto/falha dos caches em memória: catálogo, análises e agregados (com coalescência)"""
+    return {
+        "catalogo_disciplinas": catalogos.de(usuario).estatisticas(),
+        "catalogos_em_memoria": len(catalogos),
+        "analytics": memo_analitico.estatisticas(),
+        "resumos": cache_resumos.estatisticas(),
+        "desempenho": cache_desempenho.estatisticas(),
+    }
+
+@admin_router.get("/perfis")
+async def listar_perfis():
+    """Perfis cProfile capturados (PROFILE_SAMPLE_RATE ou cabeçalho X-Profile com PROFILE_TOKEN)"""
+    return MongoJSONResponse({"habilitado": perfis.habilitado, "perfis": perfis.listar()})
+
+@admin_router.get("/perfis/{perfil_id}")
+async def baixar_perfil(perfil_id: str, formato: str = "pstats"):
+    """Baixar um perfil no formato do pstats (snakeviz, pstats.Stats) ou como texto"""
+    if formato not in ("pstats", "texto"):
+        raise HTTPException(status_code=400, detail="Formato deve ser 'pstats' ou 'texto'")
+    perfil = perfis.obter(perfil_id)
+    if not perfil:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    if formato == "texto":
+        return Response(perfil["texto"], media_type="text/plain; charset=utf-8")
+    return Response(
+        perfil["pstats"],
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="perfil-{perfil_id}.prof"'}
+    )
+
+@admin_router.get("/consultas-lentas")
+async def listar_consultas_lentas():
+    """Comandos MongoDB acima de SLOW_QUERY_MS, com a rota de origem e o plano do explain()"""
+    if not consultas_lentas:
+        return {"habilitado": False, "limite_ms": None, "consultas": []}
+    return MongoJSONResponse({
+        "habilitado": True,
+        "limite_ms": consultas_lentas.limite_micros / 1000,
+        "consultas": consultas_lentas.listar(),
+    })
+
+@api_router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Latência por rota e duração dos comandos MongoDB no formato texto do Prometheus"""
+    corpo, content_type = metricas_prometheus()
+    return Response(corpo, media_type=content_type)
+
+# Liveness/readiness probes for the container orchestrator
+@api_router.get("/health/live")
+async def health_live():
+    """O processo está de pé e o event loop responde"""
+    return {"status": "ok"}
+
+@api_router.get("/health/ready")
+async def health_ready(request: Request):
+    """Pronto para tráfego: inicialização concluída, banco respondendo e índices presentes"""
+    inicializacao = getattr(request.app.state, "inicializacao", {"pronto": False})
+    prontidao = await storage.verificar_prontidao() if inicializacao["pronto"] else {"ok": False}
+    pronto = inicializacao["pronto"] and prontidao["ok"]
+    return JSONResponse(
+        {"status": "ok" if pronto else "indisponivel", "backend": storage.nome,
+         "inicializacao": inicializacao, "storage": prontidao},
+        status_code=200 if pronto else 503
+    )
+
 # Disciplinas endpoints
 @api_router.get("/disciplinas", response_model=List[Disciplina])
-async def get_disciplinas():
+async def get_disciplinas(request: Request, usuario: DadosUsuario = Depends(usuario_atual)):
     """Buscar todas as disciplinas"""
-    disciplinas = await db.disciplinas.find().to_list(1000)
-    return [Disciplina(**serialize_obj(disciplina)) for disciplina in disciplinas]
+    corpo, etag = await catalogos.de(usuario).json_todas()
+    if nao_modificado(request, etag):
+        return resposta_304(etag)
+    return Response(content=corpo, media_type="application/json", headers=cabecalhos_cache(etag))
 
 @api_router.get("/disciplinas/{disciplina_id}", response_model=Disciplina)
-async def get_disciplina(disciplina_id: str):
+async def get_disciplina(disciplina_id: str, request: Request, usuario: DadosUsuario = Depends(usuario_atual)):
     """Buscar disciplina por ID"""
-    disciplina = await db.disciplinas.find_one({"id": disciplina_id})
+    disciplina, etag = await catalogos.de(usuario).json_por_id(disciplina_id)
     if not disciplina:
         raise HTTPException(status_code=404, detail="Disciplina não encontrada")
-    return Disciplina(**serialize_obj(disciplina))
+    if nao_modificado(request, etag):
+        return resposta_304(etag)
+    return Response(content=disciplina, media_type="application/json", headers=cabecalhos_cache(etag))
+
+# "HH:MM" as sent by <input type="time">; an empty string clears the field
+HORARIO_VALIDO = re.compile(r"([01]\d|2[0-3]):[0-5]\d")
+MAX_DISCIPLINAS_LOTE = 200
+
+def campos_informados(update_data: DisciplinaUpdate) -> Dict[str, str]:
+    """Campos de horário presentes na atualização"""
+    return {k: v for k, v in update_data.dict().items() if k in DisciplinaUpdate.model_fields and v is not None}
+
+def campos_horario(update_data: DisciplinaUpdate) -> Dict[str, str]:
+    """Campos informados num item do lote; ValueError se algum horário estiver fora do formato HH:MM"""
+    campos = campos_informados(update_data)
+    invalidos = [k for k, v in campos.items() if v and not HORARIO_VALIDO.fullmatch(v)]
+    if invalidos:
+        raise ValueError(f"Horário inválido em {', '.join(invalidos)}. Use HH:MM")
+    return campos
+
+@api_router.put("/disciplinas")
+async def update_disciplinas(atualizacoes: List[DisciplinaUpdateLote], usuario: DadosUsuario = Depends(usuario_atual)):
+    """Atualizar os horários de várias disciplinas de uma vez, com um resultado por item
+    
+    Itens inválidos ou de disciplinas inexistentes não impedem os demais; vários itens para a
+    mesma disciplina são aplicados em ordem.
+    """
+    if len(atualizacoes) > MAX_DISCIPLINAS_LOTE:
+        raise HTTPException(status_code=400, detail=f"No máximo {MAX_DISCIPLINAS_LOTE} disciplinas por lote")
+    
+    resultados: List[Dict[str, Any]] = []
+    alteracoes: Dict[str, Dict[str, str]] = {}
+    for atualizacao in atualizacoes:
+        try:
+            campos = campos_horario(atualizacao)
+        except ValueError as e:
+            resultados.append({"id": atualizacao.id, "status": "invalida", "detalhe": str(e)})
+            continue
+        alteracoes.setdefault(atualizacao.id, {}).update(campos)
+        resultados.append({"id": atualizacao.id, "status": "atualizada"})
+    
+    disciplinas = await usuario.disciplinas.atualizar_muitos(alteracoes)
+    if any(alteracoes[disciplina_id] for disciplina_id in disciplinas):
+        catalogos.de(usuario).invalidar()
+        cache_resumos.invalidar(usuario.usuario_id)
+    
+    for resultado in resultados:
+        if resultado["status"] != "atualizada":
+            continue
+        if resultado["id"] in disciplinas:
+            resultado["disciplina"] = Disciplina(**disciplinas[resultado["id"]]).dict()
+        else:
+            resultado.update(status="nao_encontrada", detalhe="Disciplina não encontrada")
+    return MongoJSONResponse({"resultados": resultados})
 
 @api_router.put("/disciplinas/{disciplina_id}", response_model=Disciplina)
-async def update_disciplina(disciplina_id: str, update_data: DisciplinaUpdate):
+async def update_disciplina(disciplina_id: str, update_data: DisciplinaUpdate, usuario: DadosUsuario = Depends(usuario_atual)):
     """Atualizar horários de uma disciplina"""
-    disciplina = await db.disciplinas.find_one({"id": disciplina_id})
-    if not disciplina:
+    update_dict = campos_informados(update_data)
+    updated_disciplina = await usuario.disciplinas.atualizar(disciplina_id, update_dict)
+    if not updated_disciplina:
         raise HTTPException(status_code=404, detail="Disciplina não encontrada")
-    
-    update_dict = {k: v for k, v in update_data.dict().items() if v is not None}
     if update_dict:
-        await db.disciplinas.update_one(
-            {"id": disciplina_id}, 
-            {"$set": update_dict}
-        )
+        catalogos.de(usuario).invalidar()
+        cache_resumos.invalidar(usuario.usuario_id)
     
-    updated_disciplina = await db.disciplinas.find_one({"id": disciplina_id})
     return Disciplina(**serialize_obj(updated_disciplina))
 
 # Desempenho Semanal endpoints
+def semana_vazia(usuario_id: str, week_date: date) -> Dict[str, Any]:
+    """Semana sem tarefas, montada em memória; só é gravada na primeira escrita real"""
+    # A deterministic id keeps synthesized weeks stable across reads and equal to the stored one;
+    # the user is part of it, or two users' weeks would share an id and so an ETag
+    desempenho = DesempenhoSemanal(
+        id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"desempenho_semanal/{usuario_id}/{week_date.isoformat()}")),
+        semana_inicio=week_date
+    )
+    return documento_para_mongo("desempenho_semanal", desempenho.dict())
+
+MAX_SEMANAS_INTERVALO = 260
+
 @api_router.get("/desempenho", response_model=List[DesempenhoSemanal])
-async def get_desempenho_semanal():
-    """Buscar todos os desempenhos semanais"""
-    desempenhos = await db.desempenho_semanal.find().sort("semana_inicio", -1).to_list(1000)
-    return [DesempenhoSemanal(**serialize_obj(desempenho)) for desempenho in desempenhos]
+async def get_desempenho_semanal(de: Optional[str] = None, ate: Optional[str] = None,
+                                 usuario: DadosUsuario = Depends(usuario_atual)):
+    """Buscar os desempenhos semanais
+    
+    Sem parâmetros, devolve todas as semanas gravadas (mais recente primeiro). Com `de`/`ate`
+    devolve todas as semanas (segundas-feiras) do intervalo em ordem crescente, preenchendo
+    as que ainda não existem sem gravá-las.
+    """
+    if de is None and ate is None:
+        corpo = await cache_desempenho.obter(usuario.usuario_id, None,
+                                             lambda: desempenhos_codificados(usuario.desempenho.listar()))
+        return Response(content=corpo, media_type="application/json")
+    
+    data_ate = parse_data(ate) if ate else datetime.utcnow().date()
+    data_de = parse_data(de) if de else data_ate
+    primeira = data_de - timedelta(days=data_de.weekday())
+    if data_ate < data_de:
+        raise HTTPException(status_code=400, detail="A data final deve ser posterior à inicial")
+    if (data_ate - primeira).days // 7 >= MAX_SEMANAS_INTERVALO:
+        raise HTTPException(status_code=400, detail=f"O intervalo máximo é de {MAX_SEMANAS_INTERVALO} semanas")
+    
+    corpo = await cache_desempenho.obter(usuario.usuario_id, (primeira, data_ate),
+                                         lambda: desempenhos_codificados(semanas_do_intervalo(usuario, primeira, data_ate)))
+    return Response(content=corpo, media_type="application/json")
+
+async def semanas_do_intervalo(usuario: DadosUsuario, primeira: date, data_ate: date) -> List[Dict[str, Any]]:
+    """Semanas gravadas no intervalo, preenchendo as que ainda não existem sem gravá-las"""
+    gravadas = {
+        desempenho["semana_inicio"]: desempenho
+        for desempenho in await usuario.desempenho.listar_intervalo(primeira.isoformat(), data_ate.isoformat())
+    }
+    semana = primeira
+    while semana <= data_ate:
+        if semana.isoformat() not in gravadas:
+            gravadas[semana.isoformat()] = semana_vazia(usuario.usuario_id, semana)
+        semana += timedelta(days=7)
+    return [gravadas[chave] for chave in sorted(gravadas)]
+
+async def desempenhos_codificados(desempenhos) -> bytes:
+    return encode_json(await desempenhos)
+
+def taxa_conclusao(contagem: Dict[str, int]) -> Dict[str, Any]:
+    taxa = round(contagem["concluidas"] / contagem["total"], 4) if contagem["total"] else None
+    return {**contagem, "taxa_conclusao": taxa}
+
+@api_router.get("/desempenho/estatisticas")
+async def get_estatisticas_desempenho(
+    de: Optional[str] = None,
+    ate: Optional[str] = None,
+    limite: int = Query(52, ge=1, le=520),
+    cursor: Optional[str] = None,
+    usuario: DadosUsuario = Depends(usuario_atual),
+):
+    """Tarefas totais/concluídas e taxa de conclusão por semana e por dia da semana
+    
+    As semanas vêm da mais recente para a mais antiga; passe o `next_cursor` da página anterior
+    em `cursor`. `por_dia_semana` soma os dias das semanas da página.
+    """
+    de = parse_data(de).isoformat() if de else None
+    ate = parse_data(ate).isoformat() if ate else None
+    antes = parse_data(cursor).isoformat() if cursor else None
+    
+    # Fetch one extra week to know whether another page exists
+    contagens = await usuario.desempenho.contagens(DIAS_SEMANA, de=de, ate=ate, antes=antes, limite=limite + 1)
+    next_cursor = contagens[limite - 1]["semana_inicio"] if len(contagens) > limite else None
+    
+    semanas = []
+    por_dia_semana = {dia: {"total": 0, "concluidas": 0} for dia in DIAS_SEMANA}
+    for contagem in contagens[:limite]:
+        for dia, dia_contagem in contagem["dias"].items():
+            por_dia_semana[dia]["total"] += dia_contagem["total"]
+            por_dia_semana[dia]["concluidas"] += dia_contagem["concluidas"]
+        semana = {
+            "total": sum(d["total"] for d in contagem["dias"].values()),
+            "concluidas": sum(d["concluidas"] for d in contagem["dias"].values()),
+        }
+        semanas.append({
+            "semana_inicio": contagem["semana_inicio"],
+            **taxa_conclusao(semana),
+            "dias": {dia: taxa_conclusao(dia_contagem) for dia, dia_contagem in contagem["dias"].items()},
+        })
+    
+    return MongoJSONResponse({
+        "semanas": semanas,
+        "por_dia_semana": {dia: taxa_conclusao(contagem) for dia, contagem in por_dia_semana.items()},
+        "next_cursor": next_cursor,
+    })
 
 @api_router.get("/desempenho/{semana_inicio}")
-async def get_desempenho_by_week(semana_inicio: str):
+async def get_desempenho_by_week(semana_inicio: str, request: Request, usuario: DadosUsuario = Depends(usuario_atual)):
     """Buscar desempenho de uma semana específica"""
     try:
         week_date = datetime.strptime(semana_inicio, "%Y-%m-%d").date()
     except ValueError:
         raise HTTPException(status_code=400, detail="Formato de data inválido. Use YYYY-MM-DD")
     
-    desempenho = await db.desempenho_semanal.find_one({"semana_inicio": week_date.isoformat()})
+    desempenho = await usuario.desempenho.obter_semana(week_date.isoformat())
     if not desempenho:
-        # Create new performance week if it doesn't exist
-        new_desempenho = DesempenhoSemanal(semana_inicio=week_date)
-        await db.desempenho_semanal.insert_one(serialize_obj(new_desempenho.dict()))
-        return serialize_obj(new_desempenho.dict())
+        # Weeks are only persisted on their first real write
+        desempenho = semana_vazia(usuario.usuario_id, week_date)
     
-    return serialize_obj(desempenho)
+    # Every write bumps versao, so (id, versao) identifies the representation; the user keeps weeks
+    # stored before ids included it (or imported with another user's id) apart from other tenants'
+    etag = etag_de(usuario.usuario_id, desempenho["id"], desempenho.get("versao", 0))
+    if nao_modificado(request, etag):
+        return resposta_304(etag)
+    return MongoJSONResponse(desempenho, headers=cabecalhos_cache(etag))
 
 @api_router.post("/desempenho")
-async def create_or_update_desempenho(desempenho: DesempenhoSemanal):
+async def create_or_update_desempenho(desempenho: DesempenhoSemanal, usuario: DadosUsuario = Depends(usuario_atual)):
     """Criar ou atualizar desempenho semanal"""
-    existing = await db.desempenho_semanal.find_one({"semana_inicio": desempenho.semana_inicio.isoformat()})
-    
-    if existing:
-        # Update existing
-        await db.desempenho_semanal.update_one(
-            {"semana_inicio": desempenho.semana_inicio.isoformat()},
-            {"$set": desempenho.dict()}
-        )
-    else:
-        # Create new
-        await db.desempenho_semanal.insert_one(desempenho.dict())
+    await usuario.desempenho.salvar_semana(documento_para_mongo("desempenho_semanal", desempenho.dict()))
+    cache_desempenho.invalidar(usuario.usuario_id)
     
     return {"message": "Desempenho semanal salvo com sucesso"}
 
+# Task-level writes: touch a single task instead of rewriting the whole week
+def validar_dia(dia: str) -> str:
+    if dia not in DIAS_SEMANA:
+        raise HTTPException(status_code=400, detail=f"Dia inválido. Use um de: {', '.join(DIAS_SEMANA)}")
+    return dia
+
+@api_router.post("/desempenho/{semana_inicio}/{dia}/tarefas", response_model=TarefaDiaria)
+async def adicionar_tarefa(semana_inicio: str, dia: str, tarefa_data: TarefaDiariaCreate,
+                           usuario: DadosUsuario = Depends(usuario_atual)):
+    """Adicionar uma tarefa a um dia da semana (a semana é criada se ainda não existir)"""
+    week_date = parse_data(semana_inicio)
+    validar_dia(dia)
+    
+    tarefa = TarefaDiaria(**tarefa_data.dict())
+    await usuario.desempenho.adicionar_tarefa(week_date.isoformat(), dia, tarefa.dict(),
+                                              semana_vazia(usuario.usuario_id, week_date))
+    cache_desempenho.invalidar(usuario.usuario_id)
+    return tarefa
+
+@api_router.patch("/desempenho/{semana_inicio}/{dia}/tarefas/{tarefa_id}", response_model=TarefaDiaria)
+async def atualizar_tarefa(semana_inicio: str, dia: str, tarefa_id: str, update_data: TarefaDiariaUpdate,
+                           usuario: DadosUsuario = Depends(usuario_atual)):
+    """Editar ou marcar como concluída uma única tarefa"""
+    week_date = parse_data(semana_inicio)
+    validar_dia(dia)
+    
+    update_dict = {k: v for k, v in update_data.dict().items() if v is not None}
+    if not update_dict:
+        raise HTTPException(status_code=400, detail="Nenhum campo para atualizar")
+    
+    tarefa = await usuario.desempenho.atualizar_tarefa(week_date.isoformat(), dia, tarefa_id, update_dict)
+    if not tarefa:
+        raise HTTPException(status_code=404, detail="Tarefa não encontrada")
+    cache_desempenho.invalidar(usuario.usuario_id)
+    return tarefa
+
+@api_router.delete("/desempenho/{semana_inicio}/{dia}/tarefas/{tarefa_id}")
+async def remover_tarefa(semana_inicio: str, dia: str, tarefa_id: str, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Remover uma única tarefa de um dia"""
+    week_date = parse_data(semana_inicio)
+    validar_dia(dia)
+    
+    if not await usuario.desempenho.remover_tarefa(week_date.isoformat(), dia, tarefa_id):
+        raise HTTPException(status_code=404, detail="Tarefa não encontrada")
+    cache_desempenho.invalidar(usuario.usuario_id)
+    return {"message": "Tarefa removida com sucesso"}
+
 # Timer/Cronometer endpoints
 @api_router.post("/timer/iniciar", response_model=SessaoEstudo)
-async def iniciar_cronometro(sessao_data: SessaoEstudoCreate):
+async def iniciar_cronometro(sessao_data: SessaoEstudoCreate, usuario: DadosUsuario = Depends(usuario_atual)):
     """Iniciar cronômetro de estudo para uma disciplina"""
-    # Check if there's already an active session for this discipline
-    sessao_ativa = await db.sessoes_estudo.find_one({
-        "disciplina_id": sessao_data.disciplina_id,
-        "ativa": True
-    })
-    
-    if sessao_ativa:
+    # The storage enforces at most one active session per discipline atomically
+    nova_sessao = SessaoEstudo(**sessao_data.dict(), inicio=datetime.utcnow())
+    try:
+        await usuario.sessoes.inserir_ativa(nova_sessao.dict())
+    except SessaoAtivaExistente:
         raise HTTPException(status_code=400, detail="Já existe uma sessão ativa para esta disciplina")
     
-    # Create new study session
-    nova_sessao = SessaoEstudo(**sessao_data.dict(), inicio=datetime.utcnow())
-    await db.sessoes_estudo.insert_one(nova_sessao.dict())
+    timer_broadcaster.publicar(usuario.usuario_id, {"disciplina_id": nova_sessao.disciplina_id, **status_sessao(nova_sessao.dict())})
     return nova_sessao
 
 @api_router.put("/timer/parar/{disciplina_id}")
-async def parar_cronometro(disciplina_id: str):
+async def parar_cronometro(disciplina_id: str, usuario: DadosUsuario = Depends(usuario_atual)):
     """Parar cronômetro de estudo para uma disciplina"""
-    # Find active session
-    sessao_ativa = await db.sessoes_estudo.find_one({
-        "disciplina_id": disciplina_id,
-        "ativa": True
-    })
+    sessao = await usuario.sessoes.encerrar_ativa(disciplina_id)
     
-    if not sessao_ativa:
+    if not sessao:
         raise HTTPException(status_code=404, detail="Nenhuma sessão ativa encontrada para esta disciplina")
     
-    # Calculate duration and stop session
-    fim = datetime.utcnow()
-    inicio = datetime.fromisoformat(sessao_ativa["inicio"].replace('Z', '+00:00')) if isinstance(sessao_ativa["inicio"], str) else sessao_ativa["inicio"]
-    duracao_segundos = int((fim - inicio).total_seconds())
-    
-    await db.sessoes_estudo.update_one(
-        {"id": sessao_ativa["id"]},
-        {
-            "$set": {
-                "fim": fim,
-                "duracao_segundos": duracao_segundos,
-                "ativa": False
-            }
-        }
-    )
+    duracao_segundos = sessao["duracao_segundos"]
+    await registrar_rollup(usuario, disciplina_id, sessao["inicio"], duracao_segundos)
+    cache_resumos.invalidar(usuario.usuario_id)
+    timer_broadcaster.publicar(usuario.usuario_id, {"disciplina_id": disciplina_id, **status_sessao(None), "duracao_segundos": duracao_segundos})
     
     return {
         "message": "Cronômetro parado com sucesso",
@@ -295,20 +1029,15 @@ async def parar_cronometro(disciplina_id: str):
         "duracao_formatada": f"{duracao_segundos // 3600}h {(duracao_segundos % 3600) // 60}m"
     }
 
-@api_router.get("/timer/status/{disciplina_id}")
-async def status_cronometro(disciplina_id: str):
-    """Verificar status do cronômetro para uma disciplina"""
-    sessao_ativa = await db.sessoes_estudo.find_one({
-        "disciplina_id": disciplina_id,
-        "ativa": True
-    })
-    
+def status_sessao(sessao_ativa, agora: Optional[datetime] = None) -> Dict[str, Any]:
+    """Montar a resposta de status do cronômetro a partir da sessão ativa (ou None)"""
     if not sessao_ativa:
         return {"ativo": False, "sessao": None}
     
     # Calculate current duration
+    agora = agora or datetime.utcnow()
     inicio = datetime.fromisoformat(sessao_ativa["inicio"].replace('Z', '+00:00')) if isinstance(sessao_ativa["inicio"], str) else sessao_ativa["inicio"]
-    duracao_atual = int((datetime.utcnow() - inicio).total_seconds())
+    duracao_atual = int((agora - inicio).total_seconds())
     
     return {
         "ativo": True,
@@ -316,52 +1045,197 @@ async def status_cronometro(disciplina_id: str):
         "duracao_atual_segundos": duracao_atual
     }
 
-@api_router.get("/timer/resumo-semanal", response_model=List[ResumoSemanalTempo])
-async def resumo_tempo_semanal():
-    """Obter resumo do tempo estudado por disciplina na semana atual"""
-    # Calculate current week start (Monday)
-    today = datetime.utcnow().date()
-    days_since_monday = today.weekday()
-    week_start = today - timedelta(days=days_since_monday)
-    week_end = week_start + timedelta(days=6)
+@api_router.get("/timer/status")
+async def status_cronometros(ids: Optional[str] = None, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Verificar status do cronômetro de várias disciplinas em uma única consulta
     
-    # Convert to datetime for comparison
-    week_start_dt = datetime.combine(week_start, datetime.min.time())
-    week_end_dt = datetime.combine(week_end, datetime.max.time())
-    
-    # Aggregate time by discipline for current week
-    pipeline = [
-        {
-            "$match": {
-                "ativa": False,  # Only completed sessions
-                "inicio": {
-                    "$gte": week_start_dt,
-                    "$lte": week_end_dt
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": "$disciplina_id",
-                "total_segundos": {"$sum": "$duracao_segundos"}
-            }
-        }
-    ]
+    `ids` é uma lista separada por vírgulas; sem ela, responde para todas as disciplinas.
+    """
+    if ids:
+        disciplina_ids = [i.strip() for i in ids.split(",") if i.strip()]
+    else:
+        disciplina_ids = [disciplina.id for disciplina in await catalogos.de(usuario).todas()]
+    
+    # One query for every active session among the requested disciplines
+    sessoes_ativas = await usuario.sessoes.listar_ativas(disciplina_ids)
+    por_disciplina = {sessao["disciplina_id"]: sessao for sessao in sessoes_ativas}
+    
+    agora = datetime.utcnow()
+    return {
+        disciplina_id: status_sessao(por_disciplina.get(disciplina_id), agora)
+        for disciplina_id in disciplina_ids
+    }
+
+@api_router.get("/timer/stream")
+async def stream_cronometros(request: Request, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Server-Sent Events com as mudanças de estado dos cronômetros
+    
+    Começa com um evento `snapshot` (status de todas as disciplinas) e depois envia um evento
+    `timer` a cada início/parada. Reconexões com `Last-Event-ID` recebem apenas o que perderam.
+    """
+    fila = timer_broadcaster.assinar(usuario.usuario_id)
+    perdidos = timer_broadcaster.eventos_desde(usuario.usuario_id, request.headers.get("last-event-id"))
+    
+    async def gerar():
+        try:
+            if perdidos is None:
+                yield evento_sse("snapshot", await status_cronometros(usuario=usuario), timer_broadcaster.ultimo_id)
+            else:
+                for evento_id, dados in perdidos:
+                    yield evento_sse("timer", dados, evento_id)
+            
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(fila.get(), timeout=SSE_HEARTBEAT_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                if evento is None:
+                    yield evento_sse("snapshot", await status_cronometros(usuario=usuario), timer_broadcaster.ultimo_id)
+                else:
+                    evento_id, dados = evento
+                    yield evento_sse("timer", dados, evento_id)
+        finally:
+            timer_broadcaster.cancelar(usuario.usuario_id, fila)
+    
+    return StreamingResponse(
+        gerar(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/timer/status/{disciplina_id}")
+async def status_cronometro(disciplina_id: str, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Verificar status do cronômetro para uma disciplina"""
+    sessao_ativa = await usuario.sessoes.obter_ativa(disciplina_id)
+    
+    return status_sessao(sessao_ativa)
+
+@api_router.post("/timer/sinal/{disciplina_id}")
+async def sinal_cronometro(disciplina_id: str, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Heartbeat do cliente com o cronômetro aberto; sem ele a sessão é encerrada no último sinal"""
+    sessao_ativa = await usuario.sessoes.registrar_sinal(disciplina_id, datetime.utcnow())
+    if not sessao_ativa:
+        raise HTTPException(status_code=404, detail="Nenhuma sessão ativa encontrada para esta disciplina")
+    return status_sessao(sessao_ativa)
+
+# Offline sync: a client replays what it queued as one ordered batch instead of one request per action
+MAX_EVENTOS_SYNC = 500
+MAX_CHAVE_SYNC = 128
+
+def sessao_sincronizada(disciplina_id: str, inicio: datetime) -> Dict[str, Any]:
+    return SessaoEstudo(disciplina_id=disciplina_id, inicio=inicio).dict()
+
+@api_router.post("/sync")
+async def sincronizar(lote: LoteSync, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Aplicar em ordem eventos gerados offline (iniciar, parar, tarefa) e devolver o estado resultante
     
-    resultados = await db.sessoes_estudo.aggregate(pipeline).to_list(1000)
+    Cada evento traz uma `chave` de idempotência: reenviar um lote (ou parte dele) não reaplica nada,
+    e o resultado original volta com `duplicado: true`. As escritas vão num lote por coleção; se uma
+    delas falhar, parte do lote pode já estar gravada, e seus eventos ficam com status `erro`.
+    """
+    if len(lote.eventos) > MAX_EVENTOS_SYNC:
+        raise HTTPException(status_code=400, detail=f"No máximo {MAX_EVENTOS_SYNC} eventos por lote")
+    if any(not evento.chave or len(evento.chave) > MAX_CHAVE_SYNC for evento in lote.eventos):
+        raise HTTPException(status_code=400, detail=f"Toda chave deve ter de 1 a {MAX_CHAVE_SYNC} caracteres")
+    
+    eventos = [evento.dict() for evento in lote.eventos]
+    chaves = list(dict.fromkeys(evento["chave"] for evento in eventos))
+    # Claiming the keys first keeps a concurrent replay of the same batch from applying it twice
+    reservadas = set(await usuario.sync.reservar(chaves))
+    try:
+        anteriores = await usuario.sync.resultados([c for c in chaves if c not in reservadas]) \
+            if len(reservadas) < len(chaves) else {}
+        
+        disciplina_ids = list(dict.fromkeys(
+            [disciplina.id for disciplina in await catalogos.de(usuario).todas()]
+            + [evento["disciplina_id"] for evento in eventos if evento["disciplina_id"]]
+        ))
+        semanas = sorted({
+            evento["semana_inicio"].isoformat() for evento in eventos
+            if evento["tipo"] == "tarefa" and evento["semana_inicio"] and evento["chave"] in reservadas
+        })
+        agora = datetime.utcnow()
+        plano = PlanoSync(
+            await usuario.sessoes.listar_ativas(disciplina_ids),
+            await usuario.desempenho.obter_semanas(semanas),
+            agora,
+            sessao_sincronizada,
+        )
+        
+        resultados: Dict[str, Dict[str, Any]] = {}
+        respostas = []
+        for evento in eventos:
+            chave = evento["chave"]
+            if chave in resultados:
+                respostas.append((resultados[chave], True))
+            elif chave in reservadas:
+                resultados[chave] = plano.aplicar(evento)
+                respostas.append((resultados[chave], False))
+            else:
+                # A batch still being applied elsewhere has no result yet
+                pendente = {"chave": chave, "tipo": evento["tipo"], "status": "pendente"}
+                respostas.append((anteriores.get(chave) or pendente, True))
+    except Exception:
+        # Nothing is written yet: free the keys so the client can resend the batch
+        await usuario.sync.liberar(list(reservadas))
+        raise
+    
+    try:
+        conflitos = await usuario.sessoes.aplicar_lote(list(plano.novas.values()), list(plano.encerradas.values()))
+        plano.marcar_conflitos(conflitos)
+        await usuario.rollups.incrementar_muitos(plano.incrementos_rollup())
+        await usuario.desempenho.marcar_tarefas(plano.alteracoes_tarefas())
+        await usuario.sync.concluir(list(resultados.values()))
+    except Exception:
+        # Releasing the keys would let a replay insert the sessions already written a second time
+        falhas = [{**resultado, "status": "erro", "detalhe": "Falha ao gravar o lote; parte dele pode ter sido aplicada"}
+                  for resultado in resultados.values()]
+        try:
+            await usuario.sync.concluir(falhas)
+        except Exception:
+            logger.exception(f"Could not record the failed sync batch of {usuario.usuario_id}")
+        raise
+    finally:
+        cache_resumos.invalidar(usuario.usuario_id)
+        cache_desempenho.invalidar(usuario.usuario_id)
+    
+    for _, disciplina_id, sessao, duracao_segundos in plano.publicacoes:
+        if sessao:
+            timer_broadcaster.publicar(usuario.usuario_id, {"disciplina_id": disciplina_id, **status_sessao(sessao)})
+        else:
+            timer_broadcaster.publicar(usuario.usuario_id, {"disciplina_id": disciplina_id, **status_sessao(None),
+                                                            "duracao_segundos": duracao_segundos})
+    
+    # The planned state is exact unless another request won a race; then read it back
+    ativas = await usuario.sessoes.listar_ativas(disciplina_ids) if conflitos else plano.ativas.values()
+    por_disciplina = {sessao["disciplina_id"]: sessao for sessao in ativas}
+    return MongoJSONResponse({
+        "resultados": [{**resultado, "duplicado": duplicado} for resultado, duplicado in respostas],
+        "cronometros": {
+            disciplina_id: status_sessao(por_disciplina.get(disciplina_id), agora)
+            for disciplina_id in disciplina_ids
+        },
+        "semanas": await usuario.desempenho.obter_semanas(sorted({s for s, _, _ in plano.tarefas})),
+    })
+
+async def resumo_por_periodo(usuario: DadosUsuario, inicio: date, fim: date) -> List[ResumoSemanalTempo]:
+    """Somar os rollups diários do usuário por disciplina no intervalo [inicio, fim]"""
+    resultados = await usuario.rollups.somar_por_disciplina(inicio.isoformat(), fim.isoformat())
+    catalogo = catalogos.de(usuario)
     
     # Get discipline names and format results
     resumo_final = []
     for resultado in resultados:
-        disciplina = await db.disciplinas.find_one({"id": resultado["_id"]})
+        disciplina = await catalogo.obter(resultado["disciplina_id"])
         if disciplina:
             total_segundos = resultado["total_segundos"]
             total_horas = total_segundos / 3600
             total_minutos = total_segundos // 60
             
             resumo_final.append(ResumoSemanalTempo(
-                disciplina_id=resultado["_id"],
-                nome_disciplina=disciplina["nome"],
+                disciplina_id=resultado["disciplina_id"],
+                nome_disciplina=disciplina.nome,
                 total_segundos=total_segundos,
                 total_horas=round(total_horas, 2),
                 total_minutos=total_minutos
@@ -369,14 +1243,377 @@ async def resumo_tempo_semanal():
     
     return resumo_final
 
+async def resumo_condicional(request: Request, usuario: DadosUsuario, inicio: date, fim: date) -> Response:
+    """Resumo do período com ETag derivado do marcador dos rollups, servido do cache de agregados"""
+    # The rollup marker advances on every timer stop and rebuild; names come from the catalog.
+    # Both are cheap, so a revalidation is answered before the cache or the aggregation
+    _, etag_catalogo = await catalogos.de(usuario).json_todas()
+    etag = etag_de("resumo", usuario.usuario_id, inicio, fim, await usuario.rollups.versao(), etag_catalogo)
+    if nao_modificado(request, etag):
+        return resposta_304(etag)
+    
+    async def produzir():
+        resumo = await resumo_por_periodo(usuario, inicio, fim)
+        return encode_json([item.dict() for item in resumo])
+    
+    # Keyed by the ETag too, so a body is only ever served under the marker it was computed at
+    corpo = await cache_resumos.obter(usuario.usuario_id, (inicio, fim, etag), produzir)
+    return Response(content=corpo, media_type="application/json", headers=cabecalhos_cache(etag))
+
+@api_router.get("/timer/resumo-semanal", response_model=List[ResumoSemanalTempo])
+async def resumo_tempo_semanal(request: Request, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Obter resumo do tempo estudado por disciplina na semana atual"""
+    # Calculate current week start (Monday)
+    today = datetime.utcnow().date()
+    days_since_monday = today.weekday()
+    week_start = today - timedelta(days=days_since_monday)
+    week_end = week_start + timedelta(days=6)
+    
+    return await resumo_condicional(request, usuario, week_start, week_end)
+
+@api_router.get("/timer/resumo-mensal", response_model=List[ResumoSemanalTempo])
+async def resumo_tempo_mensal(request: Request, mes: Optional[str] = None, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Obter resumo do tempo estudado por disciplina em um mês (YYYY-MM, padrão: mês atual)"""
+    if mes:
+        try:
+            month_start = datetime.strptime(mes, "%Y-%m").date()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Formato de mês inválido. Use YYYY-MM")
+    else:
+        month_start = datetime.utcnow().date().replace(day=1)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    
+    return await resumo_condicional(request, usuario, month_start, next_month - timedelta(days=1))
+
+@api_router.get("/timer/resumo", response_model=List[ResumoSemanalTempo])
+async def resumo_tempo_periodo(request: Request, de: str, ate: str, usuario: DadosUsuario = Depends(usuario_atual)):
+    """Obter resumo do tempo estudado por disciplina em um intervalo de datas"""
+    data_de = parse_data(de)
+    data_ate = parse_data(ate)
+    if data_ate < data_de:
+        raise HTTPException(status_code=400, detail="A data final deve ser posterior à inicial")
+    if (data_ate - data_de).days > 366:
+        raise HTTPException(status_code=400, detail="O intervalo máximo é de 366 dias")
+    
+    return await resumo_condicional(request, usuario, data_de, data_ate)
+
+# Vectorized analytics over a user's sessions, split across day boundaries and memoized per date range
+memo_analitico = MemoAnalitico(int(os.environ.get('ANALYTICS_MEMO_MAX_BYTES', str(64 * 1024 * 1024))))
+MAX_DIAS_ANALISE = 3660
+
+def intervalo_analise(de: Optional[str], ate: Optional[str]) -> Tuple[date, date]:
+    """Intervalo [de, ate] das análises; padrão: os últimos 365 dias"""
+    data_ate = parse_data(ate) if ate else datetime.utcnow().date()
+    data_de = parse_data(de) if de else data_ate - timedelta(days=364)
+    if data_ate < data_de:
+        raise HTTPException(status_code=400, detail="A data final deve ser posterior à inicial")
+    if (data_ate - data_de).days >= MAX_DIAS_ANALISE:
+        raise HTTPException(status_code=400, detail=f"O intervalo máximo é de {MAX_DIAS_ANALISE} dias")
+    return data_de, data_ate
+
+async def matriz_do_periodo(usuario: DadosUsuario, de: date, ate: date):
+    """Dias × disciplinas com os segundos estudados no período"""
+    # The rollup marker advances on every timer stop, rebuild and import, so it keys the memo
+    chave = (usuario.usuario_id, de, ate, await usuario.rollups.versao())
+    matriz = memo_analitico.obter(chave)
+    if matriz is None:
+        colunas = await usuario.sessoes.colunas_concluidas(
+            datetime.combine(de, datetime.min.time()) - MARGEM_INICIO,
+            datetime.combine(ate, datetime.max.time())
+        )
+        # Pandas work runs off the event loop; years of sessions take tens of milliseconds
+        matriz = await asyncio.to_thread(matriz_do_intervalo, colunas, de, ate)
+        memo_analitico.guardar(chave, matriz)
+    return matriz
+
+async def nomes_disciplinas(usuario: DadosUsuario) -> Dict[str, str]:
+    return {disciplina.id: disciplina.nome for disciplina in await catalogos.de(usuario).todas()}
+
+@api_router.get("/analytics/heatmap")
+async def analytics_heatmap(de: Optional[str] = None, ate: Optional[str] = None,
+                            usuario: DadosUsuario = Depends(usuario_atual)):
+    """Mapa de calor diário: segundos estudados por dia e nível de 0 a 4 relativo ao dia de maior estudo"""
+    data_de, data_ate = intervalo_analise(de, ate)
+    matriz = await matriz_do_periodo(usuario, data_de, data_ate)
+    return MongoJSONResponse({"de": data_de.isoformat(), "ate": data_ate.isoformat(), **mapa_de_calor(matriz)})
+
+@api_router.get("/analytics/sequencias")
+async def analytics_sequencias(de: Optional[str] = None, ate: Optional[str] = None,
+                               minimo_minutos: int = Query(1, ge=1, le=1440),
+                               usuario: DadosUsuario = Depends(usuario_atual)):
+    """Sequência atual e maior sequência de dias com pelo menos `minimo_minutos` de estudo"""
+    data_de, data_ate = intervalo_analise(de, ate)
+    matriz = await matriz_do_periodo(usuario, data_de, data_ate)
+    return MongoJSONResponse({
+        "de": data_de.isoformat(),
+        "ate": data_ate.isoformat(),
+        **sequencias(matriz, minimo_minutos * 60, datetime.utcnow().date()),
+    })
+
+@api_router.get("/analytics/medias")
+async def analytics_medias(de: Optional[str] = None, ate: Optional[str] = None,
+                           janela: int = Query(7, ge=1, le=365),
+                           usuario: DadosUsuario = Depends(usuario_atual)):
+    """Média móvel diária de `janela` dias e tendência linear por disciplina"""
+    data_de, data_ate = intervalo_analise(de, ate)
+    matriz = await matriz_do_periodo(usuario, data_de, data_ate)
+    return MongoJSONResponse({"de": data_de.isoformat(), "ate": data_ate.isoformat(),
+                              **medias_moveis(matriz, janela, await nomes_disciplinas(usuario))})
+
+@api_router.get("/analytics/distribuicao")
+async def analytics_distribuicao(de: Optional[str] = None, ate: Optional[str] = None, por: str = "dia",
+                                 usuario: DadosUsuario = Depends(usuario_atual)):
+    """Segundos por disciplina em cada dia ou semana, com as sessões repartidas nas viradas de dia/semana"""
+    if por not in ("dia", "semana"):
+        raise HTTPException(status_code=400, detail="`por` deve ser 'dia' ou 'semana'")
+    data_de, data_ate = intervalo_analise(de, ate)
+    matriz = await matriz_do_periodo(usuario, data_de, data_ate)
+    return MongoJSONResponse({"de": data_de.isoformat(), "ate": data_ate.isoformat(),
+                              **distribuicao(matriz, por, await nomes_disciplinas(usuario))})
+
+def encode_cursor(sessao: Dict[str, Any]) -> str:
+    inicio, sessao_id = posicao_sessao(sessao)
+    payload = json.dumps({"inicio": inicio.isoformat(), "id": sessao_id})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {"inicio": datetime.fromisoformat(payload["inicio"]), "id": payload["id"]}
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
 @api_router.get("/timer/sessoes/{disciplina_id}")
-async def get_sessoes_disciplina(disciplina_id: str):
-    """Buscar todas as sessões de estudo de uma disciplina"""
-    sessoes = await db.sessoes_estudo.find({"disciplina_id": disciplina_id}).sort("inicio", -1).to_list(1000)
-    return [serialize_obj(sessao) for sessao in sessoes]
+async def get_sessoes_disciplina(
+    disciplina_id: str,
+    request: Request,
+    limite: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    usuario: DadosUsuario = Depends(usuario_atual),
+):
+    """Buscar as sessões de estudo de uma disciplina, da mais recente para a mais antiga
+    
+    Paginação por keyset em (inicio, id): passe o `next_cursor` da página anterior em `cursor`.
+    Com `Accept: application/x-ndjson` o histórico restante é transmitido documento a documento.
+    """
+    posicao = decode_cursor(cursor) if cursor else None
+    
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        async def gerar_ndjson():
+            async for sessao in usuario.sessoes.historico(disciplina_id, apos=posicao, batch_size=limite):
+                yield encode_json(sessao) + b"\n"
+        
+        return StreamingResponse(gerar_ndjson(), media_type="application/x-ndjson")
+    
+    # Fetch one extra document to know whether another page exists
+    sessoes = [sessao async for sessao in usuario.sessoes.historico(disciplina_id, apos=posicao, limite=limite + 1)]
+    next_cursor = encode_cursor(sessoes[limite - 1]) if len(sessoes) > limite else None
+    return MongoJSONResponse({"sessoes": sessoes[:limite], "next_cursor": next_cursor})
+
+# Bulk export/import of study data
+COLECOES_EXPORTAVEIS = {
+    "disciplinas": Disciplina,
+    "sessoes_estudo": SessaoEstudo,
+    "desempenho_semanal": DesempenhoSemanal,
+}
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 1000
+
+def documento_para_mongo(colecao: str, documento: Dict[str, Any]) -> Dict[str, Any]:
+    """Validar um documento importado e convertê-lo para o formato armazenado"""
+    modelo = COLECOES_EXPORTAVEIS[colecao]
+    # The owner always comes from the request, never from the imported document
+    documento = {k: v for k, v in documento.items() if k not in ("_id", "usuario_id")}
+    validado = {**documento, **modelo(**documento).dict()}
+    if colecao == "desempenho_semanal":
+        # Weeks are stored keyed by their ISO date string
+        validado["semana_inicio"] = validado["semana_inicio"].isoformat()
+    return validado
+
+def celula_csv(valor: Any) -> str:
+    if valor is None:
+        return ""
+    if isinstance(valor, (list, dict)):
+        return json.dumps(valor)
+    if isinstance(valor, bool):
+        return "true" if valor else "false"
+    return str(valor)
+
+def linhas_csv(linhas: List[List[str]]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(linhas)
+    return buffer.getvalue()
+
+def colunas_csv(colecao: str) -> List[str]:
+    return list(COLECOES_EXPORTAVEIS[colecao].model_fields.keys())
+
+def colecoes_solicitadas(colecoes: Optional[str]) -> List[str]:
+    nomes = [c.strip() for c in colecoes.split(",") if c.strip()] if colecoes else list(COLECOES_EXPORTAVEIS)
+    desconhecidas = [nome for nome in nomes if nome not in COLECOES_EXPORTAVEIS]
+    if desconhecidas:
+        raise HTTPException(status_code=400, detail=f"Coleções desconhecidas: {', '.join(desconhecidas)}")
+    return nomes
+
+@api_router.get("/export")
+async def exportar_dados(formato: str = "ndjson", colecoes: Optional[str] = None,
+                         usuario: DadosUsuario = Depends(usuario_atual)):
+    """Exportar as coleções de estudo do usuário em NDJSON (todas) ou CSV (uma coleção por vez)"""
+    nomes = colecoes_solicitadas(colecoes)
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato inválido. Use ndjson ou csv")
+    if formato == "csv" and len(nomes) != 1:
+        raise HTTPException(status_code=400, detail="A exportação CSV exige exatamente uma coleção em `colecoes`")
+    
+    async def gerar():
+        inicio = time.perf_counter()
+        total = 0
+        for colecao in nomes:
+            colunas = colunas_csv(colecao)
+            if formato == "csv":
+                yield linhas_csv([colunas])
+            
+            # Flush one chunk per cursor batch so memory stays bounded
+            pendentes = []
+            async for documento in usuario.repositorios[colecao].iterar(EXPORT_BATCH_SIZE):
+                documento = serialize_obj(documento)
+                if formato == "csv":
+                    pendentes.append([celula_csv(documento.get(coluna)) for coluna in colunas])
+                else:
+                    pendentes.append(json.dumps({"colecao": colecao, "documento": documento}) + "\n")
+                total += 1
+                if len(pendentes) >= EXPORT_BATCH_SIZE:
+                    yield linhas_csv(pendentes) if formato == "csv" else "".join(pendentes)
+                    pendentes = []
+            if pendentes:
+                yield linhas_csv(pendentes) if formato == "csv" else "".join(pendentes)
+        
+        segundos = time.perf_counter() - inicio
+        resumo = {"documentos": total, "segundos": round(segundos, 3), "docs_por_segundo": round(total / segundos, 1) if segundos else None}
+        logger.info(f"Export finished: {resumo}")
+        if formato == "ndjson":
+            yield json.dumps({"resumo": resumo}) + "\n"
+    
+    media_type = "text/csv" if formato == "csv" else "application/x-ndjson"
+    filename = f"{nomes[0]}.csv" if formato == "csv" else "export.ndjson"
+    return StreamingResponse(gerar(), media_type=media_type, headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+async def linhas_do_corpo(request: Request):
+    """Quebrar o corpo da requisição em linhas à medida que ele chega"""
+    # A multi-byte character may be split across two chunks
+    decodificador = codecs.getincrementaldecoder("utf-8")()
+    resto = ""
+    try:
+        async for chunk in request.stream():
+            resto += decodificador.decode(chunk)
+            *linhas, resto = resto.split("\n")
+            for linha in linhas:
+                yield linha + "\n"
+        resto += decodificador.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="O corpo da requisição não está em UTF-8")
+    if resto:
+        yield resto
+
+async def registros_ndjson(request: Request):
+    async for linha in linhas_do_corpo(request):
+        if not linha.strip():
+            continue
+        try:
+            registro = json.loads(linha)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Linha NDJSON inválida: {linha[:100]}")
+        if "resumo" in registro:
+            continue
+        yield registro.get("colecao"), registro.get("documento") or {}
+
+async def registros_csv(request: Request, colecao: str):
+    colunas = None
+    pendente = ""
+    async for linha in linhas_do_corpo(request):
+        pendente += linha
+        # A quoted field may span lines; wait until every quote is closed
+        if pendente.count('"') % 2:
+            continue
+        for valores in csv.reader(io.StringIO(pendente)):
+            if colunas is None:
+                colunas = valores
+                continue
+            documento = {}
+            for coluna, valor in zip(colunas, valores):
+                if valor == "":
+                    continue
+                documento[coluna] = json.loads(valor) if coluna in DIAS_SEMANA else valor
+            yield colecao, documento
+        pendente = ""
+
+@api_router.post("/import")
+async def importar_dados(request: Request, formato: str = "ndjson", colecao: Optional[str] = None,
+                         usuario: DadosUsuario = Depends(usuario_atual)):
+    """Importar dados exportados para o usuário, com upsert por `id` em lotes de bulk_write"""
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato inválido. Use ndjson ou csv")
+    if formato == "csv":
+        if colecao not in COLECOES_EXPORTAVEIS:
+            raise HTTPException(status_code=400, detail="A importação CSV exige o parâmetro `colecao`")
+        registros = registros_csv(request, colecao)
+    else:
+        registros = registros_ndjson(request)
+    
+    inicio = time.perf_counter()
+    lotes: Dict[str, List[Dict[str, Any]]] = {}
+    importados = {nome: 0 for nome in COLECOES_EXPORTAVEIS}
+    
+    async def aplicar(nome: str):
+        documentos = lotes.pop(nome, [])
+        if not documentos:
+            return
+        try:
+            await usuario.repositorios[nome].upsert_muitos(documentos)
+        except DocumentosRecusados as e:
+            # Earlier batches stay imported; name the failed one so the client can fix and resume
+            lote = importados[nome] // IMPORT_BATCH_SIZE + 1
+            primeiro, ultimo = importados[nome] + 1, importados[nome] + len(documentos)
+            raise HTTPException(
+                status_code=409,
+                detail=f"Lote {lote} de {nome} (documentos {primeiro} a {ultimo}) recusado: {e}. "
+                       f"Importados antes dele: {importados}"
+            )
+        importados[nome] += len(documentos)
+    
+    async for nome, documento in registros:
+        if nome not in COLECOES_EXPORTAVEIS:
+            raise HTTPException(status_code=400, detail=f"Coleção desconhecida: {nome}")
+        try:
+            documento = documento_para_mongo(nome, documento)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Documento inválido em {nome}: {e}")
+        lotes.setdefault(nome, []).append(documento)
+        if len(lotes[nome]) >= IMPORT_BATCH_SIZE:
+            await aplicar(nome)
+    for nome in list(lotes):
+        await aplicar(nome)
+    
+    # Derived state follows the imported data
+    if importados["disciplinas"]:
+        catalogos.de(usuario).invalidar()
+    if importados["sessoes_estudo"]:
+        await usuario.rollups.reconstruir()
+    cache_resumos.invalidar(usuario.usuario_id)
+    cache_desempenho.invalidar(usuario.usuario_id)
+    
+    segundos = time.perf_counter() - inicio
+    total = sum(importados.values())
+    return {
+        "message": "Importação concluída com sucesso",
+        "importados": importados,
+        "documentos": total,
+        "segundos": round(segundos, 3),
+        "docs_por_segundo": round(total / segundos, 1) if segundos else None
+    }
 
-# Include the router in the main app
+# Include the routers in the main app
 app.include_router(api_router)
+app.include_router(admin_router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -385,6 +1622,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(PrometheusMiddleware)
+if perfis.habilitado or consultas_lentas:
+    app.add_middleware(DiagnosticoMiddleware, perfis=perfis)
 
 # Configure logging
 logging.basicConfig(
@@ -393,6 +1633,3 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
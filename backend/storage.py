@@ -0,0 +1,2251 @@
+"""Storage layer for the study planner API.
+
+Handlers talk to repositories that exchange plain documents (dicts without `_id`),
+so the same API runs on MongoDB (`MongoStorage`, on Motor) or on the embedded
+SQLite store (`SQLiteStorage`), which also serves as the in-memory backend when
+opened on ":memory:". `criar_storage` picks one from the STORAGE_BACKEND setting.
+
+Study data is partitioned by user: `Storage.do_usuario()` hands out repositories bound
+to one `usuario_id`, which every filter and every written document carries, and every
+index leads on it. Only `status_checks` stays global.
+
+Completed sessions older than the compaction age move to a second tier, `sessoes_compactadas`:
+one document per (usuario_id, disciplina_id, month) with parallel arrays of ids, start offsets
+and durations. Session reads (history, daily totals, analytics columns, export) span both tiers.
+"""
+import asyncio
+import json
+import sqlite3
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, date, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+
+
+class SessaoAtivaExistente(Exception):
+    """A discipline already has an active study session"""
+
+
+class DocumentosRecusados(Exception):
+    """A bulk write had documents rejected, e.g. by a unique index; the others may have been written"""
+
+
+# Owner of the data written before it was partitioned by user, and of requests without one
+USUARIO_PADRAO = "padrao"
+
+# Collections partitioned by usuario_id
+COLECOES_DO_USUARIO = [
+    "disciplinas", "sessoes_estudo", "desempenho_semanal", "study_rollups", "sync_eventos", "sessoes_compactadas",
+]
+
+# How long /sync idempotency keys are remembered; replays older than this are applied again
+SYNC_RETENCAO = timedelta(days=30)
+
+
+# Compacted tier: a bucket holds a month of one discipline's completed sessions as offsets
+# (whole seconds since the start of the month) and durations, next to the sessions' ids
+LOTE_COMPACTACAO = 5000
+# A compaction run claims its batch for this long; a claim older than that belongs to a run that died
+PRAZO_COMPACTACAO = timedelta(hours=1)
+
+
+def inicio_do_mes(valor: datetime) -> datetime:
+    return datetime(valor.year, valor.month, 1)
+
+
+def agrupar_em_buckets(sessoes: List[Dict[str, Any]]) -> Dict[Tuple[str, datetime], Dict[str, List[Any]]]:
+    """Arrays de cada bucket (disciplina_id, mês) para sessões concluídas com `inicio` datetime"""
+    buckets: Dict[Tuple[str, datetime], Dict[str, List[Any]]] = {}
+    for sessao in sessoes:
+        mes = inicio_do_mes(sessao["inicio"])
+        bucket = buckets.setdefault((sessao["disciplina_id"], mes), {"ids": [], "inicios": [], "duracoes": []})
+        bucket["ids"].append(sessao["id"])
+        bucket["inicios"].append(int((sessao["inicio"] - mes).total_seconds()))
+        bucket["duracoes"].append(int(sessao.get("duracao_segundos") or 0))
+    return buckets
+
+
+def expandir_bucket(bucket: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Sessões de um bucket como documentos de sessoes_estudo; criado_em e frações de segundo não são guardados"""
+    sessoes = []
+    for sessao_id, deslocamento, duracao in zip(bucket["ids"], bucket["inicios"], bucket["duracoes"]):
+        inicio = bucket["mes"] + timedelta(seconds=deslocamento)
+        sessoes.append({
+            "id": sessao_id,
+            "disciplina_id": bucket["disciplina_id"],
+            "inicio": inicio,
+            "fim": inicio + timedelta(seconds=duracao),
+            "duracao_segundos": duracao,
+            "ativa": False,
+            "criado_em": inicio,
+        })
+    return sessoes
+
+
+def posicao_sessao(sessao: Dict[str, Any]) -> Tuple[datetime, str]:
+    """(inicio, id) de uma sessão, a chave da ordem do histórico e dos cursores"""
+    inicio = sessao["inicio"]
+    # Sessions written before inicio was stored as a date may still hold an ISO string
+    if isinstance(inicio, str):
+        inicio = datetime.fromisoformat(inicio.replace("Z", "+00:00")).replace(tzinfo=None)
+    return inicio, sessao["id"]
+
+
+async def _mesclar_decrescente(*fontes: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    """Intercalar históricos já ordenados por (inicio, id) decrescente"""
+    proximos = [await anext(fonte, None) for fonte in fontes]
+    while any(sessao is not None for sessao in proximos):
+        i = max((i for i, sessao in enumerate(proximos) if sessao is not None), key=lambda i: posicao_sessao(proximos[i]))
+        yield proximos[i]
+        proximos[i] = await anext(fontes[i], None)
+
+
+def resumo_camadas(brutas: Dict[str, int], compactadas: Dict[str, int]) -> Dict[str, Any]:
+    """Tamanho de cada camada e a redução por sessão obtida com a compactação"""
+    por_bruta = brutas["bytes"] / brutas["documentos"] if brutas["documentos"] else None
+    por_compactada = compactadas["bytes"] / compactadas["sessoes"] if compactadas["sessoes"] else None
+    reducao = None
+    if por_bruta and por_compactada:
+        reducao = {
+            "bytes_por_sessao_bruta": round(por_bruta, 1),
+            "bytes_por_sessao_compactada": round(por_compactada, 1),
+            "percentual": round(100 * (1 - por_compactada / por_bruta), 1),
+            "bytes_economizados": round(compactadas["sessoes"] * por_bruta - compactadas["bytes"]),
+        }
+    return {"brutas": brutas, "compactadas": compactadas, "reducao": reducao}
+
+
+# Repository interfaces
+class Repositorio(ABC):
+    colecao: str
+    # None only for global collections (status_checks)
+    usuario_id: Optional[str] = None
+
+    @abstractmethod
+    async def iterar(self, batch_size: int = 1000) -> AsyncIterator[Dict[str, Any]]:
+        """Percorrer todos os documentos da coleção em lotes"""
+
+    @abstractmethod
+    async def upsert_muitos(self, documentos: List[Dict[str, Any]]):
+        """Inserir ou substituir documentos pelo campo `id`; levanta DocumentosRecusados se algum for recusado"""
+
+
+class DisciplinaRepository(Repositorio):
+    colecao = "disciplinas"
+
+    @abstractmethod
+    async def semear(self, documentos: List[Dict[str, Any]]) -> int:
+        """Inserir as disciplinas ainda ausentes (por nome) sem tocar nas existentes; devolve quantas criou"""
+
+    @abstractmethod
+    async def listar(self) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def obter(self, disciplina_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def atualizar(self, disciplina_id: str, campos: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Aplicar `campos` e devolver o documento atualizado (None se não existir)"""
+
+    @abstractmethod
+    async def atualizar_muitos(self, alteracoes: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Aplicar os campos de cada id de uma vez; devolve os documentos atualizados dos ids existentes"""
+
+
+class SessaoRepository(Repositorio):
+    colecao = "sessoes_estudo"
+
+    @abstractmethod
+    async def inserir_ativa(self, documento: Dict[str, Any]):
+        """Inserir uma sessão ativa; levanta SessaoAtivaExistente se já houver outra"""
+
+    @abstractmethod
+    async def encerrar_ativa(self, disciplina_id: str) -> Optional[Dict[str, Any]]:
+        """Encerrar a sessão ativa atomicamente e devolvê-la com fim e duração"""
+
+    @abstractmethod
+    async def obter_ativa(self, disciplina_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def listar_ativas(self, disciplina_ids: List[str]) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def registrar_sinal(self, disciplina_id: str, em: datetime) -> Optional[Dict[str, Any]]:
+        """Gravar `em` como o último sinal de vida (`visto_em`) da sessão ativa e devolvê-la, se houver"""
+
+    async def historico(
+        self,
+        disciplina_id: str,
+        apos: Optional[Dict[str, Any]] = None,
+        limite: Optional[int] = None,
+        batch_size: int = 100,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Sessões da mais recente para a mais antiga, após a posição (inicio, id) `apos`, nas duas camadas"""
+        entregues = 0
+        async for sessao in _mesclar_decrescente(
+            self._historico_bruto(disciplina_id, apos, limite, batch_size),
+            self._historico_compactado(disciplina_id, apos),
+        ):
+            yield sessao
+            entregues += 1
+            if limite and entregues >= limite:
+                return
+
+    @abstractmethod
+    async def _historico_bruto(self, disciplina_id: str, apos: Optional[Dict[str, Any]], limite: Optional[int],
+                               batch_size: int) -> AsyncIterator[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def _buckets_decrescentes(self, disciplina_id: str, ate: Optional[datetime]) -> AsyncIterator[Dict[str, Any]]:
+        """Buckets da disciplina do mês mais recente para o mais antigo, até o mês de `ate`"""
+
+    async def _historico_compactado(self, disciplina_id: str,
+                                    apos: Optional[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        # Buckets are only fetched as the merge reaches their month
+        async for bucket in self._buckets_decrescentes(disciplina_id, apos["inicio"] if apos else None):
+            for sessao in sorted(expandir_bucket(bucket), key=posicao_sessao, reverse=True):
+                if apos is None or posicao_sessao(sessao) < (apos["inicio"], apos["id"]):
+                    yield sessao
+
+    @abstractmethod
+    async def totais_por_dia(self, de: Optional[datetime] = None, ate: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Totais de sessões concluídas por (disciplina_id, dia)"""
+
+    @abstractmethod
+    async def existe_concluida(self) -> bool:
+        ...
+
+    @abstractmethod
+    async def colunas_concluidas(self, de: datetime, ate: datetime) -> Dict[str, List[Any]]:
+        """Sessões concluídas com início em [de, ate] em colunas: disciplina_id, inicio, duracao_segundos
+
+        `inicio` vem como datetime (MongoDB) ou texto ISO 8601 (SQLite); as análises convertem a coluna inteira.
+        """
+
+    @abstractmethod
+    async def compactar(self, antes: datetime, lote: int = LOTE_COMPACTACAO) -> Dict[str, int]:
+        """Mover as sessões concluídas que começaram antes de `antes` para os buckets mensais"""
+
+    @abstractmethod
+    async def aplicar_lote(self, novas: List[Dict[str, Any]], encerradas: List[Dict[str, Any]]) -> List[str]:
+        """Inserir `novas` e encerrar as sessões ativas `encerradas` (documentos com fim e duração) de uma vez
+
+        Devolve os ids que não puderam ser gravados porque outra requisição mudou o cronômetro antes
+        (nova sessão ativa concorrente, ou sessão já encerrada).
+        """
+
+
+class DesempenhoRepository(Repositorio):
+    colecao = "desempenho_semanal"
+
+    @abstractmethod
+    async def listar(self) -> List[Dict[str, Any]]:
+        """Todas as semanas, da mais recente para a mais antiga"""
+
+    @abstractmethod
+    async def listar_intervalo(self, de: str, ate: str) -> List[Dict[str, Any]]:
+        """Semanas com semana_inicio entre `de` e `ate` (YYYY-MM-DD), em ordem crescente"""
+
+    @abstractmethod
+    async def contagens(self, dias: List[str], de: Optional[str] = None, ate: Optional[str] = None,
+                        antes: Optional[str] = None, limite: int = 52) -> List[Dict[str, Any]]:
+        """Tarefas totais/concluídas em cada dia de cada semana, da mais recente para a mais antiga"""
+
+    @abstractmethod
+    async def obter_semana(self, semana_inicio: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def obter_semanas(self, semanas: List[str]) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def salvar_semana(self, documento: Dict[str, Any]):
+        """Substituir a semana `documento["semana_inicio"]`, criando-a se necessário
+
+        Toda escrita numa semana incrementa seu campo `versao`, usado como ETag.
+        """
+
+    @abstractmethod
+    async def adicionar_tarefa(self, semana_inicio: str, dia: str, tarefa: Dict[str, Any],
+                               semana_nova: Dict[str, Any]):
+        """Acrescentar uma tarefa ao dia, criando a semana a partir de `semana_nova` se necessário"""
+
+    @abstractmethod
+    async def atualizar_tarefa(self, semana_inicio: str, dia: str, tarefa_id: str,
+                               campos: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Alterar campos de uma tarefa e devolvê-la atualizada (None se não existir)"""
+
+    @abstractmethod
+    async def remover_tarefa(self, semana_inicio: str, dia: str, tarefa_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def marcar_tarefas(self, alteracoes: List[Tuple[str, str, str, bool]]):
+        """Aplicar (semana_inicio, dia, tarefa_id, concluida) de uma vez; tarefas inexistentes são ignoradas"""
+
+
+class StatusCheckRepository(Repositorio):
+    colecao = "status_checks"
+
+    @abstractmethod
+    async def inserir(self, documento: Dict[str, Any]):
+        ...
+
+    @abstractmethod
+    async def listar(self) -> List[Dict[str, Any]]:
+        ...
+
+
+class RollupRepository(ABC):
+    colecao = "study_rollups"
+
+    @abstractmethod
+    async def incrementar(self, disciplina_id: str, dia: str, segundos: int):
+        ...
+
+    @abstractmethod
+    async def incrementar_muitos(self, incrementos: List[Dict[str, Any]]):
+        """Somar vários {disciplina_id, dia, total_segundos, sessoes} avançando o marcador uma só vez"""
+
+    @abstractmethod
+    async def somar_por_disciplina(self, de: str, ate: str) -> List[Dict[str, Any]]:
+        """Total de segundos por disciplina entre os dias `de` e `ate` (YYYY-MM-DD)"""
+
+    @abstractmethod
+    async def listar(self, de: str, ate: str) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def reconstruir(self) -> int:
+        """Reconstruir os rollups do usuário a partir das sessões concluídas; devolve o total
+
+        Dias que não têm mais nenhuma sessão concluída são removidos, não só os demais recalculados.
+        """
+
+    @abstractmethod
+    async def contar(self) -> int:
+        ...
+
+    @abstractmethod
+    async def versao(self) -> int:
+        """Marcador que avança a cada incremento ou reconstrução; resumos o usam como ETag sem reagregar"""
+
+
+class SyncRepository(ABC):
+    """Chaves de idempotência dos eventos recebidos por /sync, com o resultado de cada um"""
+    colecao = "sync_eventos"
+
+    @abstractmethod
+    async def reservar(self, chaves: List[str]) -> List[str]:
+        """Registrar as chaves ainda desconhecidas como pendentes; devolve só as que foram reservadas agora"""
+
+    @abstractmethod
+    async def resultados(self, chaves: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Resultado gravado de cada chave (None enquanto o lote que a reservou não terminou)"""
+
+    @abstractmethod
+    async def concluir(self, resultados: List[Dict[str, Any]]):
+        """Gravar o resultado de cada evento reservado, pela sua `chave`"""
+
+    @abstractmethod
+    async def liberar(self, chaves: List[str]):
+        """Desfazer reservas de um lote que falhou, para que o cliente possa reenviá-lo"""
+
+
+class DadosUsuario:
+    """Repositórios de um usuário: toda consulta e escrita fica restrita ao seu `usuario_id`"""
+
+    def __init__(self, usuario_id: str, disciplinas: DisciplinaRepository, sessoes: SessaoRepository,
+                 desempenho: DesempenhoRepository, rollups: RollupRepository, sync: SyncRepository):
+        self.usuario_id = usuario_id
+        self.disciplinas = disciplinas
+        self.sessoes = sessoes
+        self.desempenho = desempenho
+        self.rollups = rollups
+        self.sync = sync
+
+    @property
+    def repositorios(self) -> Dict[str, Repositorio]:
+        return {repo.colecao: repo for repo in (self.disciplinas, self.sessoes, self.desempenho)}
+
+
+class Storage(ABC):
+    nome: str
+    status_checks: StatusCheckRepository
+
+    @abstractmethod
+    def do_usuario(self, usuario_id: str) -> DadosUsuario:
+        """Repositórios restritos a `usuario_id` (objetos leves, sem I/O)"""
+
+    @abstractmethod
+    async def inicializar(self):
+        """Criar índices/tabelas e atribuir ao USUARIO_PADRAO os dados anteriores à partição por usuário"""
+
+    @abstractmethod
+    async def preencher_rollups(self) -> int:
+        """Construir os rollups de todos os usuários se ainda não existir nenhum; devolve quantos criou"""
+
+    @abstractmethod
+    async def verificar_indices(self) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    async def usuarios_com_sessoes(self) -> List[str]:
+        ...
+
+    async def compactar_sessoes(self, antes: datetime) -> Dict[str, int]:
+        """Compactar as sessões concluídas antes de `antes`, usuário por usuário"""
+        total = {"usuarios": 0, "sessoes": 0, "buckets": 0}
+        for usuario_id in await self.usuarios_com_sessoes():
+            resultado = await self.do_usuario(usuario_id).sessoes.compactar(antes)
+            if resultado["sessoes"]:
+                total["usuarios"] += 1
+                total["sessoes"] += resultado["sessoes"]
+                total["buckets"] += resultado["buckets"]
+        return total
+
+    @abstractmethod
+    async def relatorio_compactacao(self) -> Dict[str, Any]:
+        """Documentos e bytes das duas camadas de sessões e a redução obtida"""
+
+    @abstractmethod
+    async def encerrar_abandonadas(self, sinal_ate: datetime, sem_sinal_ate: Optional[datetime],
+                                   usuario_id: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Encerrar de uma vez as sessões ativas abandonadas, no último sinal de vida
+
+        Abandonadas são as com `visto_em` anterior a `sinal_ate` e, se `sem_sinal_ate` for dado, as que
+        nunca mandaram sinal e começaram antes dele (estas terminam no próprio início). Sem `usuario_id`,
+        de todos os usuários. Devolve as sessões encerradas por usuario_id; cada uma é devolvida por uma
+        única execução.
+        """
+
+    @abstractmethod
+    async def verificar_prontidao(self) -> Dict[str, Any]:
+        """Checagem barata para o readiness probe: banco respondendo e índices do manifesto presentes"""
+
+    @abstractmethod
+    async def descartar(self):
+        """Apagar todos os dados (usado por benchmarks e testes)"""
+
+    @abstractmethod
+    def fechar(self):
+        ...
+
+
+# MongoDB (Motor) backend
+
+# Index manifest: every query the API issues must be served by one of these. Indexes on
+# per-user collections lead on usuario_id, so a user's queries only touch their own keys
+INDEX_MANIFEST = {
+    "disciplinas": [
+        IndexModel([("usuario_id", ASCENDING), ("id", ASCENDING)], name="usuario_id_unico", unique=True),
+        # Lets concurrent first requests seed a user's catalog without duplicating it
+        IndexModel([("usuario_id", ASCENDING), ("nome", ASCENDING)], name="usuario_nome_unico", unique=True),
+    ],
+    "sessoes_estudo": [
+        IndexModel([("usuario_id", ASCENDING), ("id", ASCENDING)], name="usuario_id_unico", unique=True),
+        # At most one active session per discipline
+        IndexModel(
+            [("usuario_id", ASCENDING), ("disciplina_id", ASCENDING)],
+            name="usuario_sessao_ativa_unica",
+            unique=True,
+            partialFilterExpression={"ativa": True},
+        ),
+        IndexModel([("usuario_id", ASCENDING), ("ativa", ASCENDING), ("inicio", ASCENDING)],
+                   name="usuario_ativa_inicio"),
+        IndexModel(
+            [("usuario_id", ASCENDING), ("disciplina_id", ASCENDING), ("inicio", DESCENDING), ("id", DESCENDING)],
+            name="usuario_disciplina_inicio_id",
+        ),
+    ],
+    "desempenho_semanal": [
+        IndexModel([("usuario_id", ASCENDING), ("id", ASCENDING)], name="usuario_id_unico", unique=True),
+        IndexModel([("usuario_id", ASCENDING), ("semana_inicio", ASCENDING)], name="usuario_semana_inicio_unica",
+                   unique=True),
+    ],
+    "status_checks": [
+        IndexModel([("id", ASCENDING)], name="id_unico", unique=True),
+    ],
+    "study_rollups": [
+        IndexModel([("usuario_id", ASCENDING), ("disciplina_id", ASCENDING), ("dia", ASCENDING)],
+                   name="usuario_disciplina_dia_unico", unique=True),
+        IndexModel([("usuario_id", ASCENDING), ("dia", ASCENDING), ("disciplina_id", ASCENDING)],
+                   name="usuario_dia_disciplina"),
+    ],
+    "sessoes_compactadas": [
+        IndexModel([("usuario_id", ASCENDING), ("disciplina_id", ASCENDING), ("mes", DESCENDING)],
+                   name="usuario_disciplina_mes_unico", unique=True),
+    ],
+    "sync_eventos": [
+        IndexModel([("usuario_id", ASCENDING), ("chave", ASCENDING)], name="usuario_chave_unica", unique=True),
+        IndexModel([("registrado_em", ASCENDING)], name="registrado_em_ttl",
+                   expireAfterSeconds=int(SYNC_RETENCAO.total_seconds())),
+    ],
+}
+
+# Shard keys for horizontal scaling (sh.shardCollection). A sharded collection only accepts
+# unique indexes prefixed by its shard key, which is why every unique index above leads on usuario_id
+SHARD_KEYS = {colecao: {"usuario_id": 1} for colecao in COLECOES_DO_USUARIO}
+
+# Indexes replaced by the usuario_id-prefixed ones; dropped by the migration
+INDICES_LEGADOS = {
+    "disciplinas": ["id_unico", "nome_unico"],
+    "sessoes_estudo": ["id_unico", "sessao_ativa_unica", "ativa_inicio", "disciplina_inicio_id"],
+    "desempenho_semanal": ["id_unico", "semana_inicio_unica"],
+    "study_rollups": ["disciplina_dia_unico", "dia_disciplina"],
+    "sync_eventos": [],
+    "sessoes_compactadas": [],
+}
+MIGRACAO_USUARIO_ID = "migracao_usuario_id"
+MIGRACAO_INICIO_DATA = "migracao_inicio_data"
+
+# Hides the partition key from the documents handed to the API
+PROJECAO = {"_id": 0, "usuario_id": 0}
+
+
+def indices_incompativeis_com_shard() -> List[str]:
+    """Índices únicos do manifesto que não começam pela shard key da coleção"""
+    return [
+        f"{colecao}.{index.document['name']}"
+        for colecao, chave in SHARD_KEYS.items()
+        for index in INDEX_MANIFEST[colecao]
+        if index.document.get("unique") and list(index.document["key"])[:len(chave)] != list(chave)
+    ]
+
+
+def filtro_abandonadas(sinal_ate: datetime, sem_sinal_ate: Optional[datetime],
+                       usuario_id: Optional[str] = None) -> Dict[str, Any]:
+    condicoes = [{"visto_em": {"$lt": sinal_ate}}]
+    if sem_sinal_ate:
+        # Matches a null visto_em (sessions are stored with visto_em: None) as well as a missing one
+        condicoes.append({"visto_em": None, "inicio": {"$lt": sem_sinal_ate}})
+    filtro = {"ativa": True, "$or": condicoes}
+    if usuario_id is not None:
+        filtro["usuario_id"] = usuario_id
+    return filtro
+
+
+def pipeline_encerrar_abandonadas(execucao: str) -> List[Dict[str, Any]]:
+    """Encerrar no último sinal (ou no início), marcando a execução do reaper que encerrou"""
+    return [
+        {"$set": {"inicio": {"$toDate": "$inicio"}}},
+        {"$set": {
+            "fim": {"$max": ["$inicio", {"$ifNull": ["$visto_em", "$inicio"]}]},
+            "ativa": False,
+            "encerramento_automatico": execucao,
+        }},
+        {"$set": {"duracao_segundos": {"$toInt": {"$floor": {"$divide": [{"$subtract": ["$fim", "$inicio"]}, 1000]}}}}},
+    ]
+
+
+# Close the active session and compute its duration on the server, in one round trip
+PIPELINE_PARAR_SESSAO = [
+    {"$set": {"inicio": {"$toDate": "$inicio"}}},
+    {
+        "$set": {
+            "fim": "$$NOW",
+            "ativa": False,
+            "duracao_segundos": {
+                "$toInt": {"$floor": {"$divide": [{"$subtract": ["$$NOW", "$inicio"]}, 1000]}}
+            }
+        }
+    }
+]
+
+
+def estagios_do_plano(explain: Any) -> List[str]:
+    """Coletar os estágios do plano vencedor de um resultado de explain()"""
+    estagios = []
+    if isinstance(explain, dict):
+        for chave, valor in explain.items():
+            if chave == "rejectedPlans":
+                continue
+            if chave == "stage" and isinstance(valor, str):
+                estagios.append(valor)
+            else:
+                estagios.extend(estagios_do_plano(valor))
+    elif isinstance(explain, list):
+        for item in explain:
+            estagios.extend(estagios_do_plano(item))
+    return estagios
+
+
+def pipeline_expandir_buckets(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Estágios sobre sessoes_compactadas que devolvem uma sessão concluída por elemento dos buckets
+
+    `match` tem a forma usada em sessoes_estudo (usuario_id e um intervalo de `inicio`); o intervalo
+    também poda os buckets pelo mês antes da expansão.
+    """
+    intervalo = match.get("inicio", {})
+    meses = {}
+    if "$gte" in intervalo:
+        meses["$gte"] = inicio_do_mes(intervalo["$gte"])
+    for operador in ("$lt", "$lte"):
+        if operador in intervalo:
+            meses[operador] = intervalo[operador]
+    filtro_bucket = {k: v for k, v in match.items() if k != "inicio"}
+    if meses:
+        filtro_bucket["mes"] = meses
+    return [
+        {"$match": filtro_bucket},
+        {"$project": {
+            "_id": 0, "usuario_id": 1, "disciplina_id": 1, "mes": 1,
+            "sessao": {"$zip": {"inputs": ["$ids", "$inicios", "$duracoes"]}},
+        }},
+        {"$unwind": "$sessao"},
+        {"$project": {
+            "usuario_id": 1,
+            "disciplina_id": 1,
+            "id": {"$arrayElemAt": ["$sessao", 0]},
+            "inicio": {"$add": ["$mes", {"$multiply": [{"$arrayElemAt": ["$sessao", 1]}, 1000]}]},
+            "duracao_segundos": {"$arrayElemAt": ["$sessao", 2]},
+            "ativa": {"$literal": False},
+        }},
+        *([{"$match": {"inicio": intervalo}}] if intervalo else []),
+    ]
+
+
+def pipeline_concluidas(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Sessões concluídas das duas camadas, a partir de sessoes_estudo"""
+    return [
+        {"$match": {**match, "ativa": False, "inicio": {**match.get("inicio", {}), "$type": "date"}}},
+        {"$unionWith": {"coll": "sessoes_compactadas", "pipeline": pipeline_expandir_buckets(match)}},
+    ]
+
+
+def pipeline_sessoes_por_dia(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Agregar sessões concluídas (das duas camadas) em totais por (usuario_id, disciplina_id, dia)"""
+    return [
+        *pipeline_concluidas(match),
+        {
+            "$group": {
+                "_id": {
+                    "usuario_id": "$usuario_id",
+                    "disciplina_id": "$disciplina_id",
+                    "dia": {"$dateToString": {"format": "%Y-%m-%d", "date": "$inicio"}}
+                },
+                "total_segundos": {"$sum": "$duracao_segundos"},
+                "sessoes": {"$sum": 1}
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "usuario_id": "$_id.usuario_id",
+                "disciplina_id": "$_id.disciplina_id",
+                "dia": "$_id.dia",
+                "total_segundos": 1,
+                "sessoes": 1
+            }
+        }
+    ]
+
+
+def pipeline_reconstruir_rollups(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Totais por dia gravados em study_rollups, substituindo os existentes"""
+    return pipeline_sessoes_por_dia(match) + [
+        {
+            "$merge": {
+                "into": "study_rollups",
+                "on": ["usuario_id", "disciplina_id", "dia"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }
+        }
+    ]
+
+
+def intervalo_inicio(de: Optional[datetime], ate: Optional[datetime]) -> Dict[str, Any]:
+    intervalo = {}
+    if de:
+        intervalo["$gte"] = de
+    if ate:
+        intervalo["$lte"] = ate
+    return {"inicio": intervalo} if intervalo else {}
+
+
+async def avancar_marcador(marcadores, nome: str):
+    await marcadores.update_one(
+        {"_id": nome},
+        {"$inc": {"versao": 1}, "$currentDate": {"atualizado_em": True}},
+        upsert=True
+    )
+
+
+class MongoRepositorio(Repositorio):
+    def __init__(self, db, usuario_id: Optional[str] = None):
+        self.collection = db[self.colecao]
+        self.usuario_id = usuario_id
+
+    def _filtro(self, filtro: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Restringir um filtro aos documentos do usuário"""
+        if self.usuario_id is None:
+            return dict(filtro or {})
+        return {"usuario_id": self.usuario_id, **(filtro or {})}
+
+    def _documento(self, documento: Dict[str, Any]) -> Dict[str, Any]:
+        if self.usuario_id is None:
+            return dict(documento)
+        return {**documento, "usuario_id": self.usuario_id}
+
+    async def iterar(self, batch_size: int = 1000):
+        async for documento in self.collection.find(self._filtro(), PROJECAO).batch_size(batch_size):
+            yield documento
+
+    async def upsert_muitos(self, documentos: List[Dict[str, Any]]):
+        if not documentos:
+            return
+        try:
+            await self.collection.bulk_write(
+                [
+                    ReplaceOne(self._filtro({"id": documento["id"]}), self._documento(documento), upsert=True)
+                    for documento in documentos
+                ],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            erros = e.details["writeErrors"]
+            raise DocumentosRecusados(f"{len(erros)} de {len(documentos)} recusados: {erros[0]['errmsg']}") from e
+
+
+class MongoDisciplinaRepository(MongoRepositorio, DisciplinaRepository):
+    async def semear(self, documentos):
+        # The filter's usuario_id is written on insert along with $setOnInsert
+        operacoes = [
+            UpdateOne(self._filtro({"nome": documento["nome"]}), {"$setOnInsert": documento}, upsert=True)
+            for documento in documentos
+        ]
+        try:
+            result = await self.collection.bulk_write(operacoes, ordered=False)
+        except BulkWriteError as e:
+            # Another request seeded some of the names first (usuario_nome_unico); those are already there
+            if any(erro["code"] != 11000 for erro in e.details["writeErrors"]):
+                raise
+            return e.details["nUpserted"]
+        return result.upserted_count
+
+    async def listar(self):
+        return await self.collection.find(self._filtro(), PROJECAO).to_list(1000)
+
+    async def obter(self, disciplina_id):
+        return await self.collection.find_one(self._filtro({"id": disciplina_id}), PROJECAO)
+
+    async def atualizar(self, disciplina_id, campos):
+        filtro = self._filtro({"id": disciplina_id})
+        if not campos:
+            return await self.collection.find_one(filtro, PROJECAO)
+        return await self.collection.find_one_and_update(
+            filtro, {"$set": campos}, projection=PROJECAO, return_document=ReturnDocument.AFTER
+        )
+
+    async def atualizar_muitos(self, alteracoes):
+        if not alteracoes:
+            return {}
+        operacoes = [
+            UpdateOne(self._filtro({"id": disciplina_id}), {"$set": campos})
+            for disciplina_id, campos in alteracoes.items() if campos
+        ]
+        if operacoes:
+            await self.collection.bulk_write(operacoes, ordered=False)
+        # bulk_write only reports totals; reading the documents back tells which ids exist
+        disciplinas = self.collection.find(self._filtro({"id": {"$in": list(alteracoes)}}), PROJECAO)
+        return {disciplina["id"]: disciplina async for disciplina in disciplinas}
+
+
+class MongoSessaoRepository(MongoRepositorio, SessaoRepository):
+    def __init__(self, db, usuario_id: Optional[str] = None):
+        super().__init__(db, usuario_id)
+        self.compactadas = db["sessoes_compactadas"]
+
+    async def iterar(self, batch_size: int = 1000):
+        async for sessao in super().iterar(batch_size):
+            yield sessao
+        async for bucket in self.compactadas.find(self._filtro(), PROJECAO).batch_size(batch_size):
+            for sessao in expandir_bucket(bucket):
+                yield sessao
+
+    async def _ids_compactados(self, sessoes: List[Dict[str, Any]]) -> set:
+        """Ids dentre `sessoes` que já estão nos buckets de seus meses"""
+        chaves = {
+            (sessao["disciplina_id"], inicio_do_mes(sessao["inicio"]))
+            for sessao in sessoes if isinstance(sessao.get("inicio"), datetime)
+        }
+        if not chaves:
+            return set()
+        buckets = self.compactadas.find(
+            self._filtro({"$or": [{"disciplina_id": disciplina_id, "mes": mes} for disciplina_id, mes in chaves]}),
+            {"_id": 0, "ids": 1}
+        )
+        return {sessao_id async for bucket in buckets for sessao_id in bucket["ids"]} & {s["id"] for s in sessoes}
+
+    async def upsert_muitos(self, documentos):
+        # Re-importing an export must not bring compacted sessions back as raw duplicates
+        compactados = await self._ids_compactados(documentos)
+        await super().upsert_muitos([documento for documento in documentos if documento["id"] not in compactados])
+
+    async def inserir_ativa(self, documento):
+        # The usuario_sessao_ativa_unica partial index rejects a second active session atomically
+        try:
+            await self.collection.insert_one(self._documento(documento))
+        except DuplicateKeyError:
+            raise SessaoAtivaExistente(documento["disciplina_id"])
+
+    async def encerrar_ativa(self, disciplina_id):
+        return await self.collection.find_one_and_update(
+            self._filtro({"disciplina_id": disciplina_id, "ativa": True}),
+            PIPELINE_PARAR_SESSAO,
+            projection=PROJECAO,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def obter_ativa(self, disciplina_id):
+        return await self.collection.find_one(self._filtro({"disciplina_id": disciplina_id, "ativa": True}), PROJECAO)
+
+    async def listar_ativas(self, disciplina_ids):
+        return await self.collection.find(
+            self._filtro({"ativa": True, "disciplina_id": {"$in": disciplina_ids}}), PROJECAO
+        ).to_list(len(disciplina_ids) or 1)
+
+    async def registrar_sinal(self, disciplina_id, em):
+        # $max keeps a delayed heartbeat from moving visto_em backwards
+        return await self.collection.find_one_and_update(
+            self._filtro({"disciplina_id": disciplina_id, "ativa": True}),
+            {"$max": {"visto_em": em}},
+            projection=PROJECAO,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _historico_bruto(self, disciplina_id, apos, limite, batch_size):
+        filtro = self._filtro({"disciplina_id": disciplina_id})
+        if apos:
+            filtro["$or"] = [
+                {"inicio": {"$lt": apos["inicio"]}},
+                {"inicio": apos["inicio"], "id": {"$lt": apos["id"]}},
+            ]
+        consulta = self.collection.find(filtro, PROJECAO).sort([("inicio", -1), ("id", -1)])
+        if limite:
+            consulta = consulta.limit(limite)
+        async for sessao in consulta.batch_size(min(batch_size, limite or batch_size)):
+            yield sessao
+
+    async def _buckets_decrescentes(self, disciplina_id, ate):
+        filtro = self._filtro({"disciplina_id": disciplina_id})
+        if ate:
+            filtro["mes"] = {"$lte": ate}
+        # Small batches: a history page usually needs only the most recent bucket or two
+        async for bucket in self.compactadas.find(filtro, PROJECAO).sort("mes", -1).batch_size(2):
+            yield bucket
+
+    async def totais_por_dia(self, de=None, ate=None):
+        pipeline = pipeline_sessoes_por_dia(self._filtro(intervalo_inicio(de, ate)))
+        return await self.collection.aggregate(pipeline).to_list(None)
+
+    async def existe_concluida(self):
+        return bool(await self.collection.count_documents(self._filtro({"ativa": False}), limit=1)) or \
+            bool(await self.compactadas.count_documents(self._filtro(), limit=1))
+
+    async def colunas_concluidas(self, de, ate):
+        # Raw sessions come from usuario_ativa_inicio, buckets pruned by month; only three fields leave the server
+        pipeline = pipeline_concluidas(self._filtro({"inicio": {"$gte": de, "$lte": ate}})) + [
+            {"$project": {"_id": 0, "disciplina_id": 1, "inicio": 1, "duracao_segundos": 1}}
+        ]
+        sessoes = await self.collection.aggregate(pipeline, batchSize=10000).to_list(None)
+        return {
+            campo: [sessao.get(campo) for sessao in sessoes]
+            for campo in ("disciplina_id", "inicio", "duracao_segundos")
+        }
+
+    async def aplicar_lote(self, novas, encerradas):
+        operacoes = [InsertOne(self._documento(sessao)) for sessao in novas] + [
+            UpdateOne(
+                self._filtro({"id": sessao["id"], "ativa": True}),
+                {"$set": {"fim": sessao["fim"], "ativa": False, "duracao_segundos": sessao["duracao_segundos"]}}
+            )
+            for sessao in encerradas
+        ]
+        if not operacoes:
+            return []
+        conflitos = []
+        try:
+            result = await self.collection.bulk_write(operacoes, ordered=False)
+            encerradas_gravadas = result.modified_count
+        except BulkWriteError as e:
+            # Only usuario_sessao_ativa_unica can reject an insert: another client started that timer first
+            if any(erro["code"] != 11000 for erro in e.details["writeErrors"]):
+                raise
+            conflitos = [novas[erro["index"]]["id"] for erro in e.details["writeErrors"]]
+            encerradas_gravadas = e.details["nModified"]
+        if encerradas_gravadas < len(encerradas):
+            # bulk_write only reports totals; the sessions someone else closed carry a different fim
+            fins = {sessao["id"]: sessao["fim"] for sessao in encerradas}
+            async for sessao in self.collection.find(self._filtro({"id": {"$in": list(fins)}}), {"_id": 0, "id": 1, "fim": 1}):
+                if sessao.get("fim") != fins[sessao["id"]]:
+                    conflitos.append(sessao["id"])
+        return conflitos
+
+    async def compactar(self, antes, lote=LOTE_COMPACTACAO):
+        compactadas, buckets = 0, set()
+        # Runs overlap (the periodic task in every worker, the admin endpoint): each batch is claimed
+        # first, and a run only folds in the sessions its own claim won
+        execucao = uuid.uuid4().hex
+        while True:
+            agora = datetime.utcnow()
+            # Oldest first through usuario_ativa_inicio; unparseable string starts stay in the raw tier.
+            # A claim left by a run that died is taken over once it expires
+            filtro = self._filtro({
+                "ativa": False,
+                "inicio": {"$lt": antes, "$type": "date"},
+                "$or": [{"compactando": {"$exists": False}}, {"compactando_em": {"$lt": agora - PRAZO_COMPACTACAO}}],
+            })
+            candidatas = [
+                documento["_id"]
+                for documento in await self.collection.find(filtro, {"_id": 1}).sort("inicio", 1).limit(lote).to_list(None)
+            ]
+            if not candidatas:
+                break
+            # The filter is re-checked per document, so each session is claimed by exactly one run
+            await self.collection.update_many(
+                {"_id": {"$in": candidatas}, **filtro},
+                {"$set": {"compactando": execucao, "compactando_em": agora}}
+            )
+            sessoes = await self.collection.find(
+                {"_id": {"$in": candidatas}, "compactando": execucao},
+                {"_id": 0, "id": 1, "disciplina_id": 1, "inicio": 1, "duracao_segundos": 1}
+            ).to_list(None)
+            # Without a transaction a run can stop between the two writes below; the sessions it
+            # had already folded in are then only deleted, never appended twice
+            ja_compactadas = await self._ids_compactados(sessoes)
+            grupos = agrupar_em_buckets([sessao for sessao in sessoes if sessao["id"] not in ja_compactadas])
+            if grupos:
+                await self.compactadas.bulk_write(
+                    [
+                        UpdateOne(
+                            self._filtro({"disciplina_id": disciplina_id, "mes": mes}),
+                            {
+                                "$push": {campo: {"$each": valores} for campo, valores in arrays.items()},
+                                "$inc": {"total_segundos": sum(arrays["duracoes"]), "sessoes": len(arrays["ids"])},
+                            },
+                            upsert=True
+                        )
+                        for (disciplina_id, mes), arrays in grupos.items()
+                    ],
+                    ordered=False
+                )
+            await self.collection.delete_many(
+                self._filtro({"id": {"$in": [sessao["id"] for sessao in sessoes]}, "compactando": execucao})
+            )
+            compactadas += len(sessoes)
+            buckets.update(grupos)
+            if len(candidatas) < lote:
+                break
+        return {"sessoes": compactadas, "buckets": len(buckets)}
+
+
+class MongoDesempenhoRepository(MongoRepositorio, DesempenhoRepository):
+    async def listar(self):
+        return await self.collection.find(self._filtro(), PROJECAO).sort("semana_inicio", -1).to_list(1000)
+
+    async def listar_intervalo(self, de, ate):
+        return await self.collection.find(
+            self._filtro({"semana_inicio": {"$gte": de, "$lte": ate}}), PROJECAO
+        ).sort("semana_inicio", 1).to_list(None)
+
+    async def contagens(self, dias, de=None, ate=None, antes=None, limite=52):
+        intervalo = {}
+        if de:
+            intervalo["$gte"] = de
+        if ate:
+            intervalo["$lte"] = ate
+        if antes:
+            intervalo["$lt"] = antes
+        pipeline = [
+            {"$match": self._filtro({"semana_inicio": intervalo} if intervalo else {})},
+            {"$sort": {"semana_inicio": -1}},
+            {"$limit": limite},
+            # Only the counts leave the server, never the tasks themselves
+            {
+                "$project": {
+                    "_id": 0,
+                    "semana_inicio": 1,
+                    "dias": {
+                        dia: {
+                            "total": {"$size": {"$ifNull": [f"${dia}", []]}},
+                            "concluidas": {
+                                "$size": {
+                                    "$filter": {
+                                        "input": {"$ifNull": [f"${dia}", []]},
+                                        "cond": {"$eq": ["$$this.concluida", True]}
+                                    }
+                                }
+                            }
+                        }
+                        for dia in dias
+                    }
+                }
+            }
+        ]
+        return await self.collection.aggregate(pipeline).to_list(None)
+
+    async def obter_semana(self, semana_inicio):
+        return await self.collection.find_one(self._filtro({"semana_inicio": semana_inicio}), PROJECAO)
+
+    async def obter_semanas(self, semanas):
+        return await self.collection.find(
+            self._filtro({"semana_inicio": {"$in": semanas}}), PROJECAO
+        ).sort("semana_inicio", 1).to_list(len(semanas) or 1)
+
+    async def salvar_semana(self, documento):
+        # Identity fields are only written when the week is first created
+        na_criacao = {k: documento[k] for k in ("id", "criado_em") if k in documento}
+        await self.collection.update_one(
+            self._filtro({"semana_inicio": documento["semana_inicio"]}),
+            {
+                "$set": {k: v for k, v in documento.items() if k not in na_criacao and k not in ("versao", "usuario_id")},
+                "$setOnInsert": na_criacao,
+                "$inc": {"versao": 1}
+            },
+            upsert=True
+        )
+
+    async def adicionar_tarefa(self, semana_inicio, dia, tarefa, semana_nova):
+        # Every other field of a brand-new week is only written on insert
+        na_criacao = {k: v for k, v in semana_nova.items() if k not in (dia, "semana_inicio", "versao", "usuario_id")}
+        await self.collection.update_one(
+            self._filtro({"semana_inicio": semana_inicio}),
+            {"$push": {dia: tarefa}, "$setOnInsert": na_criacao, "$inc": {"versao": 1}},
+            upsert=True
+        )
+
+    async def atualizar_tarefa(self, semana_inicio, dia, tarefa_id, campos):
+        desempenho = await self.collection.find_one_and_update(
+            self._filtro({"semana_inicio": semana_inicio, f"{dia}.id": tarefa_id}),
+            {"$set": {f"{dia}.$[tarefa].{campo}": valor for campo, valor in campos.items()}, "$inc": {"versao": 1}},
+            array_filters=[{"tarefa.id": tarefa_id}],
+            projection={"_id": 0, dia: {"$elemMatch": {"id": tarefa_id}}},
+            return_document=ReturnDocument.AFTER
+        )
+        return desempenho[dia][0] if desempenho else None
+
+    async def remover_tarefa(self, semana_inicio, dia, tarefa_id):
+        result = await self.collection.update_one(
+            self._filtro({"semana_inicio": semana_inicio, f"{dia}.id": tarefa_id}),
+            {"$pull": {dia: {"id": tarefa_id}}, "$inc": {"versao": 1}}
+        )
+        return result.modified_count > 0
+
+    async def marcar_tarefas(self, alteracoes):
+        if alteracoes:
+            await self.collection.bulk_write(
+                [
+                    UpdateOne(
+                        self._filtro({"semana_inicio": semana_inicio, f"{dia}.id": tarefa_id}),
+                        {"$set": {f"{dia}.$[tarefa].concluida": concluida}, "$inc": {"versao": 1}},
+                        array_filters=[{"tarefa.id": tarefa_id}]
+                    )
+                    for semana_inicio, dia, tarefa_id, concluida in alteracoes
+                ],
+                ordered=False
+            )
+
+
+class MongoStatusCheckRepository(MongoRepositorio, StatusCheckRepository):
+    async def inserir(self, documento):
+        await self.collection.insert_one(dict(documento))
+
+    async def listar(self):
+        return await self.collection.find({}, {"_id": 0}).to_list(1000)
+
+
+class MongoRollupRepository(RollupRepository):
+    def __init__(self, db, usuario_id: str):
+        self.collection = db[self.colecao]
+        self.sessoes = db["sessoes_estudo"]
+        self.marcadores = db["marcadores"]
+        self.usuario_id = usuario_id
+        self.marcador = f"{self.colecao}:{usuario_id}"
+
+    async def incrementar(self, disciplina_id, dia, segundos):
+        await self.collection.update_one(
+            {"usuario_id": self.usuario_id, "disciplina_id": disciplina_id, "dia": dia},
+            {"$inc": {"total_segundos": segundos, "sessoes": 1}},
+            upsert=True
+        )
+        await avancar_marcador(self.marcadores, self.marcador)
+
+    async def incrementar_muitos(self, incrementos):
+        if not incrementos:
+            return
+        await self.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"usuario_id": self.usuario_id, "disciplina_id": incremento["disciplina_id"], "dia": incremento["dia"]},
+                    {"$inc": {"total_segundos": incremento["total_segundos"], "sessoes": incremento["sessoes"]}},
+                    upsert=True
+                )
+                for incremento in incrementos
+            ],
+            ordered=False
+        )
+        await avancar_marcador(self.marcadores, self.marcador)
+
+    async def somar_por_disciplina(self, de, ate):
+        pipeline = [
+            {"$match": {"usuario_id": self.usuario_id, "dia": {"$gte": de, "$lte": ate}}},
+            {"$group": {"_id": "$disciplina_id", "total_segundos": {"$sum": "$total_segundos"}}},
+            {"$project": {"_id": 0, "disciplina_id": "$_id", "total_segundos": 1}}
+        ]
+        return await self.collection.aggregate(pipeline).to_list(1000)
+
+    async def listar(self, de, ate):
+        return await self.collection.find(
+            {"usuario_id": self.usuario_id, "dia": {"$gte": de, "$lte": ate}}, PROJECAO
+        ).to_list(None)
+
+    async def reconstruir(self):
+        # Every day the sessions still back is replaced by the $merge, dropping the mark; the rest are phantoms
+        execucao = uuid.uuid4().hex
+        await self.collection.update_many({"usuario_id": self.usuario_id}, {"$set": {"reconstrucao": execucao}})
+        await self.sessoes.aggregate(pipeline_reconstruir_rollups({"usuario_id": self.usuario_id})).to_list(None)
+        await self.collection.delete_many({"usuario_id": self.usuario_id, "reconstrucao": execucao})
+        await avancar_marcador(self.marcadores, self.marcador)
+        return await self.contar()
+
+    async def contar(self):
+        return await self.collection.count_documents({"usuario_id": self.usuario_id})
+
+    async def versao(self):
+        # The user's marker plus the global one advanced by preencher_rollups
+        marcadores = self.marcadores.find({"_id": {"$in": [self.marcador, self.colecao]}})
+        return sum([marcador["versao"] async for marcador in marcadores])
+
+
+class MongoSyncRepository(SyncRepository):
+    def __init__(self, db, usuario_id: str):
+        self.collection = db[self.colecao]
+        self.usuario_id = usuario_id
+
+    async def reservar(self, chaves):
+        if not chaves:
+            return []
+        # registrado_em drives the TTL index that forgets keys after SYNC_RETENCAO
+        agora = datetime.utcnow()
+        try:
+            await self.collection.insert_many(
+                [{"usuario_id": self.usuario_id, "chave": chave, "registrado_em": agora, "resultado": None}
+                 for chave in chaves],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            if any(erro["code"] != 11000 for erro in e.details["writeErrors"]):
+                raise
+            repetidas = {erro["index"] for erro in e.details["writeErrors"]}
+            return [chave for i, chave in enumerate(chaves) if i not in repetidas]
+        return list(chaves)
+
+    async def resultados(self, chaves):
+        eventos = self.collection.find(
+            {"usuario_id": self.usuario_id, "chave": {"$in": chaves}}, {"_id": 0, "chave": 1, "resultado": 1}
+        )
+        return {evento["chave"]: evento.get("resultado") async for evento in eventos}
+
+    async def concluir(self, resultados):
+        if resultados:
+            await self.collection.bulk_write(
+                [
+                    UpdateOne({"usuario_id": self.usuario_id, "chave": resultado["chave"]},
+                              {"$set": {"resultado": resultado}})
+                    for resultado in resultados
+                ],
+                ordered=False
+            )
+
+    async def liberar(self, chaves):
+        if chaves:
+            await self.collection.delete_many({"usuario_id": self.usuario_id, "chave": {"$in": chaves}})
+
+
+class MongoStorage(Storage):
+    nome = "mongo"
+
+    def __init__(self, mongo_url: str, db_name: str, **client_options):
+        self.client = AsyncIOMotorClient(mongo_url, **client_options)
+        self.db = self.client[db_name]
+        self.status_checks = MongoStatusCheckRepository(self.db)
+
+    def do_usuario(self, usuario_id):
+        return DadosUsuario(
+            usuario_id,
+            MongoDisciplinaRepository(self.db, usuario_id),
+            MongoSessaoRepository(self.db, usuario_id),
+            MongoDesempenhoRepository(self.db, usuario_id),
+            MongoRollupRepository(self.db, usuario_id),
+            MongoSyncRepository(self.db, usuario_id),
+        )
+
+    async def _migrar_usuario_padrao(self):
+        """Atribuir ao USUARIO_PADRAO os documentos gravados antes da partição por usuário (uma única vez)"""
+        if await self.db.marcadores.find_one({"_id": MIGRACAO_USUARIO_ID}):
+            return
+        for colecao in COLECOES_DO_USUARIO:
+            resultado = await self.db[colecao].update_many(
+                {"usuario_id": {"$exists": False}}, {"$set": {"usuario_id": USUARIO_PADRAO}}
+            )
+            if resultado.modified_count:
+                print(f"Assigned {resultado.modified_count} {colecao} documents to user {USUARIO_PADRAO}")
+            # The old single-field unique indexes would block other users' data (e.g. nome_unico)
+            existentes = await self.db[colecao].index_information()
+            for nome in INDICES_LEGADOS[colecao]:
+                if nome in existentes:
+                    await self.db[colecao].drop_index(nome)
+        await self.db.marcadores.update_one(
+            {"_id": MIGRACAO_USUARIO_ID}, {"$currentDate": {"atualizado_em": True}}, upsert=True
+        )
+
+    async def _migrar_inicio_data(self, batch_size: int = 1000):
+        """Converter em datas os inicio gravados como texto ISO (uma única vez)
+
+        BSON orders every string before every date, so the history keyset (inicio < cursor) and the
+        sort by inicio would skip or misplace these sessions.
+        """
+        if await self.db.marcadores.find_one({"_id": MIGRACAO_INICIO_DATA}):
+            return
+        sessoes = self.db.sessoes_estudo
+        operacoes, convertidas = [], 0
+        async for sessao in sessoes.find({"inicio": {"$type": "string"}}, {"_id": 1, "inicio": 1, "id": 1}):
+            # Parsed the way posicao_sessao reads it; a value that is not ISO at all is left as it was
+            try:
+                inicio = posicao_sessao(sessao)[0]
+            except ValueError:
+                continue
+            operacoes.append(UpdateOne({"_id": sessao["_id"], "inicio": sessao["inicio"]}, {"$set": {"inicio": inicio}}))
+            if len(operacoes) >= batch_size:
+                convertidas += (await sessoes.bulk_write(operacoes, ordered=False)).modified_count
+                operacoes = []
+        if operacoes:
+            convertidas += (await sessoes.bulk_write(operacoes, ordered=False)).modified_count
+        if convertidas:
+            print(f"Converted {convertidas} sessoes_estudo inicio values from text to dates")
+        await self.db.marcadores.update_one(
+            {"_id": MIGRACAO_INICIO_DATA}, {"$currentDate": {"atualizado_em": True}}, upsert=True
+        )
+
+    async def inicializar(self):
+        await self._migrar_usuario_padrao()
+        await self._migrar_inicio_data()
+        for collection_name, indexes in INDEX_MANIFEST.items():
+            try:
+                await self.db[collection_name].create_indexes(indexes)
+            except OperationFailure as e:
+                # e.g. legacy duplicate active sessions; the API still works, just unprotected
+                print(f"Could not create indexes on {collection_name}: {e}")
+
+    async def preencher_rollups(self):
+        rollups = self.db["study_rollups"]
+        if await rollups.estimated_document_count() or (
+                not await self.db.sessoes_estudo.count_documents({"ativa": False}, limit=1)
+                and not await self.db.sessoes_compactadas.estimated_document_count()):
+            return 0
+        await self.db.sessoes_estudo.aggregate(pipeline_reconstruir_rollups({})).to_list(None)
+        await avancar_marcador(self.db.marcadores, "study_rollups")
+        return await rollups.estimated_document_count()
+
+    async def usuarios_com_sessoes(self):
+        return await self.db.sessoes_estudo.distinct("usuario_id")
+
+    async def encerrar_abandonadas(self, sinal_ate, sem_sinal_ate, usuario_id=None):
+        sessoes = self.db.sessoes_estudo
+        filtro = filtro_abandonadas(sinal_ate, sem_sinal_ate, usuario_id)
+        # Across users (or one): the partial index holds only active sessions, so this reads the small active set
+        ids = [
+            documento["_id"]
+            async for documento in sessoes.find(filtro, {"_id": 1}).hint("usuario_sessao_ativa_unica")
+        ]
+        if not ids:
+            return {}
+        # One update for all of them; the filter is re-checked, so a session stopped or heartbeating
+        # meanwhile is left alone, and the run id tells this run's sessions from another worker's
+        execucao = uuid.uuid4().hex
+        await sessoes.update_many({"_id": {"$in": ids}, **filtro}, pipeline_encerrar_abandonadas(execucao))
+        encerradas: Dict[str, List[Dict[str, Any]]] = {}
+        async for sessao in sessoes.find({"_id": {"$in": ids}, "encerramento_automatico": execucao}, PROJECAO):
+            encerradas.setdefault(sessao["usuario_id"], []).append(sessao)
+        return encerradas
+
+    async def _estatisticas_colecao(self, nome: str) -> Dict[str, int]:
+        try:
+            stats = await self.db.command("collStats", nome)
+        except OperationFailure:
+            # Not created yet
+            return {"documentos": 0, "bytes": 0}
+        return {"documentos": stats.get("count", 0), "bytes": stats.get("size", 0) + stats.get("totalIndexSize", 0)}
+
+    async def relatorio_compactacao(self):
+        brutas, compactadas = await asyncio.gather(
+            self._estatisticas_colecao("sessoes_estudo"), self._estatisticas_colecao("sessoes_compactadas")
+        )
+        soma = await self.db.sessoes_compactadas.aggregate(
+            [{"$group": {"_id": None, "sessoes": {"$sum": "$sessoes"}}}]
+        ).to_list(None)
+        compactadas["sessoes"] = soma[0]["sessoes"] if soma else 0
+        return resumo_camadas(brutas, compactadas)
+
+    def consultas_canonicas(self):
+        """Consultas representativas checadas com explain(); nenhuma pode cair em COLLSCAN"""
+        agora = datetime.utcnow()
+        db = self.db
+        return [
+            ("disciplinas.find_one(usuario_id, id)", db.disciplinas.find({"usuario_id": "", "id": ""}).limit(1)),
+            ("sessoes_estudo.find_one(usuario_id, disciplina_id, ativa)",
+             db.sessoes_estudo.find({"usuario_id": "", "disciplina_id": "", "ativa": True}).limit(1)),
+            ("sessoes_estudo.find(usuario_id, ativa, disciplina_id $in)",
+             db.sessoes_estudo.find({"usuario_id": "", "ativa": True, "disciplina_id": {"$in": [""]}})),
+            ("sessoes_estudo.find(usuario_id, disciplina_id).sort(inicio, id)",
+             db.sessoes_estudo.find({"usuario_id": "", "disciplina_id": ""}).sort([("inicio", -1), ("id", -1)])),
+            ("sessoes_estudo.aggregate(sessoes_por_dia)",
+             ("sessoes_estudo", [{"$match": {"usuario_id": "", "ativa": False, "inicio": {"$gte": agora, "$lte": agora}}}])),
+            ("study_rollups.aggregate(resumo_periodo)",
+             ("study_rollups", [{"$match": {"usuario_id": "", "dia": {"$gte": "", "$lte": ""}}}])),
+            ("desempenho_semanal.find_one(usuario_id, semana_inicio)",
+             db.desempenho_semanal.find({"usuario_id": "", "semana_inicio": ""}).limit(1)),
+            ("sync_eventos.find(usuario_id, chave $in)",
+             db.sync_eventos.find({"usuario_id": "", "chave": {"$in": [""]}})),
+            ("sessoes_compactadas.find(usuario_id, disciplina_id, mes).sort(mes)",
+             db.sessoes_compactadas.find({"usuario_id": "", "disciplina_id": "", "mes": {"$lte": agora}}).sort("mes", -1)),
+            ("sessoes_estudo.find(abandonadas)",
+             db.sessoes_estudo.find(filtro_abandonadas(agora, agora), {"_id": 1}).hint("usuario_sessao_ativa_unica")),
+        ]
+
+    async def explicar_comando(self, comando: Dict[str, Any]) -> Dict[str, Any]:
+        """explain() de um comando já enviado ao servidor (find, aggregate, update...)"""
+        return await self.db.command({"explain": comando, "verbosity": "queryPlanner"})
+
+    async def _indices_ausentes(self) -> List[str]:
+        existentes = await asyncio.gather(*(self.db[nome].index_information() for nome in INDEX_MANIFEST))
+        return [
+            f"{collection_name}.{index.document['name']}"
+            for (collection_name, indexes), indices in zip(INDEX_MANIFEST.items(), existentes)
+            for index in indexes
+            if index.document["name"] not in indices
+        ]
+
+    async def verificar_prontidao(self):
+        try:
+            await self.client.admin.command("ping")
+            ausentes = await self._indices_ausentes()
+        except PyMongoError as e:
+            return {"ok": False, "erro": str(e)}
+        return {"ok": not ausentes, "indices_ausentes": ausentes}
+
+    async def verificar_indices(self):
+        """Comparar os índices existentes com o manifesto e explicar as consultas canônicas"""
+        ausentes = await self._indices_ausentes()
+        nao_utilizados = []
+        for collection_name in INDEX_MANIFEST:
+            # $indexStats counts accesses since the last mongod restart
+            async for stats in self.db[collection_name].aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats.get("accesses", {}).get("ops", 0) == 0:
+                    nao_utilizados.append(f"{collection_name}.{stats['name']}")
+
+        planos = {}
+        for nome, consulta in self.consultas_canonicas():
+            if isinstance(consulta, tuple):
+                collection_name, pipeline = consulta
+                explain = await self.db.command("aggregate", collection_name, pipeline=pipeline, explain=True)
+            else:
+                explain = await consulta.explain()
+            estagios = estagios_do_plano(explain)
+            planos[nome] = {"estagios": estagios, "collscan": "COLLSCAN" in estagios}
+
+        incompativeis = indices_incompativeis_com_shard()
+        return {
+            "backend": self.nome,
+            "ausentes": ausentes,
+            "nao_utilizados": nao_utilizados,
+            "planos": planos,
+            "shard_keys": SHARD_KEYS,
+            "incompativeis_com_shard": incompativeis,
+            "ok": not ausentes and not incompativeis and not any(p["collscan"] for p in planos.values()),
+        }
+
+    async def descartar(self):
+        await self.client.drop_database(self.db.name)
+
+    def fechar(self):
+        self.client.close()
+
+
+# Embedded SQLite backend. Documents are kept as JSON next to the columns that
+# are filtered or sorted on; calls run inline on the event loop, which keeps each
+# operation atomic with respect to other requests and reads sub-millisecond.
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return {"$date": obj.isoformat()}
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_hook(obj):
+    if len(obj) == 1 and "$date" in obj:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+def _dumps(documento: Dict[str, Any]) -> str:
+    return json.dumps(documento, default=_json_default)
+
+
+def _loads(texto: str) -> Dict[str, Any]:
+    return json.loads(texto, object_hook=_json_hook)
+
+
+def _ts(valor: datetime) -> str:
+    """Timestamp com largura fixa, para que a ordem textual seja a cronológica"""
+    return valor.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS disciplinas (
+    usuario_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (usuario_id, id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS usuario_nome_unico ON disciplinas (usuario_id, json_extract(doc, '$.nome'));
+CREATE TABLE IF NOT EXISTS sessoes_estudo (
+    usuario_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    disciplina_id TEXT NOT NULL,
+    inicio TEXT NOT NULL,
+    ativa INTEGER NOT NULL,
+    duracao_segundos INTEGER,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (usuario_id, id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS usuario_sessao_ativa_unica ON sessoes_estudo (usuario_id, disciplina_id) WHERE ativa = 1;
+CREATE INDEX IF NOT EXISTS usuario_ativa_inicio ON sessoes_estudo (usuario_id, ativa, inicio);
+CREATE INDEX IF NOT EXISTS usuario_disciplina_inicio_id ON sessoes_estudo (usuario_id, disciplina_id, inicio DESC, id DESC);
+CREATE TABLE IF NOT EXISTS desempenho_semanal (
+    usuario_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    semana_inicio TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    PRIMARY KEY (usuario_id, id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS usuario_semana_inicio_unica ON desempenho_semanal (usuario_id, semana_inicio);
+CREATE TABLE IF NOT EXISTS status_checks (
+    id TEXT PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS study_rollups (
+    usuario_id TEXT NOT NULL,
+    disciplina_id TEXT NOT NULL,
+    dia TEXT NOT NULL,
+    total_segundos INTEGER NOT NULL DEFAULT 0,
+    sessoes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (usuario_id, disciplina_id, dia)
+);
+CREATE INDEX IF NOT EXISTS usuario_dia_disciplina ON study_rollups (usuario_id, dia, disciplina_id);
+CREATE TABLE IF NOT EXISTS marcadores (
+    nome TEXT PRIMARY KEY,
+    versao INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_eventos (
+    usuario_id TEXT NOT NULL,
+    chave TEXT NOT NULL,
+    registrado_em TEXT NOT NULL,
+    resultado TEXT,
+    PRIMARY KEY (usuario_id, chave)
+);
+CREATE INDEX IF NOT EXISTS usuario_registrado_em ON sync_eventos (usuario_id, registrado_em);
+CREATE TABLE IF NOT EXISTS sessoes_compactadas (
+    usuario_id TEXT NOT NULL,
+    disciplina_id TEXT NOT NULL,
+    mes TEXT NOT NULL,
+    ids TEXT NOT NULL,
+    inicios TEXT NOT NULL,
+    duracoes TEXT NOT NULL,
+    total_segundos INTEGER NOT NULL,
+    sessoes INTEGER NOT NULL,
+    PRIMARY KEY (usuario_id, disciplina_id, mes)
+);
+CREATE VIEW IF NOT EXISTS sessoes_concluidas AS
+    SELECT usuario_id, disciplina_id, inicio, duracao_segundos FROM sessoes_estudo WHERE ativa = 0
+    UNION ALL
+    SELECT c.usuario_id, c.disciplina_id,
+           strftime('%Y-%m-%dT%H:%M:%f', c.mes, '+' || i.value || ' seconds') || '000',
+           json_extract(c.duracoes, '$[' || i.key || ']')
+    FROM sessoes_compactadas c, json_each(c.inicios) i;
+"""
+
+SQLITE_INDICES = [
+    "usuario_nome_unico", "usuario_sessao_ativa_unica", "usuario_ativa_inicio", "usuario_disciplina_inicio_id",
+    "usuario_semana_inicio_unica", "usuario_dia_disciplina", "usuario_registrado_em",
+]
+
+# Columns of the tables created before the partition by user, copied over by the migration
+SQLITE_COLUNAS_LEGADAS = {
+    "disciplinas": "id, doc",
+    "sessoes_estudo": "id, disciplina_id, inicio, ativa, duracao_segundos, doc",
+    "desempenho_semanal": "id, semana_inicio, doc",
+    "study_rollups": "disciplina_id, dia, total_segundos, sessoes",
+}
+
+# The user's completed sessions started between two timestamps, from both tiers. Buckets are pruned by
+# month before json_each expands them, which the view cannot do
+SQL_CONCLUIDAS_DO_USUARIO = """
+    SELECT disciplina_id, inicio, duracao_segundos FROM sessoes_estudo
+    WHERE usuario_id = ? AND ativa = 0 AND inicio BETWEEN ? AND ?
+    UNION ALL
+    SELECT disciplina_id, inicio, duracao_segundos FROM (
+        SELECT c.disciplina_id,
+               strftime('%Y-%m-%dT%H:%M:%f', c.mes, '+' || i.value || ' seconds') || '000' AS inicio,
+               json_extract(c.duracoes, '$[' || i.key || ']') AS duracao_segundos
+        FROM sessoes_compactadas c, json_each(c.inicios) i
+        WHERE c.usuario_id = ? AND c.mes BETWEEN ? AND ?
+    ) WHERE inicio BETWEEN ? AND ?
+"""
+
+SQL_RECONSTRUIR_ROLLUPS = """
+    INSERT INTO study_rollups (usuario_id, disciplina_id, dia, total_segundos, sessoes)
+    SELECT usuario_id, disciplina_id, substr(inicio, 1, 10), COALESCE(SUM(duracao_segundos), 0), COUNT(*)
+    FROM sessoes_concluidas {filtro} GROUP BY usuario_id, disciplina_id, substr(inicio, 1, 10)
+    ON CONFLICT(usuario_id, disciplina_id, dia) DO UPDATE SET
+        total_segundos = excluded.total_segundos,
+        sessoes = excluded.sessoes
+"""
+
+
+def _avancar_marcador(conn: sqlite3.Connection, nome: str):
+    conn.execute(
+        "INSERT INTO marcadores (nome, versao) VALUES (?, 1) ON CONFLICT(nome) DO UPDATE SET versao = versao + 1",
+        (nome,)
+    )
+
+
+class SQLiteRepositorio(Repositorio):
+    def __init__(self, conn: sqlite3.Connection, usuario_id: Optional[str] = None):
+        self.conn = conn
+        self.usuario_id = usuario_id
+
+    def colunas(self, documento: Dict[str, Any]) -> Dict[str, Any]:
+        """Colunas indexadas extraídas do documento, além de usuario_id, id e doc"""
+        return {}
+
+    @property
+    def _chave(self) -> List[str]:
+        return ["id"] if self.usuario_id is None else ["usuario_id", "id"]
+
+    def _linha(self, documento: Dict[str, Any]) -> Dict[str, Any]:
+        usuario = {} if self.usuario_id is None else {"usuario_id": self.usuario_id}
+        return {**usuario, "id": documento["id"], **self.colunas(documento), "doc": _dumps(documento)}
+
+    def _gravar(self, documentos: List[Dict[str, Any]], upsert: bool = True):
+        if not documentos:
+            return
+        linhas = [self._linha(documento) for documento in documentos]
+        nomes = list(linhas[0])
+        sql = f"INSERT INTO {self.colecao} ({', '.join(nomes)}) VALUES ({', '.join('?' * len(nomes))})"
+        if upsert:
+            sql += f" ON CONFLICT({', '.join(self._chave)}) DO UPDATE SET " + ", ".join(
+                f"{n} = excluded.{n}" for n in nomes if n not in self._chave
+            )
+        with self.conn:
+            self.conn.executemany(sql, [tuple(linha.values()) for linha in linhas])
+
+    def _buscar(self, sql: str, parametros=()) -> List[Dict[str, Any]]:
+        return [_loads(linha[0]) for linha in self.conn.execute(sql, parametros)]
+
+    async def iterar(self, batch_size: int = 1000):
+        if self.usuario_id is None:
+            cursor = self.conn.execute(f"SELECT doc FROM {self.colecao} ORDER BY rowid")
+        else:
+            cursor = self.conn.execute(f"SELECT doc FROM {self.colecao} WHERE usuario_id = ? ORDER BY rowid",
+                                       (self.usuario_id,))
+        while True:
+            linhas = cursor.fetchmany(batch_size)
+            if not linhas:
+                break
+            for linha in linhas:
+                yield _loads(linha[0])
+
+    async def upsert_muitos(self, documentos):
+        try:
+            self._gravar(documentos)
+        except sqlite3.IntegrityError as e:
+            # The batch runs in one transaction, so none of it was written
+            raise DocumentosRecusados(f"{len(documentos)} recusados: {e}") from e
+
+
+class SQLiteDisciplinaRepository(SQLiteRepositorio, DisciplinaRepository):
+    async def semear(self, documentos):
+        antes = self.conn.total_changes
+        with self.conn:
+            # Names the user already has hit usuario_nome_unico and are skipped
+            self.conn.executemany(
+                "INSERT INTO disciplinas (usuario_id, id, doc) VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+                [(self.usuario_id, documento["id"], _dumps(documento)) for documento in documentos]
+            )
+        return self.conn.total_changes - antes
+
+    async def listar(self):
+        return self._buscar("SELECT doc FROM disciplinas WHERE usuario_id = ? ORDER BY rowid", (self.usuario_id,))
+
+    async def obter(self, disciplina_id):
+        documentos = self._buscar(
+            "SELECT doc FROM disciplinas WHERE usuario_id = ? AND id = ?", (self.usuario_id, disciplina_id)
+        )
+        return documentos[0] if documentos else None
+
+    async def atualizar(self, disciplina_id, campos):
+        disciplina = await self.obter(disciplina_id)
+        if not disciplina:
+            return None
+        if campos:
+            disciplina.update(campos)
+            self._gravar([disciplina])
+        return disciplina
+
+    async def atualizar_muitos(self, alteracoes):
+        if not alteracoes:
+            return {}
+        marcadores = ", ".join("?" * len(alteracoes))
+        disciplinas = {
+            disciplina["id"]: disciplina
+            for disciplina in self._buscar(
+                f"SELECT doc FROM disciplinas WHERE usuario_id = ? AND id IN ({marcadores})",
+                (self.usuario_id, *alteracoes)
+            )
+        }
+        alteradas = []
+        for disciplina_id, disciplina in disciplinas.items():
+            if alteracoes[disciplina_id]:
+                disciplina.update(alteracoes[disciplina_id])
+                alteradas.append(disciplina)
+        self._gravar(alteradas)
+        return disciplinas
+
+
+class SQLiteSessaoRepository(SQLiteRepositorio, SessaoRepository):
+    def colunas(self, documento):
+        return {
+            "disciplina_id": documento["disciplina_id"],
+            "inicio": _ts(documento["inicio"]),
+            "ativa": 1 if documento.get("ativa") else 0,
+            "duracao_segundos": documento.get("duracao_segundos"),
+        }
+
+    async def inserir_ativa(self, documento):
+        try:
+            self._gravar([documento], upsert=False)
+        except sqlite3.IntegrityError:
+            raise SessaoAtivaExistente(documento["disciplina_id"])
+
+    async def encerrar_ativa(self, disciplina_id):
+        sessao = await self.obter_ativa(disciplina_id)
+        if not sessao:
+            return None
+        fim = datetime.utcnow()
+        sessao.update({
+            "fim": fim,
+            "ativa": False,
+            "duracao_segundos": int((fim - sessao["inicio"]).total_seconds()),
+        })
+        self._gravar([sessao])
+        return sessao
+
+    async def obter_ativa(self, disciplina_id):
+        documentos = self._buscar(
+            "SELECT doc FROM sessoes_estudo WHERE usuario_id = ? AND disciplina_id = ? AND ativa = 1",
+            (self.usuario_id, disciplina_id)
+        )
+        return documentos[0] if documentos else None
+
+    async def listar_ativas(self, disciplina_ids):
+        if not disciplina_ids:
+            return []
+        marcadores = ", ".join("?" * len(disciplina_ids))
+        return self._buscar(
+            f"SELECT doc FROM sessoes_estudo WHERE usuario_id = ? AND ativa = 1 AND disciplina_id IN ({marcadores})",
+            (self.usuario_id, *disciplina_ids)
+        )
+
+    async def registrar_sinal(self, disciplina_id, em):
+        sessao = await self.obter_ativa(disciplina_id)
+        if not sessao:
+            return None
+        if not sessao.get("visto_em") or em > sessao["visto_em"]:
+            sessao["visto_em"] = em
+            self._gravar([sessao])
+        return sessao
+
+    async def iterar(self, batch_size: int = 1000):
+        async for sessao in super().iterar(batch_size):
+            yield sessao
+        cursor = self.conn.execute(
+            "SELECT disciplina_id, mes, ids, inicios, duracoes FROM sessoes_compactadas WHERE usuario_id = ?",
+            (self.usuario_id,)
+        )
+        for linha in cursor:
+            for sessao in expandir_bucket(self._bucket(linha)):
+                yield sessao
+
+    async def upsert_muitos(self, documentos):
+        # Re-importing an export must not bring compacted sessions back as raw duplicates
+        compactados = {
+            sessao_id
+            for (sessao_id,) in self.conn.execute(
+                "SELECT i.value FROM sessoes_compactadas c, json_each(c.ids) i WHERE c.usuario_id = ?",
+                (self.usuario_id,)
+            )
+        }
+        self._gravar([documento for documento in documentos if documento["id"] not in compactados])
+
+    @staticmethod
+    def _bucket(linha) -> Dict[str, Any]:
+        disciplina_id, mes, ids, inicios, duracoes = linha
+        return {
+            "disciplina_id": disciplina_id,
+            "mes": datetime.fromisoformat(mes),
+            "ids": json.loads(ids),
+            "inicios": json.loads(inicios),
+            "duracoes": json.loads(duracoes),
+        }
+
+    async def _historico_bruto(self, disciplina_id, apos, limite, batch_size):
+        sql = "SELECT doc FROM sessoes_estudo WHERE usuario_id = ? AND disciplina_id = ?"
+        parametros: List[Any] = [self.usuario_id, disciplina_id]
+        if apos:
+            sql += " AND (inicio < ? OR (inicio = ? AND id < ?))"
+            inicio = _ts(apos["inicio"])
+            parametros += [inicio, inicio, apos["id"]]
+        sql += " ORDER BY inicio DESC, id DESC"
+        if limite:
+            sql += " LIMIT ?"
+            parametros.append(limite)
+        cursor = self.conn.execute(sql, parametros)
+        while True:
+            linhas = cursor.fetchmany(batch_size)
+            if not linhas:
+                break
+            for linha in linhas:
+                yield _loads(linha[0])
+
+    async def _buckets_decrescentes(self, disciplina_id, ate):
+        sql = "SELECT disciplina_id, mes, ids, inicios, duracoes FROM sessoes_compactadas " \
+              "WHERE usuario_id = ? AND disciplina_id = ?"
+        parametros: List[Any] = [self.usuario_id, disciplina_id]
+        if ate:
+            sql += " AND mes <= ?"
+            parametros.append(_ts(ate))
+        for linha in self.conn.execute(sql + " ORDER BY mes DESC", parametros):
+            yield self._bucket(linha)
+
+    def _concluidas(self, de: Optional[datetime], ate: Optional[datetime]) -> List[Any]:
+        """Parâmetros de SQL_CONCLUIDAS_DO_USUARIO; sem `de` ou `ate`, o intervalo fica aberto desse lado"""
+        de_ts, ate_ts = (_ts(de) if de else ""), (_ts(ate) if ate else "9999")
+        mes_de = _ts(inicio_do_mes(de)) if de else ""
+        return [self.usuario_id, de_ts, ate_ts, self.usuario_id, mes_de, ate_ts, de_ts, ate_ts]
+
+    async def totais_por_dia(self, de=None, ate=None):
+        sql = f"""
+            SELECT disciplina_id, substr(inicio, 1, 10) AS dia, SUM(duracao_segundos), COUNT(*)
+            FROM ({SQL_CONCLUIDAS_DO_USUARIO}) GROUP BY disciplina_id, dia
+        """
+        return [
+            {"disciplina_id": disciplina_id, "dia": dia, "total_segundos": total or 0, "sessoes": sessoes}
+            for disciplina_id, dia, total, sessoes in self.conn.execute(sql, self._concluidas(de, ate))
+        ]
+
+    async def existe_concluida(self):
+        return self.conn.execute(
+            "SELECT 1 FROM sessoes_concluidas WHERE usuario_id = ? LIMIT 1", (self.usuario_id,)
+        ).fetchone() is not None
+
+    async def colunas_concluidas(self, de, ate):
+        linhas = self.conn.execute(SQL_CONCLUIDAS_DO_USUARIO, self._concluidas(de, ate)).fetchall()
+        disciplina_ids, inicios, duracoes = zip(*linhas) if linhas else ((), (), ())
+        return {"disciplina_id": list(disciplina_ids), "inicio": list(inicios), "duracao_segundos": list(duracoes)}
+
+    async def aplicar_lote(self, novas, encerradas):
+        # Nothing else runs between the caller reading the active sessions and this write, so no conflicts
+        self._gravar(novas + encerradas)
+        return []
+
+    async def compactar(self, antes, lote=LOTE_COMPACTACAO):
+        compactadas, buckets = 0, set()
+        while True:
+            sessoes = [
+                {"id": sessao_id, "disciplina_id": disciplina_id, "inicio": datetime.fromisoformat(inicio),
+                 "duracao_segundos": duracao}
+                for sessao_id, disciplina_id, inicio, duracao in self.conn.execute(
+                    "SELECT id, disciplina_id, inicio, duracao_segundos FROM sessoes_estudo "
+                    "WHERE usuario_id = ? AND ativa = 0 AND inicio < ? ORDER BY inicio LIMIT ?",
+                    (self.usuario_id, _ts(antes), lote)
+                )
+            ]
+            if not sessoes:
+                break
+            grupos = agrupar_em_buckets(sessoes)
+            # Appending to a bucket and deleting its raw rows happen in one transaction per batch
+            with self.conn:
+                for (disciplina_id, mes), arrays in grupos.items():
+                    existente = self.conn.execute(
+                        "SELECT disciplina_id, mes, ids, inicios, duracoes FROM sessoes_compactadas "
+                        "WHERE usuario_id = ? AND disciplina_id = ? AND mes = ?",
+                        (self.usuario_id, disciplina_id, _ts(mes))
+                    ).fetchone()
+                    if existente:
+                        bucket = self._bucket(existente)
+                        for campo in arrays:
+                            arrays[campo] = bucket[campo] + arrays[campo]
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO sessoes_compactadas "
+                        "(usuario_id, disciplina_id, mes, ids, inicios, duracoes, total_segundos, sessoes) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (self.usuario_id, disciplina_id, _ts(mes), json.dumps(arrays["ids"]),
+                         json.dumps(arrays["inicios"]), json.dumps(arrays["duracoes"]),
+                         sum(arrays["duracoes"]), len(arrays["ids"]))
+                    )
+                marcadores = ", ".join("?" * len(sessoes))
+                self.conn.execute(
+                    f"DELETE FROM sessoes_estudo WHERE usuario_id = ? AND id IN ({marcadores})",
+                    (self.usuario_id, *(sessao["id"] for sessao in sessoes))
+                )
+            compactadas += len(sessoes)
+            buckets.update(grupos)
+            if len(sessoes) < lote:
+                break
+        return {"sessoes": compactadas, "buckets": len(buckets)}
+
+
+class SQLiteDesempenhoRepository(SQLiteRepositorio, DesempenhoRepository):
+    def colunas(self, documento):
+        return {"semana_inicio": documento["semana_inicio"]}
+
+    async def listar(self):
+        return self._buscar(
+            "SELECT doc FROM desempenho_semanal WHERE usuario_id = ? ORDER BY semana_inicio DESC LIMIT 1000",
+            (self.usuario_id,)
+        )
+
+    async def listar_intervalo(self, de, ate):
+        return self._buscar(
+            "SELECT doc FROM desempenho_semanal WHERE usuario_id = ? AND semana_inicio BETWEEN ? AND ? "
+            "ORDER BY semana_inicio",
+            (self.usuario_id, de, ate)
+        )
+
+    async def contagens(self, dias, de=None, ate=None, antes=None, limite=52):
+        colunas = ", ".join(
+            f"(SELECT count(*) FROM json_each(doc, '$.{dia}')), "
+            f"(SELECT count(*) FROM json_each(doc, '$.{dia}') WHERE json_extract(value, '$.concluida'))"
+            for dia in dias
+        )
+        filtros, parametros = ["usuario_id = ?"], [self.usuario_id]
+        for condicao, valor in (("semana_inicio >= ?", de), ("semana_inicio <= ?", ate), ("semana_inicio < ?", antes)):
+            if valor:
+                filtros.append(condicao)
+                parametros.append(valor)
+        linhas = self.conn.execute(
+            f"SELECT semana_inicio, {colunas} FROM desempenho_semanal WHERE {' AND '.join(filtros)} "
+            f"ORDER BY semana_inicio DESC LIMIT ?",
+            (*parametros, limite)
+        )
+        return [
+            {
+                "semana_inicio": linha[0],
+                "dias": {
+                    dia: {"total": linha[1 + 2 * i], "concluidas": linha[2 + 2 * i]}
+                    for i, dia in enumerate(dias)
+                }
+            }
+            for linha in linhas
+        ]
+
+    async def obter_semana(self, semana_inicio):
+        documentos = self._buscar(
+            "SELECT doc FROM desempenho_semanal WHERE usuario_id = ? AND semana_inicio = ?",
+            (self.usuario_id, semana_inicio)
+        )
+        return documentos[0] if documentos else None
+
+    async def obter_semanas(self, semanas):
+        if not semanas:
+            return []
+        marcadores = ", ".join("?" * len(semanas))
+        return self._buscar(
+            f"SELECT doc FROM desempenho_semanal WHERE usuario_id = ? AND semana_inicio IN ({marcadores}) "
+            f"ORDER BY semana_inicio",
+            (self.usuario_id, *semanas)
+        )
+
+    async def salvar_semana(self, documento):
+        existente = await self.obter_semana(documento["semana_inicio"])
+        if existente:
+            documento = {**existente, **documento, "id": existente["id"], "criado_em": existente["criado_em"]}
+        self._gravar([{**documento, "versao": (existente or {}).get("versao", 0) + 1}])
+
+    async def adicionar_tarefa(self, semana_inicio, dia, tarefa, semana_nova):
+        desempenho = await self.obter_semana(semana_inicio) or dict(semana_nova)
+        desempenho[dia] = desempenho.get(dia, []) + [tarefa]
+        desempenho["versao"] = desempenho.get("versao", 0) + 1
+        self._gravar([desempenho])
+
+    async def atualizar_tarefa(self, semana_inicio, dia, tarefa_id, campos):
+        desempenho = await self.obter_semana(semana_inicio)
+        for tarefa in (desempenho or {}).get(dia, []):
+            if tarefa["id"] == tarefa_id:
+                tarefa.update(campos)
+                desempenho["versao"] = desempenho.get("versao", 0) + 1
+                self._gravar([desempenho])
+                return tarefa
+        return None
+
+    async def remover_tarefa(self, semana_inicio, dia, tarefa_id):
+        desempenho = await self.obter_semana(semana_inicio)
+        if not desempenho:
+            return False
+        restantes = [tarefa for tarefa in desempenho.get(dia, []) if tarefa["id"] != tarefa_id]
+        if len(restantes) == len(desempenho.get(dia, [])):
+            return False
+        desempenho[dia] = restantes
+        desempenho["versao"] = desempenho.get("versao", 0) + 1
+        self._gravar([desempenho])
+        return True
+
+    async def marcar_tarefas(self, alteracoes):
+        semanas = {semana["semana_inicio"]: semana
+                   for semana in await self.obter_semanas(sorted({a[0] for a in alteracoes}))}
+        alteradas = {}
+        for semana_inicio, dia, tarefa_id, concluida in alteracoes:
+            desempenho = semanas.get(semana_inicio)
+            for tarefa in (desempenho or {}).get(dia, []):
+                if tarefa["id"] == tarefa_id:
+                    tarefa["concluida"] = concluida
+                    alteradas[semana_inicio] = desempenho
+        # One version bump and one row write per week, however many of its tasks changed
+        for desempenho in alteradas.values():
+            desempenho["versao"] = desempenho.get("versao", 0) + 1
+        self._gravar(list(alteradas.values()))
+
+
+class SQLiteStatusCheckRepository(SQLiteRepositorio, StatusCheckRepository):
+    async def inserir(self, documento):
+        self._gravar([documento], upsert=False)
+
+    async def listar(self):
+        return self._buscar("SELECT doc FROM status_checks ORDER BY rowid LIMIT 1000")
+
+
+class SQLiteRollupRepository(RollupRepository):
+    def __init__(self, conn: sqlite3.Connection, usuario_id: str):
+        self.conn = conn
+        self.usuario_id = usuario_id
+        self.marcador = f"{self.colecao}:{usuario_id}"
+
+    async def incrementar(self, disciplina_id, dia, segundos):
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO study_rollups (usuario_id, disciplina_id, dia, total_segundos, sessoes)
+                VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT(usuario_id, disciplina_id, dia) DO UPDATE SET
+                    total_segundos = total_segundos + excluded.total_segundos,
+                    sessoes = sessoes + 1
+                """,
+                (self.usuario_id, disciplina_id, dia, segundos)
+            )
+            _avancar_marcador(self.conn, self.marcador)
+
+    async def incrementar_muitos(self, incrementos):
+        if not incrementos:
+            return
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO study_rollups (usuario_id, disciplina_id, dia, total_segundos, sessoes)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(usuario_id, disciplina_id, dia) DO UPDATE SET
+                    total_segundos = total_segundos + excluded.total_segundos,
+                    sessoes = sessoes + excluded.sessoes
+                """,
+                [
+                    (self.usuario_id, i["disciplina_id"], i["dia"], i["total_segundos"], i["sessoes"])
+                    for i in incrementos
+                ]
+            )
+            _avancar_marcador(self.conn, self.marcador)
+
+    async def somar_por_disciplina(self, de, ate):
+        linhas = self.conn.execute(
+            "SELECT disciplina_id, SUM(total_segundos) FROM study_rollups "
+            "WHERE usuario_id = ? AND dia BETWEEN ? AND ? GROUP BY disciplina_id",
+            (self.usuario_id, de, ate)
+        )
+        return [{"disciplina_id": disciplina_id, "total_segundos": total} for disciplina_id, total in linhas]
+
+    async def listar(self, de, ate):
+        linhas = self.conn.execute(
+            "SELECT disciplina_id, dia, total_segundos, sessoes FROM study_rollups "
+            "WHERE usuario_id = ? AND dia BETWEEN ? AND ?",
+            (self.usuario_id, de, ate)
+        )
+        return [
+            {"disciplina_id": disciplina_id, "dia": dia, "total_segundos": total, "sessoes": sessoes}
+            for disciplina_id, dia, total, sessoes in linhas
+        ]
+
+    async def reconstruir(self):
+        with self.conn:
+            # One transaction: readers never see the user without rollups
+            self.conn.execute("DELETE FROM study_rollups WHERE usuario_id = ?", (self.usuario_id,))
+            self.conn.execute(SQL_RECONSTRUIR_ROLLUPS.format(filtro="WHERE usuario_id = ?"), (self.usuario_id,))
+            _avancar_marcador(self.conn, self.marcador)
+        return await self.contar()
+
+    async def contar(self):
+        return self.conn.execute("SELECT COUNT(*) FROM study_rollups WHERE usuario_id = ?",
+                                 (self.usuario_id,)).fetchone()[0]
+
+    async def versao(self):
+        # The user's marker plus the global one advanced by preencher_rollups
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(versao), 0) FROM marcadores WHERE nome IN (?, ?)", (self.marcador, self.colecao)
+        ).fetchone()[0]
+
+
+class SQLiteSyncRepository(SyncRepository):
+    def __init__(self, conn: sqlite3.Connection, usuario_id: str):
+        self.conn = conn
+        self.usuario_id = usuario_id
+
+    async def reservar(self, chaves):
+        agora = datetime.utcnow()
+        reservadas = []
+        with self.conn:
+            # No TTL index here: forget the user's expired keys while we hold the write
+            self.conn.execute("DELETE FROM sync_eventos WHERE usuario_id = ? AND registrado_em < ?",
+                              (self.usuario_id, _ts(agora - SYNC_RETENCAO)))
+            for chave in chaves:
+                cursor = self.conn.execute(
+                    "INSERT INTO sync_eventos (usuario_id, chave, registrado_em) VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+                    (self.usuario_id, chave, _ts(agora))
+                )
+                if cursor.rowcount:
+                    reservadas.append(chave)
+        return reservadas
+
+    async def resultados(self, chaves):
+        if not chaves:
+            return {}
+        marcadores = ", ".join("?" * len(chaves))
+        linhas = self.conn.execute(
+            f"SELECT chave, resultado FROM sync_eventos WHERE usuario_id = ? AND chave IN ({marcadores})",
+            (self.usuario_id, *chaves)
+        )
+        return {chave: _loads(resultado) if resultado else None for chave, resultado in linhas}
+
+    async def concluir(self, resultados):
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE sync_eventos SET resultado = ? WHERE usuario_id = ? AND chave = ?",
+                [(_dumps(resultado), self.usuario_id, resultado["chave"]) for resultado in resultados]
+            )
+
+    async def liberar(self, chaves):
+        with self.conn:
+            self.conn.executemany("DELETE FROM sync_eventos WHERE usuario_id = ? AND chave = ?",
+                                  [(self.usuario_id, chave) for chave in chaves])
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path: str):
+        self.nome = "memory" if path == ":memory:" else "sqlite"
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.status_checks = SQLiteStatusCheckRepository(self.conn)
+
+    def do_usuario(self, usuario_id):
+        return DadosUsuario(
+            usuario_id,
+            SQLiteDisciplinaRepository(self.conn, usuario_id),
+            SQLiteSessaoRepository(self.conn, usuario_id),
+            SQLiteDesempenhoRepository(self.conn, usuario_id),
+            SQLiteRollupRepository(self.conn, usuario_id),
+            SQLiteSyncRepository(self.conn, usuario_id),
+        )
+
+    def _migrar_usuario_padrao(self):
+        """Recriar as tabelas anteriores à partição por usuário, atribuindo suas linhas ao USUARIO_PADRAO"""
+        legadas = [
+            tabela for tabela in SQLITE_COLUNAS_LEGADAS
+            if (colunas := [linha[1] for linha in self.conn.execute(f"PRAGMA table_info({tabela})")])
+            and "usuario_id" not in colunas
+        ]
+        if not legadas:
+            return
+        # SQLite can't change a primary key in place: rename, recreate and copy in one transaction
+        script = ["BEGIN;"]
+        script += [f"ALTER TABLE {tabela} RENAME TO {tabela}_legado;" for tabela in legadas]
+        script.append(SQLITE_SCHEMA)
+        for tabela in legadas:
+            colunas = SQLITE_COLUNAS_LEGADAS[tabela]
+            script.append(
+                f"INSERT INTO {tabela} (usuario_id, {colunas}) "
+                f"SELECT '{USUARIO_PADRAO}', {colunas} FROM {tabela}_legado;"
+            )
+            script.append(f"DROP TABLE {tabela}_legado;")
+        script.append("COMMIT;")
+        try:
+            self.conn.executescript("\n".join(script))
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        print(f"Assigned {', '.join(legadas)} to user {USUARIO_PADRAO}")
+
+    async def inicializar(self):
+        self._migrar_usuario_padrao()
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    async def preencher_rollups(self):
+        if self.conn.execute("SELECT 1 FROM study_rollups LIMIT 1").fetchone() or \
+                not self.conn.execute("SELECT 1 FROM sessoes_concluidas LIMIT 1").fetchone():
+            return 0
+        with self.conn:
+            self.conn.execute(SQL_RECONSTRUIR_ROLLUPS.format(filtro="WHERE true"))
+            _avancar_marcador(self.conn, "study_rollups")
+        return self.conn.execute("SELECT COUNT(*) FROM study_rollups").fetchone()[0]
+
+    async def usuarios_com_sessoes(self):
+        return [usuario_id for (usuario_id,) in self.conn.execute("SELECT DISTINCT usuario_id FROM sessoes_estudo")]
+
+    async def encerrar_abandonadas(self, sinal_ate, sem_sinal_ate, usuario_id=None):
+        encerradas: Dict[str, List[Dict[str, Any]]] = {}
+        execucao = uuid.uuid4().hex
+        # The active set is small: read it through usuario_sessao_ativa_unica and decide here
+        sql, parametros = "SELECT usuario_id, doc FROM sessoes_estudo WHERE ativa = 1", ()
+        if usuario_id is not None:
+            sql, parametros = sql + " AND usuario_id = ?", (usuario_id,)
+        for usuario_id, doc in self.conn.execute(sql, parametros):
+            sessao = _loads(doc)
+            visto_em = sessao.get("visto_em")
+            if visto_em is None and (sem_sinal_ate is None or sessao["inicio"] >= sem_sinal_ate):
+                continue
+            if visto_em is not None and visto_em >= sinal_ate:
+                continue
+            fim = max(sessao["inicio"], visto_em or sessao["inicio"])
+            sessao.update({
+                "fim": fim,
+                "ativa": False,
+                "duracao_segundos": int((fim - sessao["inicio"]).total_seconds()),
+                "encerramento_automatico": execucao,
+            })
+            encerradas.setdefault(usuario_id, []).append(sessao)
+        for usuario_id, sessoes in encerradas.items():
+            SQLiteSessaoRepository(self.conn, usuario_id)._gravar(sessoes)
+        return encerradas
+
+    async def relatorio_compactacao(self):
+        # Payload sizes only (no per-row or page overhead), comparable between the two tiers
+        documentos, bytes_brutos = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length(doc) + length(id) + length(disciplina_id) + length(inicio) + 8), 0) "
+            "FROM sessoes_estudo"
+        ).fetchone()
+        buckets, sessoes, bytes_compactados = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(sessoes), 0), COALESCE(SUM(length(ids) + length(inicios) + "
+            "length(duracoes) + length(disciplina_id) + length(mes) + 16), 0) FROM sessoes_compactadas"
+        ).fetchone()
+        return resumo_camadas(
+            {"documentos": documentos, "bytes": bytes_brutos},
+            {"documentos": buckets, "sessoes": sessoes, "bytes": bytes_compactados},
+        )
+
+    def consultas_canonicas(self):
+        return [
+            ("disciplinas.find_one(usuario_id, id)", "SELECT doc FROM disciplinas WHERE usuario_id = '' AND id = ''"),
+            ("sessoes_estudo.find_one(usuario_id, disciplina_id, ativa)",
+             "SELECT doc FROM sessoes_estudo WHERE usuario_id = '' AND disciplina_id = '' AND ativa = 1"),
+            ("sessoes_estudo.find(usuario_id, ativa, disciplina_id $in)",
+             "SELECT doc FROM sessoes_estudo WHERE usuario_id = '' AND ativa = 1 AND disciplina_id IN ('')"),
+            ("sessoes_estudo.find(usuario_id, disciplina_id).sort(inicio, id)",
+             "SELECT doc FROM sessoes_estudo WHERE usuario_id = '' AND disciplina_id = '' ORDER BY inicio DESC, id DESC"),
+            ("sessoes_estudo.aggregate(sessoes_por_dia)", SQL_CONCLUIDAS_DO_USUARIO.replace("?", "''")),
+            ("study_rollups.aggregate(resumo_periodo)",
+             "SELECT disciplina_id FROM study_rollups WHERE usuario_id = '' AND dia BETWEEN '' AND ''"),
+            ("desempenho_semanal.find_one(usuario_id, semana_inicio)",
+             "SELECT doc FROM desempenho_semanal WHERE usuario_id = '' AND semana_inicio = ''"),
+            ("sync_eventos.find(usuario_id, chave $in)",
+             "SELECT resultado FROM sync_eventos WHERE usuario_id = '' AND chave IN ('')"),
+            ("sessoes_compactadas.find(usuario_id, disciplina_id, mes).sort(mes)",
+             "SELECT ids FROM sessoes_compactadas WHERE usuario_id = '' AND disciplina_id = '' AND mes <= '' "
+             "ORDER BY mes DESC"),
+            ("sessoes_estudo.find(abandonadas)", "SELECT usuario_id, doc FROM sessoes_estudo WHERE ativa = 1"),
+        ]
+
+    def _indices_ausentes(self) -> List[str]:
+        existentes = {linha[0] for linha in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        return [nome for nome in SQLITE_INDICES if nome not in existentes]
+
+    async def verificar_prontidao(self):
+        try:
+            ausentes = self._indices_ausentes()
+        except sqlite3.Error as e:
+            return {"ok": False, "erro": str(e)}
+        return {"ok": not ausentes, "indices_ausentes": ausentes}
+
+    async def verificar_indices(self):
+        ausentes = self._indices_ausentes()
+
+        # Reading a view's rows back or a json_each over one row is not a table scan
+        views = {linha[0] for linha in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'view'")}
+        planos = {}
+        for nome, sql in self.consultas_canonicas():
+            estagios = [linha[3] for linha in self.conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+            # "SCAN <table>" without an index is SQLite's collection scan
+            collscan = any(
+                e.startswith("SCAN ") and " USING " not in e and " VIRTUAL TABLE " not in e and e.split()[1] not in views
+                for e in estagios
+            )
+            planos[nome] = {"estagios": estagios, "collscan": collscan}
+
+        return {
+            "backend": self.nome,
+            "ausentes": ausentes,
+            "nao_utilizados": [],
+            "planos": planos,
+            "ok": not ausentes and not any(p["collscan"] for p in planos.values()),
+        }
+
+    async def descartar(self):
+        with self.conn:
+            for tabela in ("disciplinas", "sessoes_estudo", "desempenho_semanal", "status_checks", "study_rollups",
+                           "marcadores", "sync_eventos", "sessoes_compactadas"):
+                self.conn.execute(f"DELETE FROM {tabela}")
+
+    def fechar(self):
+        self.conn.close()
+
+
+def criar_storage(backend: str, mongo_url: Optional[str] = None, db_name: Optional[str] = None,
+                  sqlite_path: Optional[str] = None, **mongo_options) -> Storage:
+    """Criar o storage configurado; `mongo_options` vão para o cliente Motor e são ignoradas nos demais"""
+    if backend == "mongo":
+        return MongoStorage(mongo_url, db_name, **mongo_options)
+    if backend == "sqlite":
+        return SQLiteStorage(sqlite_path)
+    if backend == "memory":
+        return SQLiteStorage(":memory:")
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
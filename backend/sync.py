@@ -0,0 +1,133 @@
+"""Aplicação em lote dos eventos que clientes offline acumulam: início e parada de cronômetro e marcação de tarefas
+
+`PlanoSync` reproduz os eventos em ordem sobre o estado lido antes do lote (sessões ativas e semanas
+tocadas), decidindo o resultado de cada um em memória. Só depois as escritas acumuladas vão ao
+storage, um lote por coleção: sessões, rollups e semanas.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Client clocks drift; events stamped further in the future than this are rejected
+TOLERANCIA_RELOGIO = timedelta(minutes=5)
+
+TIPOS_EVENTO = ("iniciar", "parar", "tarefa")
+
+
+def instante_utc(valor) -> datetime:
+    """UTC sem fuso e em milissegundos, como os datetimes que o BSON devolve"""
+    if isinstance(valor, str):
+        valor = datetime.fromisoformat(valor.replace("Z", "+00:00"))
+    if valor.tzinfo is not None:
+        valor = valor.astimezone(timezone.utc).replace(tzinfo=None)
+    return valor.replace(microsecond=valor.microsecond // 1000 * 1000)
+
+
+def incrementos_rollup(sessoes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Segundos e sessões concluídas por (disciplina_id, dia de início), como em /timer/parar"""
+    incrementos: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for sessao in sessoes:
+        if sessao["ativa"]:
+            continue
+        chave = (sessao["disciplina_id"], instante_utc(sessao["inicio"]).date().isoformat())
+        incremento = incrementos.setdefault(
+            chave, {"disciplina_id": chave[0], "dia": chave[1], "total_segundos": 0, "sessoes": 0}
+        )
+        incremento["total_segundos"] += sessao["duracao_segundos"]
+        incremento["sessoes"] += 1
+    return list(incrementos.values())
+
+
+class PlanoSync:
+    def __init__(self, ativas: List[Dict[str, Any]], semanas: List[Dict[str, Any]], agora: datetime,
+                 nova_sessao: Callable[[str, datetime], Dict[str, Any]]):
+        self.agora = agora
+        self.nova_sessao = nova_sessao
+        self.ativas: Dict[str, Dict[str, Any]] = {sessao["disciplina_id"]: sessao for sessao in ativas}
+        self.semanas: Dict[str, Dict[str, Any]] = {semana["semana_inicio"]: semana for semana in semanas}
+        # Sessions to insert (started here) and active ones read before the batch that it closes, by id
+        self.novas: Dict[str, Dict[str, Any]] = {}
+        self.encerradas: Dict[str, Dict[str, Any]] = {}
+        self.tarefas: Dict[Tuple[str, str, str], bool] = {}
+        # Results of the events that touched each session, so a write conflict can reject them all
+        self.por_sessao: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        # Timer transitions for the SSE stream, in order: the started session, or None plus the duration
+        self.publicacoes: List[Tuple[str, str, Optional[Dict[str, Any]], Optional[int]]] = []
+
+    def aplicar(self, evento: Dict[str, Any]) -> Dict[str, Any]:
+        """Aplicar um evento ao estado em memória e devolver seu resultado"""
+        resultado = {"chave": evento["chave"], "tipo": evento["tipo"], "status": "aplicado"}
+        if evento["tipo"] not in TIPOS_EVENTO:
+            return self._rejeitar(resultado, f"Tipo de evento inválido. Use um de: {', '.join(TIPOS_EVENTO)}")
+        em = instante_utc(evento["em"])
+        if em > self.agora + TOLERANCIA_RELOGIO:
+            return self._rejeitar(resultado, "Evento com horário no futuro")
+        if evento["tipo"] == "tarefa":
+            return self._marcar_tarefa(evento, resultado)
+        if not evento.get("disciplina_id"):
+            return self._rejeitar(resultado, "disciplina_id é obrigatório")
+        if evento["tipo"] == "iniciar":
+            return self._iniciar(evento["disciplina_id"], min(em, self.agora), resultado)
+        return self._parar(evento["disciplina_id"], min(em, self.agora), resultado)
+
+    def _rejeitar(self, resultado: Dict[str, Any], detalhe: str) -> Dict[str, Any]:
+        resultado.update(status="rejeitado", detalhe=detalhe)
+        return resultado
+
+    def _iniciar(self, disciplina_id: str, em: datetime, resultado: Dict[str, Any]) -> Dict[str, Any]:
+        if disciplina_id in self.ativas:
+            return self._rejeitar(resultado, "Já existe uma sessão ativa para esta disciplina")
+        sessao = self.nova_sessao(disciplina_id, em)
+        self.ativas[disciplina_id] = self.novas[sessao["id"]] = sessao
+        self.por_sessao[sessao["id"]].append(resultado)
+        self.publicacoes.append((sessao["id"], disciplina_id, dict(sessao), None))
+        resultado["sessao_id"] = sessao["id"]
+        return resultado
+
+    def _parar(self, disciplina_id: str, em: datetime, resultado: Dict[str, Any]) -> Dict[str, Any]:
+        sessao = self.ativas.get(disciplina_id)
+        if not sessao:
+            return self._rejeitar(resultado, "Nenhuma sessão ativa encontrada para esta disciplina")
+        inicio = instante_utc(sessao["inicio"])
+        if em < inicio:
+            return self._rejeitar(resultado, "Parada anterior ao início da sessão")
+        del self.ativas[disciplina_id]
+        sessao.update(fim=em, ativa=False, duracao_segundos=int((em - inicio).total_seconds()))
+        if sessao["id"] not in self.novas:
+            self.encerradas[sessao["id"]] = sessao
+        self.por_sessao[sessao["id"]].append(resultado)
+        self.publicacoes.append((sessao["id"], disciplina_id, None, sessao["duracao_segundos"]))
+        resultado.update(sessao_id=sessao["id"], duracao_segundos=sessao["duracao_segundos"])
+        return resultado
+
+    def _marcar_tarefa(self, evento: Dict[str, Any], resultado: Dict[str, Any]) -> Dict[str, Any]:
+        semana_inicio = evento["semana_inicio"].isoformat() if evento.get("semana_inicio") else None
+        tarefas = (self.semanas.get(semana_inicio) or {}).get(evento.get("dia"))
+        # Only the weekday fields of a week hold task lists
+        tarefa = next((t for t in tarefas if t["id"] == evento.get("tarefa_id")), None) if isinstance(tarefas, list) else None
+        if not tarefa:
+            return self._rejeitar(resultado, "Tarefa não encontrada")
+        # Without an explicit value the event toggles the state left by the events before it
+        concluida = not tarefa.get("concluida") if evento.get("concluida") is None else evento["concluida"]
+        tarefa["concluida"] = concluida
+        self.tarefas[(semana_inicio, evento["dia"], tarefa["id"])] = concluida
+        resultado.update(tarefa_id=tarefa["id"], concluida=concluida)
+        return resultado
+
+    def marcar_conflitos(self, sessao_ids: List[str]):
+        """Rejeitar os eventos das sessões que outra requisição alterou antes da gravação do lote"""
+        for sessao_id in sessao_ids:
+            for resultado in self.por_sessao.get(sessao_id, []):
+                resultado.pop("duracao_segundos", None)
+                self._rejeitar(resultado, "Conflito com outra alteração deste cronômetro")
+            self.novas.pop(sessao_id, None)
+            self.encerradas.pop(sessao_id, None)
+        conflitos = set(sessao_ids)
+        self.publicacoes = [publicacao for publicacao in self.publicacoes if publicacao[0] not in conflitos]
+
+    def incrementos_rollup(self) -> List[Dict[str, Any]]:
+        return incrementos_rollup([*self.novas.values(), *self.encerradas.values()])
+
+    def alteracoes_tarefas(self) -> List[Tuple[str, str, str, bool]]:
+        return [(*chave, concluida) for chave, concluida in self.tarefas.items()]
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+API Load Benchmark for Sistema de Planejamento de Estudos
+Starts the app in-process (uvicorn on a loopback port) against a throwaway
+database on a local mongod, or on the embedded in-memory store, seeds
+configurable volumes of study sessions and weekly performance documents, drives
+every read route concurrently and reports throughput and p50/p95/p99 latency per
+route as JSON.
+
+    python backend_benchmark.py --sessoes 50000 --semanas 104 --saida bench.json
+    python backend_benchmark.py --storage memory
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, date, timedelta
+from pathlib import Path
+
+import httpx
+import uvicorn
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storage", default=os.environ.get("STORAGE_BACKEND", "mongo"),
+                        choices=["mongo", "sqlite", "memory"], help="storage backend to benchmark")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default=f"benchmark_{uuid.uuid4().hex[:8]}",
+                        help="database to seed (dropped afterwards unless --manter)")
+    parser.add_argument("--sessoes", type=int, default=10000, help="completed study sessions to seed")
+    parser.add_argument("--semanas", type=int, default=52, help="weekly performance documents to seed")
+    parser.add_argument("--tarefas", type=int, default=5, help="tasks per day in each seeded week")
+    parser.add_argument("--concorrencia", type=int, default=10, help="concurrent clients per route")
+    parser.add_argument("--requisicoes", type=int, default=500, help="requests per route")
+    parser.add_argument("--saida", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--manter", action="store_true", help="keep the seeded database")
+    return parser.parse_args()
+
+
+def percentil(amostras, p):
+    if not amostras:
+        return None
+    ordenadas = sorted(amostras)
+    indice = min(len(ordenadas) - 1, max(0, round(p / 100 * len(ordenadas)) - 1))
+    return ordenadas[indice]
+
+
+async def seed(server, args):
+    """Seed sessions and weekly performance for the default user straight into the benchmark database"""
+    usuario = server.storage.do_usuario(server.USUARIO_PADRAO)
+    disciplinas = await server.catalogos.de(usuario).todas()
+    agora = datetime.utcnow()
+    lote = []
+    for i in range(args.sessoes):
+        inicio = agora - timedelta(minutes=random.randint(60, 60 * 24 * 365 * 2))
+        duracao = random.randint(5 * 60, 3 * 3600)
+        sessao = server.SessaoEstudo(
+            disciplina_id=random.choice(disciplinas).id,
+            inicio=inicio,
+            fim=inicio + timedelta(seconds=duracao),
+            duracao_segundos=duracao,
+            ativa=False,
+        )
+        lote.append(sessao.dict())
+        if len(lote) >= 5000:
+            await usuario.sessoes.upsert_muitos(lote)
+            lote = []
+    if lote:
+        await usuario.sessoes.upsert_muitos(lote)
+
+    segunda = date.today() - timedelta(days=date.today().weekday())
+    semanas = []
+    for semana in range(args.semanas):
+        desempenho = server.DesempenhoSemanal(semana_inicio=segunda - timedelta(weeks=semana))
+        for dia in server.DIAS_SEMANA:
+            setattr(desempenho, dia, [
+                server.TarefaDiaria(horario=f"{8 + t:02d}:00", descricao=f"Tarefa {t}", concluida=t % 2 == 0)
+                for t in range(args.tarefas)
+            ])
+        semanas.append(server.documento_para_mongo("desempenho_semanal", desempenho.dict()))
+    if semanas:
+        await usuario.desempenho.upsert_muitos(semanas)
+
+    await usuario.rollups.reconstruir()
+    return disciplinas, segunda
+
+
+def rotas(disciplinas, segunda):
+    ids = [d.id for d in disciplinas]
+    return {
+        "GET /disciplinas": lambda: ("GET", "/disciplinas"),
+        "GET /disciplinas/{id}": lambda: ("GET", f"/disciplinas/{random.choice(ids)}"),
+        "GET /timer/status": lambda: ("GET", "/timer/status"),
+        "GET /timer/status/{id}": lambda: ("GET", f"/timer/status/{random.choice(ids)}"),
+        "GET /timer/resumo-semanal": lambda: ("GET", "/timer/resumo-semanal"),
+        "GET /timer/resumo-mensal": lambda: ("GET", "/timer/resumo-mensal"),
+        "GET /timer/sessoes/{id}": lambda: ("GET", f"/timer/sessoes/{random.choice(ids)}"),
+        "GET /desempenho": lambda: ("GET", "/desempenho"),
+        "GET /desempenho?de=&ate=": lambda: (
+            "GET", f"/desempenho?de={(segunda - timedelta(weeks=51)).isoformat()}&ate={segunda.isoformat()}"
+        ),
+        "GET /desempenho/estatisticas": lambda: ("GET", "/desempenho/estatisticas"),
+        "GET /desempenho/{semana}": lambda: ("GET", f"/desempenho/{segunda.isoformat()}"),
+        "GET /analytics/heatmap": lambda: ("GET", "/analytics/heatmap"),
+        "GET /analytics/medias": lambda: ("GET", "/analytics/medias"),
+        "GET /analytics/distribuicao?por=semana": lambda: ("GET", "/analytics/distribuicao?por=semana"),
+    }
+
+
+async def run_route(client, gerar_requisicao, args):
+    latencias = []
+    erros = 0
+    restantes = args.requisicoes
+
+    async def worker():
+        nonlocal restantes, erros
+        while restantes > 0:
+            restantes -= 1
+            metodo, caminho = gerar_requisicao()
+            inicio = time.perf_counter()
+            response = await client.request(metodo, caminho)
+            latencias.append((time.perf_counter() - inicio) * 1000)
+            if response.status_code >= 400:
+                erros += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concorrencia)))
+    duracao = time.perf_counter() - inicio
+
+    return {
+        "requisicoes": len(latencias),
+        "erros": erros,
+        "rps": round(len(latencias) / duracao, 1),
+        "media_ms": round(sum(latencias) / len(latencias), 3),
+        "p50_ms": round(percentil(latencias, 50), 3),
+        "p95_ms": round(percentil(latencias, 95), 3),
+        "p99_ms": round(percentil(latencias, 99), 3),
+    }
+
+
+async def main(args):
+    # The app reads its configuration at import time
+    os.environ["STORAGE_BACKEND"] = args.storage
+    os.environ["MONGO_URL"] = args.mongo_url
+    os.environ["DB_NAME"] = args.db_name
+    sqlite_path = Path(tempfile.gettempdir()) / f"{args.db_name}.db"
+    os.environ["SQLITE_PATH"] = str(sqlite_path)
+    import server
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        porta = sock.getsockname()[1]
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=porta, log_level="warning"))
+    tarefa = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        inicio_seed = time.perf_counter()
+        disciplinas, segunda = await seed(server, args)
+        seed_segundos = time.perf_counter() - inicio_seed
+
+        relatorio = {
+            "gerado_em": datetime.utcnow().isoformat(),
+            "config": {
+                "storage": args.storage,
+                "sessoes": args.sessoes,
+                "semanas": args.semanas,
+                "tarefas_por_dia": args.tarefas,
+                "concorrencia": args.concorrencia,
+                "requisicoes_por_rota": args.requisicoes,
+            },
+            "seed_segundos": round(seed_segundos, 2),
+            "rotas": {},
+        }
+        limites = httpx.Limits(max_connections=args.concorrencia)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{porta}/api", limits=limites, timeout=60) as client:
+            for nome, gerar_requisicao in rotas(disciplinas, segunda).items():
+                relatorio["rotas"][nome] = await run_route(client, gerar_requisicao, args)
+                print(f"{nome:<28} {relatorio['rotas'][nome]}", file=sys.stderr)
+    finally:
+        if not args.manter:
+            await server.storage.descartar()
+        uvicorn_server.should_exit = True
+        await tarefa
+        if args.storage == "sqlite" and not args.manter:
+            # The shutdown closed the connection; the WAL and shared-memory files go with the database
+            for arquivo in (sqlite_path, Path(f"{sqlite_path}-wal"), Path(f"{sqlite_path}-shm")):
+                arquivo.unlink(missing_ok=True)
+
+    saida = json.dumps(relatorio, indent=2)
+    if args.saida:
+        Path(args.saida).write_text(saida + "\n")
+    else:
+        print(saida)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Serialization micro-benchmark for Sistema de Planejamento de Estudos
+Compares per-request CPU of the old response path (serialize_obj + pydantic
+revalidation + response_model) with the MongoJSONResponse fast path for
+/disciplinas, /desempenho and /timer/sessoes. No MongoDB needed: the documents
+are synthesized in the shape Motor returns them.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+from datetime import datetime, date, timedelta
+from pathlib import Path
+from typing import List
+
+from bson import ObjectId
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+
+import server  # noqa: E402
+from server import (  # noqa: E402
+    DISCIPLINAS_BRASILEIRAS, DIAS_SEMANA, Disciplina, DesempenhoSemanal,
+    MongoJSONResponse, serialize_obj,
+)
+
+
+def fake_disciplinas():
+    return [
+        {"_id": ObjectId(), **Disciplina(**disc, horario_inicio="09:00", horario_fim="10:30").dict()}
+        for disc in DISCIPLINAS_BRASILEIRAS
+    ]
+
+
+def fake_desempenhos(semanas, tarefas_por_dia):
+    segunda = date.today() - timedelta(days=date.today().weekday())
+    desempenhos = []
+    for semana in range(semanas):
+        documento = {
+            "_id": ObjectId(),
+            "id": str(uuid.uuid4()),
+            "semana_inicio": (segunda - timedelta(weeks=semana)).isoformat(),
+            "criado_em": datetime.utcnow(),
+        }
+        for dia in DIAS_SEMANA:
+            documento[dia] = [
+                {"id": str(uuid.uuid4()), "horario": "09:00", "descricao": f"Tarefa {i}", "concluida": i % 2 == 0}
+                for i in range(tarefas_por_dia)
+            ]
+        desempenhos.append(documento)
+    return desempenhos
+
+
+def fake_sessoes(quantidade):
+    agora = datetime.utcnow()
+    disciplina_id = str(uuid.uuid4())
+    sessoes = []
+    for i in range(quantidade):
+        inicio = agora - timedelta(hours=i + 1)
+        sessoes.append({
+            "_id": ObjectId(),
+            "id": str(uuid.uuid4()),
+            "disciplina_id": disciplina_id,
+            "inicio": inicio,
+            "fim": inicio + timedelta(minutes=45),
+            "duracao_segundos": 2700,
+            "ativa": False,
+            "criado_em": inicio,
+        })
+    return sessoes
+
+
+async def old_response(documentos, model, response_type):
+    """What the handlers used to do for every request"""
+    content = [model(**serialize_obj(d)) for d in documentos] if model else [serialize_obj(d) for d in documentos]
+    field = create_response_field(name="Response", type_=response_type) if response_type else None
+    return JSONResponse(await serialize_response(field=field, response_content=content, is_coroutine=True)).body
+
+
+async def new_response(documentos):
+    """Fast path: documents already projected without _id, encoded once"""
+    return MongoJSONResponse(documentos).body
+
+
+def projected(documentos):
+    return [{k: v for k, v in d.items() if k != "_id"} for d in documentos]
+
+
+async def measure(coro_factory, iteracoes):
+    await coro_factory()  # warm-up
+    inicio = time.process_time()
+    for _ in range(iteracoes):
+        await coro_factory()
+    return (time.process_time() - inicio) / iteracoes * 1e6
+
+
+async def main(args):
+    disciplinas = fake_disciplinas()
+    desempenhos = fake_desempenhos(args.semanas, args.tarefas)
+    sessoes = fake_sessoes(args.sessoes)
+
+    rotas = [
+        ("/disciplinas", disciplinas, Disciplina, List[Disciplina]),
+        ("/desempenho", desempenhos, DesempenhoSemanal, List[DesempenhoSemanal]),
+        ("/timer/sessoes", sessoes, None, None),
+    ]
+
+    print("=" * 72)
+    print(f"{'route':<18}{'docs':>8}{'before (us/req)':>18}{'after (us/req)':>17}{'speedup':>11}")
+    print("=" * 72)
+    for rota, documentos, model, response_type in rotas:
+        sem_id = projected(documentos)
+        antes = await measure(lambda: old_response(documentos, model, response_type), args.iteracoes)
+        depois = await measure(lambda: new_response(sem_id), args.iteracoes)
+        print(f"{rota:<18}{len(documentos):>8}{antes:>18.1f}{depois:>17.1f}{antes / depois:>10.1f}x")
+
+    # /disciplinas is served from the catalog's pre-encoded body once it is loaded
+    corpo = server.encode_json(projected(disciplinas))
+    cached = await measure(lambda: asyncio.sleep(0, corpo), args.iteracoes)
+    print(f"{'/disciplinas*':<18}{len(disciplinas):>8}{'':>18}{cached:>17.1f}")
+    print("* pre-encoded catalog body, per-request cost once the cache is warm")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iteracoes", type=int, default=200, help="requests simulated per route")
+    parser.add_argument("--semanas", type=int, default=52, help="weekly performance documents")
+    parser.add_argument("--tarefas", type=int, default=5, help="tasks per day in each week")
+    parser.add_argument("--sessoes", type=int, default=100, help="sessions in one history page")
+    asyncio.run(main(parser.parse_args()))
@@ -2,16 +2,96 @@
 """
 Backend API Testing for Sistema de Planejamento de Estudos
 Testing cronometer functionality and core APIs
+
+By default the app is started in-process on the embedded in-memory store, so the suite
+runs in seconds without external services. Set BACKEND_URL (e.g.
+https://<host>/api) to test a deployed backend instead. The repository-level tests also
+run on MongoDB when a mongod answers at MONGO_TEST_URL (default mongodb://localhost:27017).
 """
 
+import asyncio
+import os
 import requests
 import json
+import socket
+import threading
 import time
+import uuid
 from datetime import datetime, date, timedelta
+from pathlib import Path
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+
+def start_local_backend():
+    """Serve the app on a loopback port with the memory backend; returns its /api URL"""
+    # The app reads its configuration at import time
+    os.environ["STORAGE_BACKEND"] = "memory"
+    # Tenant tests send X-Usuario-Id themselves, standing in for the authenticating proxy
+    os.environ["TRUST_USER_HEADER"] = "1"
+    os.environ.setdefault("ADMIN_TOKEN", uuid.uuid4().hex)
+    sys.path.insert(0, str(BACKEND_DIR))
+    import uvicorn
+    import server
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        porta = sock.getsockname()[1]
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=porta, log_level="warning"))
+    threading.Thread(target=uvicorn_server.run, daemon=True).start()
+    while not uvicorn_server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{porta}/api"
+
+
+BASE_URL = os.environ.get("BACKEND_URL")
+
+# Repository-level tests also run on MongoDB when a mongod answers here (a throwaway database each time)
+MONGO_TEST_URL = os.environ.get("MONGO_TEST_URL", "mongodb://localhost:27017")
+
+
+def executar_nos_storages(teste, semear_legado=None):
+    """Run the coroutine function `teste(storage)` on a fresh in-memory store and on MongoDB
+
+    `semear_legado(storage)`, if given, writes to MongoDB before inicializar, as an older version would have.
+    Returns the results by backend; MongoDB is left out when no mongod is reachable at MONGO_TEST_URL.
+    """
+    if str(BACKEND_DIR) not in sys.path:
+        sys.path.insert(0, str(BACKEND_DIR))
+    from pymongo.errors import PyMongoError
+    from storage import criar_storage
+
+    async def executar(backend):
+        if backend == "mongo":
+            storage = criar_storage("mongo", MONGO_TEST_URL, f"teste_{uuid.uuid4().hex[:12]}",
+                                    serverSelectionTimeoutMS=2000)
+            try:
+                await storage.client.admin.command("ping")
+            except PyMongoError:
+                storage.fechar()
+                return None
+            if semear_legado:
+                await semear_legado(storage)
+        else:
+            storage = criar_storage(backend)
+        try:
+            await storage.inicializar()
+            return await teste(storage)
+        finally:
+            await storage.descartar()
+            storage.fechar()
+
+    resultados = {}
+    for backend in ("memory", "mongo"):
+        resultado = asyncio.run(executar(backend))
+        if resultado is not None:
+            resultados[backend] = resultado
+    if "mongo" not in resultados:
+        print(f"   ⏭️  No mongod at {MONGO_TEST_URL}: MongoDB run skipped")
+    return resultados
 
-# Backend URL from frontend/.env
-BASE_URL = "https://bf6a573c-fdd6-4816-9055-84687664cdb9.preview.emergentagent.com/api"
 
 class BackendTester:
     def __init__(self):
@@ -19,6 +99,8 @@ class BackendTester:
         self.session = requests.Session()
         self.test_results = []
         self.disciplina_test_id = None
+        # Admin routes need X-Admin-Token; start_local_backend sets ADMIN_TOKEN for the in-process app
+        self.admin_headers = {"X-Admin-Token": os.environ.get("ADMIN_TOKEN", "")}
         
     def log_test(self, test_name, success, message, details=None):
         """Log test results"""
@@ -53,6 +135,28 @@ class BackendTester:
             self.log_test("API Root", False, f"Connection error: {str(e)}")
             return False
     
+    def test_health_probes(self):
+        """Test GET /api/health/live and /api/health/ready - Container probes"""
+        try:
+            live = self.session.get(f"{self.base_url}/health/live")
+            ready = self.session.get(f"{self.base_url}/health/ready")
+            if live.status_code != 200 or ready.status_code != 200:
+                self.log_test("Health Probes", False, f"live HTTP {live.status_code}, ready HTTP {ready.status_code}: {ready.text}")
+                return False
+            
+            data = ready.json()
+            fases = data.get("inicializacao", {}).get("fases_ms", {})
+            if data.get("status") == "ok" and data.get("storage", {}).get("indices_ausentes") == [] and \
+                    set(fases) == {"storage", "disciplinas", "catalogo", "rollups"}:
+                self.log_test("Health Probes", True, f"Ready on {data['backend']}, startup {data['inicializacao']['total_ms']} ms")
+                return True
+            else:
+                self.log_test("Health Probes", False, f"Unexpected readiness report: {data}")
+                return False
+        except Exception as e:
+            self.log_test("Health Probes", False, f"Error: {str(e)}")
+            return False
+    
     def test_get_disciplinas(self):
         """Test GET /api/disciplinas - Should return 19 Brazilian law disciplines"""
         try:
@@ -126,6 +230,35 @@ class BackendTester:
             self.log_test("PUT Disciplina", False, f"Error: {str(e)}")
             return False
     
+    def test_bulk_update_disciplinas(self):
+        """Test PUT /api/disciplinas - Many schedule changes in one request with per-item results"""
+        try:
+            usuario = {"X-Usuario-Id": f"horarios-{uuid.uuid4().hex[:8]}"}
+            disciplinas = self.session.get(f"{self.base_url}/disciplinas", headers=usuario).json()
+            response = self.session.put(f"{self.base_url}/disciplinas", headers=usuario, json=[
+                {"id": disciplinas[0]["id"], "horario_inicio": "08:00", "horario_fim": "09:00"},
+                {"id": disciplinas[1]["id"], "horario_inicio": "25:00"},
+                {"id": str(uuid.uuid4()), "horario_inicio": "08:00"},
+            ])
+            status = [r["status"] for r in response.json()["resultados"]]
+            # HH:MM is checked only in the bulk endpoint; the single PUT stores what it is sent, as before
+            unica = self.session.put(f"{self.base_url}/disciplinas/{disciplinas[2]['id']}", headers=usuario,
+                                     json={"horario_inicio": "8h"})
+            catalogo = {d["id"]: d for d in self.session.get(f"{self.base_url}/disciplinas", headers=usuario).json()}
+            
+            if status == ["atualizada", "invalida", "nao_encontrada"] \
+                    and unica.status_code == 200 and catalogo[disciplinas[2]["id"]]["horario_inicio"] == "8h" \
+                    and catalogo[disciplinas[0]["id"]]["horario_fim"] == "09:00" \
+                    and catalogo[disciplinas[1]["id"]]["horario_inicio"] is None:
+                self.log_test("PUT Disciplinas (bulk)", True, "Per-item results and catalog refreshed")
+                return True
+            else:
+                self.log_test("PUT Disciplinas (bulk)", False, f"Unexpected results: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("PUT Disciplinas (bulk)", False, f"Error: {str(e)}")
+            return False
+    
     def test_desempenho_semanal(self):
         """Test GET /api/desempenho/{week} - Weekly performance tracking"""
         try:
@@ -151,6 +284,200 @@ class BackendTester:
             self.log_test("GET Desempenho Semanal", False, f"Error: {str(e)}")
             return False
     
+    def test_task_level_writes(self):
+        """Test POST/PATCH/DELETE /api/desempenho/{week}/{day}/tarefas - Single-task writes"""
+        try:
+            today = date.today()
+            week_str = (today - timedelta(days=today.weekday())).strftime("%Y-%m-%d")
+            tarefas_url = f"{self.base_url}/desempenho/{week_str}/segunda/tarefas"
+            
+            response = self.session.post(tarefas_url, json={"horario": "08:00", "descricao": "Revisar súmulas"})
+            if response.status_code != 200:
+                self.log_test("Task-Level Writes", False, f"Add failed: HTTP {response.status_code}: {response.text}")
+                return False
+            tarefa = response.json()
+            
+            response = self.session.patch(f"{tarefas_url}/{tarefa['id']}", json={"concluida": True})
+            if response.status_code != 200 or response.json().get("concluida") != True:
+                self.log_test("Task-Level Writes", False, f"Complete failed: HTTP {response.status_code}: {response.text}")
+                return False
+            
+            semana = self.session.get(f"{self.base_url}/desempenho/{week_str}").json()
+            salva = [t for t in semana.get("segunda", []) if t["id"] == tarefa["id"]]
+            
+            response = self.session.delete(f"{tarefas_url}/{tarefa['id']}")
+            removida = response.status_code == 200 and \
+                self.session.delete(f"{tarefas_url}/{tarefa['id']}").status_code == 404
+            
+            if salva and salva[0]["concluida"] and removida:
+                self.log_test("Task-Level Writes", True, "Task added, completed and removed individually")
+                return True
+            else:
+                self.log_test("Task-Level Writes", False, f"Unexpected task state: {salva}, removed={removida}")
+                return False
+        except Exception as e:
+            self.log_test("Task-Level Writes", False, f"Error: {str(e)}")
+            return False
+    
+    def test_desempenho_range(self):
+        """Test GET /api/desempenho?de=&ate= - Contiguous weeks without write-on-read"""
+        try:
+            # A week far in the future is never written by the other tests
+            week_str = "2099-01-05"
+            response = self.session.get(f"{self.base_url}/desempenho/{week_str}")
+            if response.status_code != 200:
+                self.log_test("Performance Range", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            persistida = any(d["semana_inicio"] == week_str for d in self.session.get(f"{self.base_url}/desempenho").json())
+            
+            response = self.session.get(f"{self.base_url}/desempenho", params={"de": "2098-12-31", "ate": "2099-01-26"})
+            if response.status_code != 200:
+                self.log_test("Performance Range", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            semanas = [d["semana_inicio"] for d in response.json()]
+            esperadas = ["2098-12-29", "2099-01-05", "2099-01-12", "2099-01-19", "2099-01-26"]
+            
+            if not persistida and semanas == esperadas:
+                self.log_test("Performance Range", True, f"{len(semanas)} contiguous weeks, reads not persisted")
+                return True
+            else:
+                self.log_test("Performance Range", False, f"Persisted on read: {persistida}, weeks: {semanas}")
+                return False
+        except Exception as e:
+            self.log_test("Performance Range", False, f"Error: {str(e)}")
+            return False
+    
+    def test_desempenho_statistics(self):
+        """Test GET /api/desempenho/estatisticas - Weekly completion counts"""
+        try:
+            week_str = "2099-02-02"
+            tarefas_url = f"{self.base_url}/desempenho/{week_str}/quarta/tarefas"
+            feita = self.session.post(tarefas_url, json={"horario": "10:00", "descricao": "Simulado"}).json()
+            self.session.post(tarefas_url, json={"horario": "11:00", "descricao": "Correção"})
+            self.session.patch(f"{tarefas_url}/{feita['id']}", json={"concluida": True})
+            
+            response = self.session.get(f"{self.base_url}/desempenho/estatisticas",
+                                        params={"de": week_str, "ate": week_str, "limite": 1})
+            if response.status_code != 200:
+                self.log_test("Performance Statistics", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            data = response.json()
+            semana = data["semanas"][0] if data.get("semanas") else {}
+            quarta = semana.get("dias", {}).get("quarta", {})
+            
+            if semana.get("semana_inicio") == week_str and quarta.get("total") == 2 and \
+                    quarta.get("concluidas") == 1 and quarta.get("taxa_conclusao") == 0.5 and \
+                    "Simulado" not in response.text and data.get("next_cursor") is None:
+                self.log_test("Performance Statistics", True, f"Week {week_str}: {semana['concluidas']}/{semana['total']} tasks done")
+                return True
+            else:
+                self.log_test("Performance Statistics", False, f"Unexpected statistics: {data}")
+                return False
+        except Exception as e:
+            self.log_test("Performance Statistics", False, f"Error: {str(e)}")
+            return False
+    
+    def test_conditional_get(self):
+        """Test If-None-Match on /disciplinas, /desempenho/{week} and /timer/resumo-semanal"""
+        try:
+            today = date.today()
+            week_str = (today - timedelta(days=today.weekday())).strftime("%Y-%m-%d")
+            urls = [
+                f"{self.base_url}/disciplinas",
+                f"{self.base_url}/desempenho/{week_str}",
+                f"{self.base_url}/timer/resumo-semanal",
+            ]
+            
+            for url in urls:
+                response = self.session.get(url)
+                etag = response.headers.get("etag")
+                if response.status_code != 200 or not etag:
+                    self.log_test("Conditional GET", False, f"No ETag from {url}: HTTP {response.status_code}")
+                    return False
+                revalidado = self.session.get(url, headers={"If-None-Match": etag})
+                if revalidado.status_code != 304 or revalidado.content:
+                    self.log_test("Conditional GET", False, f"Expected empty 304 from {url}, got {revalidado.status_code}")
+                    return False
+            
+            # A write must change the week's ETag
+            etag = self.session.get(urls[1]).headers["etag"]
+            tarefa = self.session.post(f"{self.base_url}/desempenho/{week_str}/domingo/tarefas",
+                                       json={"horario": "18:00", "descricao": "Revisão semanal"}).json()
+            mudou = self.session.get(urls[1], headers={"If-None-Match": etag}).status_code == 200
+            self.session.delete(f"{self.base_url}/desempenho/{week_str}/domingo/tarefas/{tarefa['id']}")
+            
+            if mudou:
+                self.log_test("Conditional GET", True, "304 on unchanged resources, new ETag after a write")
+                return True
+            else:
+                self.log_test("Conditional GET", False, "Week ETag did not change after adding a task")
+                return False
+        except Exception as e:
+            self.log_test("Conditional GET", False, f"Error: {str(e)}")
+            return False
+    
+    def test_tenant_isolation(self):
+        """Test X-Usuario-Id - Each user gets their own seeded catalog, weeks and timers"""
+        try:
+            outro = {"X-Usuario-Id": f"teste-{uuid.uuid4().hex[:8]}"}
+            proprias = self.session.get(f"{self.base_url}/disciplinas", headers=outro).json()
+            padrao = self.session.get(f"{self.base_url}/disciplinas").json()
+            if len(proprias) != 19 or {d["id"] for d in proprias} & {d["id"] for d in padrao}:
+                self.log_test("Tenant Isolation", False, f"Catalog not seeded per user: {len(proprias)} disciplines")
+                return False
+            
+            week_str = "2099-03-02"
+            self.session.post(f"{self.base_url}/desempenho/{week_str}/segunda/tarefas",
+                              json={"horario": "08:00", "descricao": "Tarefa de outro usuário"}, headers=outro)
+            do_outro = self.session.get(f"{self.base_url}/desempenho/{week_str}", headers=outro).json()
+            do_padrao = self.session.get(f"{self.base_url}/desempenho/{week_str}").json()
+            
+            disciplina_id = proprias[0]["id"]
+            self.session.post(f"{self.base_url}/timer/iniciar", json={"disciplina_id": disciplina_id}, headers=outro)
+            visivel = self.session.get(f"{self.base_url}/timer/status/{disciplina_id}").json()["ativo"]
+            parada_alheia = self.session.put(f"{self.base_url}/timer/parar/{disciplina_id}").status_code
+            parada = self.session.put(f"{self.base_url}/timer/parar/{disciplina_id}", headers=outro).status_code
+            invalido = self.session.get(f"{self.base_url}/disciplinas", headers={"X-Usuario-Id": "a/b"}).status_code
+            
+            if len(do_outro["segunda"]) == 1 and not do_padrao["segunda"] and not visivel \
+                    and parada_alheia == 404 and parada == 200 and invalido == 400:
+                self.log_test("Tenant Isolation", True, "Catalog, weeks and timers are scoped by X-Usuario-Id")
+                return True
+            else:
+                self.log_test("Tenant Isolation", False,
+                              f"Leak: weeks {len(do_outro['segunda'])}/{len(do_padrao['segunda'])}, timer visible={visivel}, "
+                              f"stops {parada_alheia}/{parada}, invalid header HTTP {invalido}")
+                return False
+        except Exception as e:
+            self.log_test("Tenant Isolation", False, f"Error: {str(e)}")
+            return False
+    
+    def test_week_etag_per_user(self):
+        """Test GET /api/desempenho/{week} - Identical weeks of two users never share an ETag"""
+        try:
+            usuarios = [{"X-Usuario-Id": f"semana-{uuid.uuid4().hex[:8]}"} for _ in range(2)]
+            url = f"{self.base_url}/desempenho/2024-01-01"
+            etags = []
+            for usuario in usuarios:
+                self.session.post(f"{url}/segunda/tarefas", json={"horario": "08:00", "descricao": "Leitura"},
+                                  headers=usuario)
+                etags.append(self.session.get(url, headers=usuario).headers["etag"])
+            # Bob revalidating with Alice's ETag must get his own week back
+            revalidado = self.session.get(url, headers={**usuarios[1], "If-None-Match": etags[0]})
+            vazias = [self.session.get(f"{self.base_url}/desempenho/2099-01-05", headers=usuario).headers["etag"]
+                      for usuario in usuarios]
+            
+            if etags[0] != etags[1] and revalidado.status_code == 200 and vazias[0] != vazias[1]:
+                self.log_test("Week ETag Per User", True, "Same week of two users gets distinct ETags")
+                return True
+            else:
+                self.log_test("Week ETag Per User", False, "Weeks of different users share an ETag",
+                              {"etags": etags, "revalidado": revalidado.status_code, "vazias": vazias})
+                return False
+        except Exception as e:
+            self.log_test("Week ETag Per User", False, f"Error: {str(e)}")
+            return False
+    
     def test_cronometer_start(self):
         """Test POST /api/timer/iniciar - Start study timer for discipline"""
         if not self.disciplina_test_id:
@@ -213,6 +540,39 @@ class BackendTester:
             self.log_test("GET Timer Status", False, f"Error: {str(e)}")
             return False
     
+    def test_cronometer_status_batch(self):
+        """Test GET /api/timer/status - Timer status for every discipline in one call"""
+        if not self.disciplina_test_id:
+            self.log_test("GET Timer Status Batch", False, "No discipline ID available for testing")
+            return False
+        
+        try:
+            response = self.session.get(f"{self.base_url}/timer/status")
+            
+            if response.status_code == 200:
+                statuses = response.json()
+                status = statuses.get(self.disciplina_test_id, {})
+                if len(statuses) >= 19 and status.get("ativo") == True and "duracao_atual_segundos" in status:
+                    self.log_test("GET Timer Status Batch", True, f"Batch status returned {len(statuses)} disciplines")
+                else:
+                    self.log_test("GET Timer Status Batch", False, f"Unexpected batch status: {status}")
+                    return False
+            else:
+                self.log_test("GET Timer Status Batch", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            
+            # Restricting to a list of ids
+            response = self.session.get(f"{self.base_url}/timer/status", params={"ids": self.disciplina_test_id})
+            if response.status_code == 200 and list(response.json().keys()) == [self.disciplina_test_id]:
+                self.log_test("GET Timer Status Batch (ids)", True, "Batch status honours the ids filter")
+                return True
+            else:
+                self.log_test("GET Timer Status Batch (ids)", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("GET Timer Status Batch", False, f"Error: {str(e)}")
+            return False
+    
     def test_cronometer_stop(self):
         """Test PUT /api/timer/parar/{disciplina_id} - Stop timer and calculate duration"""
         if not self.disciplina_test_id:
@@ -278,6 +638,210 @@ class BackendTester:
             self.log_test("GET Weekly Summary", False, f"Error: {str(e)}")
             return False
     
+    def test_range_summaries(self):
+        """Test GET /api/timer/resumo-mensal and /api/timer/resumo - Rollup-backed summaries"""
+        try:
+            today = date.today()
+            response = self.session.get(f"{self.base_url}/timer/resumo-mensal", params={"mes": today.strftime("%Y-%m")})
+            if response.status_code != 200 or not isinstance(response.json(), list):
+                self.log_test("GET Monthly Summary", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            
+            params = {"de": (today - timedelta(days=6)).isoformat(), "ate": today.isoformat()}
+            response = self.session.get(f"{self.base_url}/timer/resumo", params=params)
+            if response.status_code != 200:
+                self.log_test("GET Range Summary", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            
+            found = any(item.get("disciplina_id") == self.disciplina_test_id for item in response.json())
+            self.log_test("GET Range Summary", found, f"Range summary includes test discipline: {found}")
+            return found
+        except Exception as e:
+            self.log_test("GET Range Summary", False, f"Error: {str(e)}")
+            return False
+    
+    def test_rollup_consistency(self):
+        """Test GET /api/admin/rollups/verificar - Rollups match the raw sessions"""
+        try:
+            response = self.session.get(f"{self.base_url}/admin/rollups/verificar")
+            
+            if response.status_code == 200:
+                relatorio = response.json()
+                if relatorio.get("consistente"):
+                    self.log_test("Rollup Consistency", True,
+                                  f"{relatorio.get('dias_verificados')} discipline-days consistent")
+                    return True
+                else:
+                    self.log_test("Rollup Consistency", False, "Rollups diverge from sessions",
+                                  relatorio.get("divergencias"))
+                    return False
+            else:
+                self.log_test("Rollup Consistency", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("Rollup Consistency", False, f"Error: {str(e)}")
+            return False
+    
+    def test_rollup_rebuild(self):
+        """Test POST /api/admin/rollups/reconstruir - Admin only; a rebuild also drops days with no sessions left"""
+        async def reconstruir(storage):
+            usuario = storage.do_usuario(f"rollups-{uuid.uuid4().hex[:8]}")
+            inicio = datetime(2024, 1, 1, 8)
+            await usuario.sessoes.upsert_muitos([{
+                "id": str(uuid.uuid4()), "disciplina_id": "d0", "inicio": inicio,
+                "fim": inicio + timedelta(minutes=10), "ativa": False, "duracao_segundos": 600,
+            }])
+            # A wrong total for the real day and a day whose sessions are gone
+            await usuario.rollups.incrementar_muitos([
+                {"disciplina_id": "d0", "dia": "2024-01-01", "total_segundos": 9999, "sessoes": 3},
+                {"disciplina_id": "d0", "dia": "2024-01-05", "total_segundos": 300, "sessoes": 1},
+            ])
+            await usuario.rollups.reconstruir()
+            return [(r["dia"], r["total_segundos"], r["sessoes"])
+                    for r in await usuario.rollups.listar("2024-01-01", "2024-01-31")]
+        
+        try:
+            usuario = {"X-Usuario-Id": f"rollups-{uuid.uuid4().hex[:8]}"}
+            url = f"{self.base_url}/admin/rollups/reconstruir"
+            sem_token = self.session.post(url, headers=usuario).status_code
+            com_token = self.session.post(url, headers={**usuario, **self.admin_headers}).status_code
+            resultados = executar_nos_storages(reconstruir)
+            errados = {backend: r for backend, r in resultados.items() if r != [("2024-01-01", 600, 1)]}
+            
+            if sem_token == 403 and com_token == 200 and not errados:
+                self.log_test("Rollup Rebuild", True,
+                              f"Rebuild is admin only and drops phantom days ({', '.join(resultados)})")
+                return True
+            else:
+                self.log_test("Rollup Rebuild", False, "Rebuild unprotected or left phantom totals",
+                              {"sem_token": sem_token, "com_token": com_token, "rollups": errados})
+                return False
+        except Exception as e:
+            self.log_test("Rollup Rebuild", False, f"Error: {str(e)}")
+            return False
+    
+    def test_analytics(self):
+        """Test GET /api/analytics/* - Sessions split across day/week boundaries, streaks and memoization"""
+        try:
+            usuario = {"X-Usuario-Id": f"analytics-{uuid.uuid4().hex[:8]}"}
+            disciplinas = self.session.get(f"{self.base_url}/disciplinas", headers=usuario).json()
+            # 23:00-01:00 across a day boundary and Sunday 23:30 - Monday 00:30 across a week boundary
+            sessoes = [
+                (disciplinas[0]["id"], "2024-01-01T23:00:00", "2024-01-02T01:00:00", 7200),
+                (disciplinas[1]["id"], "2024-01-07T23:30:00", "2024-01-08T00:30:00", 3600),
+            ]
+            corpo = "\n".join(json.dumps({"colecao": "sessoes_estudo", "documento": {
+                "id": str(uuid.uuid4()), "disciplina_id": disciplina_id, "inicio": inicio, "fim": fim,
+                "duracao_segundos": duracao, "ativa": False,
+            }}) for disciplina_id, inicio, fim, duracao in sessoes)
+            self.session.post(f"{self.base_url}/import", data=corpo, headers=usuario)
+            
+            intervalo = {"de": "2024-01-01", "ate": "2024-01-14"}
+            por_dia = self.session.get(f"{self.base_url}/analytics/distribuicao", params=intervalo, headers=usuario).json()
+            por_semana = self.session.get(f"{self.base_url}/analytics/distribuicao", params={**intervalo, "por": "semana"},
+                                          headers=usuario).json()
+            sequencias = self.session.get(f"{self.base_url}/analytics/sequencias", params=intervalo, headers=usuario).json()
+            heatmap = self.session.get(f"{self.base_url}/analytics/heatmap", params=intervalo, headers=usuario)
+            medias = self.session.get(f"{self.base_url}/analytics/medias", params=intervalo, headers=usuario)
+            memo = self.session.get(f"{self.base_url}/admin/cache", headers=usuario).json()["analytics"]
+            
+            dias_ok = por_dia["totais_segundos"][:8] == [3600, 3600, 0, 0, 0, 0, 1800, 1800]
+            semanas_ok = por_semana["periodos"] == ["2024-01-01", "2024-01-08"] and por_semana["totais_segundos"] == [9000, 1800]
+            if dias_ok and semanas_ok and sequencias["maior"]["dias"] == 2 and heatmap.status_code == 200 \
+                    and len(medias.json()["disciplinas"]) == 2 and memo["hits"] > 0 \
+                    and 0 < memo["bytes"] <= memo["maximo_bytes"]:
+                self.log_test("Study Analytics", True, f"Boundary splits, streaks and trends OK (memo hit rate {memo['hit_rate']})")
+                return True
+            else:
+                self.log_test("Study Analytics", False,
+                              f"Days {por_dia['totais_segundos'][:8]}, weeks {por_semana['totais_segundos']}, "
+                              f"streak {sequencias['maior']}, memo {memo}")
+                return False
+        except Exception as e:
+            self.log_test("Study Analytics", False, f"Error: {str(e)}")
+            return False
+    
+    def test_session_history_pagination(self):
+        """Test GET /api/timer/sessoes/{id} - Keyset pagination and NDJSON streaming"""
+        if not self.disciplina_test_id:
+            self.log_test("GET Session History", False, "No discipline ID available for testing")
+            return False
+        
+        try:
+            url = f"{self.base_url}/timer/sessoes/{self.disciplina_test_id}"
+            paginadas = []
+            cursor = None
+            while True:
+                params = {"limite": 1}
+                if cursor:
+                    params["cursor"] = cursor
+                response = self.session.get(url, params=params)
+                if response.status_code != 200:
+                    self.log_test("GET Session History", False, f"HTTP {response.status_code}: {response.text}")
+                    return False
+                page = response.json()
+                paginadas.extend(sessao["id"] for sessao in page["sessoes"])
+                cursor = page.get("next_cursor")
+                if not cursor:
+                    break
+            
+            response = self.session.get(url, headers={"Accept": "application/x-ndjson"})
+            transmitidas = [json.loads(linha)["id"] for linha in response.text.splitlines() if linha]
+            
+            if paginadas and paginadas == transmitidas and len(set(paginadas)) == len(paginadas):
+                self.log_test("GET Session History", True,
+                              f"{len(paginadas)} sessions paged one at a time match the NDJSON stream")
+                return True
+            else:
+                self.log_test("GET Session History", False, "Paged and streamed histories differ",
+                              {"paginadas": paginadas, "transmitidas": transmitidas})
+                return False
+        except Exception as e:
+            self.log_test("GET Session History", False, f"Error: {str(e)}")
+            return False
+    
+    def read_sse_event(self, headers=None):
+        """Open /timer/stream and return the first (event, id, data) it sends"""
+        with self.session.get(f"{self.base_url}/timer/stream", headers=headers or {}, stream=True, timeout=30) as response:
+            evento = {}
+            for linha in response.iter_lines(decode_unicode=True):
+                if not linha:
+                    if "event" in evento:
+                        return evento.get("event"), evento.get("id"), json.loads(evento.get("data", "null"))
+                    continue
+                if linha.startswith(":"):
+                    continue
+                campo, _, valor = linha.partition(": ")
+                evento[campo] = valor
+        return None, None, None
+    
+    def test_timer_stream(self):
+        """Test GET /api/timer/stream - SSE snapshot and Last-Event-ID resume"""
+        if not self.disciplina_test_id:
+            self.log_test("SSE Timer Stream", False, "No discipline ID available for testing")
+            return False
+        
+        try:
+            evento, evento_id, dados = self.read_sse_event()
+            if evento != "snapshot" or self.disciplina_test_id not in dados:
+                self.log_test("SSE Timer Stream", False, f"Expected a snapshot event, got {evento}: {dados}")
+                return False
+            
+            # Events published while disconnected are replayed after Last-Event-ID
+            self.session.post(f"{self.base_url}/timer/iniciar", json={"disciplina_id": self.disciplina_test_id})
+            evento, _, dados = self.read_sse_event({"Last-Event-ID": evento_id})
+            self.session.put(f"{self.base_url}/timer/parar/{self.disciplina_test_id}")
+            
+            if evento == "timer" and dados.get("disciplina_id") == self.disciplina_test_id and dados.get("ativo"):
+                self.log_test("SSE Timer Stream", True, "Snapshot received and missed start event replayed")
+                return True
+            else:
+                self.log_test("SSE Timer Stream", False, f"Unexpected resumed event {evento}: {dados}")
+                return False
+        except Exception as e:
+            self.log_test("SSE Timer Stream", False, f"Error: {str(e)}")
+            return False
+    
     def test_prevent_overlapping_sessions(self):
         """Test that multiple disciplines can't have overlapping active sessions"""
         if not self.disciplina_test_id:
@@ -325,6 +889,590 @@ class BackendTester:
             self.log_test("Overlapping Sessions Prevention", False, f"Error: {str(e)}")
             return False
     
+    def test_catalog_cache(self):
+        """Test GET /api/admin/cache - Discipline reads are served from the in-memory catalog"""
+        try:
+            # Warm the catalog first: earlier writes (e.g. the import test) invalidate it
+            self.session.get(f"{self.base_url}/disciplinas")
+            antes = self.session.get(f"{self.base_url}/admin/cache").json()["catalogo_disciplinas"]
+            self.session.get(f"{self.base_url}/disciplinas")
+            depois = self.session.get(f"{self.base_url}/admin/cache").json()["catalogo_disciplinas"]
+            
+            if depois["hits"] > antes["hits"] and depois["disciplinas"] >= 19:
+                self.log_test("Discipline Catalog Cache", True,
+                              f"Catalog hits {antes['hits']} -> {depois['hits']} (version {depois['versao']})")
+                return True
+            else:
+                self.log_test("Discipline Catalog Cache", False, f"Cache counters did not move: {antes} -> {depois}")
+                return False
+        except Exception as e:
+            self.log_test("Discipline Catalog Cache", False, f"Error: {str(e)}")
+            return False
+    
+    def test_export_import_roundtrip(self):
+        """Test GET /api/export and POST /api/import - NDJSON round trip is idempotent"""
+        try:
+            response = self.session.get(f"{self.base_url}/export", params={"colecoes": "disciplinas"}, stream=True)
+            if response.status_code != 200:
+                self.log_test("Export/Import Round Trip", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            corpo = response.content
+            linhas = [json.loads(linha) for linha in corpo.decode().splitlines() if linha]
+            exportados = [linha for linha in linhas if "documento" in linha]
+            
+            response = self.session.post(f"{self.base_url}/import", data=corpo,
+                                         headers={"Content-Type": "application/x-ndjson"})
+            if response.status_code != 200:
+                self.log_test("Export/Import Round Trip", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            
+            resultado = response.json()
+            total_disciplinas = len(self.session.get(f"{self.base_url}/disciplinas").json())
+            if resultado["importados"]["disciplinas"] == len(exportados) == total_disciplinas:
+                self.log_test("Export/Import Round Trip", True,
+                              f"{len(exportados)} disciplines re-imported at {resultado.get('docs_por_segundo')} docs/s")
+                return True
+            else:
+                self.log_test("Export/Import Round Trip", False,
+                              f"Exported {len(exportados)}, imported {resultado['importados']}, now {total_disciplinas}")
+                return False
+        except Exception as e:
+            self.log_test("Export/Import Round Trip", False, f"Error: {str(e)}")
+            return False
+    
+    def test_import_errors(self):
+        """Test POST /api/import - UTF-8 split across chunks decodes, a rejected batch is reported"""
+        try:
+            usuario = {"X-Usuario-Id": f"importacao-{uuid.uuid4().hex[:8]}", "Content-Type": "application/x-ndjson"}
+            nome = f"Matemática {uuid.uuid4().hex[:6]}"
+            linha = json.dumps({"colecao": "disciplinas", "documento": {
+                "id": str(uuid.uuid4()), "nome": nome, "cor": "#123456",
+                "criado_em": datetime.utcnow().isoformat(),
+            }}, ensure_ascii=False).encode() + b"\n"
+            # Chunked upload cut in the middle of the two-byte "á"
+            corte = linha.index("á".encode()) + 1
+            importacao = self.session.post(f"{self.base_url}/import", data=iter([linha[:corte], linha[corte:]]),
+                                           headers=usuario)
+            nomes = [d["nome"] for d in self.session.get(f"{self.base_url}/disciplinas", headers=usuario).json()]
+            
+            # Same name under another id: usuario_nome_unico rejects the batch
+            repetida = linha.replace(json.loads(linha)["documento"]["id"].encode(), str(uuid.uuid4()).encode())
+            recusada = self.session.post(f"{self.base_url}/import", data=repetida, headers=usuario)
+            
+            if importacao.status_code == 200 and nome in nomes and recusada.status_code == 409 \
+                    and "Lote 1 de disciplinas" in recusada.json()["detail"]:
+                self.log_test("Import Errors", True, "Split UTF-8 decoded, rejected batch reported as 409")
+                return True
+            else:
+                self.log_test("Import Errors", False, "Unexpected import responses",
+                              {"importacao": importacao.text, "nomes": nomes, "recusada": recusada.text})
+                return False
+        except Exception as e:
+            self.log_test("Import Errors", False, f"Error: {str(e)}")
+            return False
+    
+    def test_index_plans(self):
+        """Test GET /api/admin/indices - Manifest indexes exist and no canonical query does a COLLSCAN"""
+        try:
+            sem_token = self.session.get(f"{self.base_url}/admin/indices").status_code
+            if sem_token != 403:
+                self.log_test("Index Explain Plans", False, f"Index report served without the admin token: {sem_token}")
+                return False
+            response = self.session.get(f"{self.base_url}/admin/indices", headers=self.admin_headers)
+            
+            if response.status_code == 200:
+                relatorio = response.json()
+                if relatorio.get("ausentes"):
+                    self.log_test("Index Manifest", False, f"Missing indexes: {relatorio['ausentes']}")
+                    return False
+                
+                collscans = [nome for nome, plano in relatorio.get("planos", {}).items() if plano.get("collscan")]
+                if collscans:
+                    self.log_test("Index Explain Plans", False, f"Queries falling back to COLLSCAN: {collscans}")
+                    return False
+                
+                self.log_test("Index Explain Plans", True,
+                              f"{len(relatorio.get('planos', {}))} canonical queries use indexes")
+                return True
+            else:
+                self.log_test("Index Explain Plans", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+        except Exception as e:
+            self.log_test("Index Explain Plans", False, f"Error: {str(e)}")
+            return False
+    
+    def test_storage_index_plans(self):
+        """Test Storage.verificar_indices on every backend - A MongoDB query falling back to COLLSCAN fails the run"""
+        async def relatorio(storage):
+            return await storage.verificar_indices()
+        
+        try:
+            relatorios = executar_nos_storages(relatorio)
+            falhas = {
+                backend: {"ausentes": r["ausentes"],
+                          "collscan": [nome for nome, plano in r["planos"].items() if plano["collscan"]]}
+                for backend, r in relatorios.items()
+                if r["ausentes"] or any(plano["collscan"] for plano in r["planos"].values())
+            }
+            if not falhas:
+                self.log_test("Storage Index Plans", True,
+                              ", ".join(f"{backend}: {len(r['planos'])} canonical queries use indexes"
+                                        for backend, r in relatorios.items()))
+                return True
+            else:
+                self.log_test("Storage Index Plans", False, "Missing indexes or COLLSCAN plans", falhas)
+                return False
+        except Exception as e:
+            self.log_test("Storage Index Plans", False, f"Error: {str(e)}")
+            return False
+    
+    def test_metrics(self):
+        """Test GET /api/metrics - Prometheus exposition with per-route latency"""
+        try:
+            self.session.get(f"{self.base_url}/timer/resumo-semanal")
+            response = self.session.get(f"{self.base_url}/metrics")
+            if response.status_code != 200:
+                self.log_test("Prometheus Metrics", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            
+            linha = 'http_request_duration_seconds_count{method="GET",route="/api/timer/resumo-semanal"}'
+            if response.headers.get("content-type", "").startswith("text/plain") and linha in response.text \
+                    and "http_requests_in_progress" in response.text:
+                self.log_test("Prometheus Metrics", True, "Per-route latency histogram exposed")
+                return True
+            else:
+                self.log_test("Prometheus Metrics", False, f"Missing series in: {response.text[:300]}")
+                return False
+        except Exception as e:
+            self.log_test("Prometheus Metrics", False, f"Error: {str(e)}")
+            return False
+    
+    def test_diagnostics(self):
+        """Test GET /api/admin/perfis and /api/admin/consultas-lentas - Opt-in diagnostics, admin only"""
+        try:
+            # They expose every tenant's queries, so they need the admin token
+            sem_token = [self.session.get(f"{self.base_url}/admin/{rota}").status_code
+                         for rota in ("perfis", f"perfis/{uuid.uuid4()}", "consultas-lentas")]
+            perfis = self.session.get(f"{self.base_url}/admin/perfis", headers=self.admin_headers)
+            lentas = self.session.get(f"{self.base_url}/admin/consultas-lentas", headers=self.admin_headers)
+            ausente = self.session.get(f"{self.base_url}/admin/perfis/{uuid.uuid4()}", headers=self.admin_headers)
+            
+            if sem_token == [403, 403, 403] and \
+                    perfis.status_code == 200 and isinstance(perfis.json().get("perfis"), list) and \
+                    lentas.status_code == 200 and isinstance(lentas.json().get("consultas"), list) and \
+                    ausente.status_code == 404:
+                self.log_test("Diagnostics Endpoints", True,
+                              f"Profiling enabled: {perfis.json()['habilitado']}, slow log enabled: {lentas.json()['habilitado']}")
+                return True
+            else:
+                self.log_test("Diagnostics Endpoints", False,
+                              f"HTTP {perfis.status_code}/{lentas.status_code}/{ausente.status_code}, "
+                              f"without token {sem_token}")
+                return False
+        except Exception as e:
+            self.log_test("Diagnostics Endpoints", False, f"Error: {str(e)}")
+            return False
+    
+    def test_concurrent_start_stop(self):
+        """Test parallel POST /api/timer/iniciar and PUT /api/timer/parar - Exactly-once semantics"""
+        if not self.disciplina_test_id:
+            self.log_test("Concurrent Start/Stop", False, "No discipline ID available for testing")
+            return False
+        
+        try:
+            tentativas = 10
+            iniciar = lambda _: requests.post(f"{self.base_url}/timer/iniciar",
+                                              json={"disciplina_id": self.disciplina_test_id}).status_code
+            parar = lambda _: requests.put(f"{self.base_url}/timer/parar/{self.disciplina_test_id}").status_code
+            
+            with ThreadPoolExecutor(max_workers=tentativas) as executor:
+                inicios = list(executor.map(iniciar, range(tentativas)))
+                paradas = list(executor.map(parar, range(tentativas)))
+            
+            if (inicios.count(200), inicios.count(400)) == (1, tentativas - 1) and \
+                    (paradas.count(200), paradas.count(404)) == (1, tentativas - 1):
+                self.log_test("Concurrent Start/Stop", True,
+                              f"{tentativas} parallel starts and stops produced exactly one session")
+                return True
+            else:
+                self.log_test("Concurrent Start/Stop", False, "Parallel requests were not exactly-once",
+                              {"inicios": inicios, "paradas": paradas})
+                return False
+        except Exception as e:
+            self.log_test("Concurrent Start/Stop", False, f"Error: {str(e)}")
+            return False
+    
+    def test_concurrent_start_stop_storage(self):
+        """Test SessaoRepository.inserir_ativa and encerrar_ativa - Exactly-once on every backend"""
+        tentativas = 10
+        
+        async def iniciar_e_parar(storage):
+            from storage import SessaoAtivaExistente
+            repo = storage.do_usuario(f"cronometro-{uuid.uuid4().hex[:8]}").sessoes
+            
+            async def iniciar():
+                agora = datetime.utcnow()
+                try:
+                    await repo.inserir_ativa({"id": str(uuid.uuid4()), "disciplina_id": "d0", "inicio": agora,
+                                              "fim": None, "duracao_segundos": None, "ativa": True,
+                                              "criado_em": agora, "visto_em": None})
+                    return "ok"
+                except SessaoAtivaExistente:
+                    return "existente"
+            
+            inicios = await asyncio.gather(*(iniciar() for _ in range(tentativas)))
+            paradas = await asyncio.gather(*(repo.encerrar_ativa("d0") for _ in range(tentativas)))
+            encerradas = [sessao for sessao in paradas if sessao is not None]
+            return {
+                "inicios": (inicios.count("ok"), inicios.count("existente")),
+                "paradas": len(encerradas),
+                "fechada": bool(encerradas) and not encerradas[0]["ativa"] and encerradas[0]["fim"] is not None,
+                "ativa_restante": await repo.obter_ativa("d0"),
+            }
+        
+        try:
+            resultados = executar_nos_storages(iniciar_e_parar)
+            errados = {
+                backend: r for backend, r in resultados.items()
+                if r["inicios"] != (1, tentativas - 1) or r["paradas"] != 1 or not r["fechada"]
+                or r["ativa_restante"] is not None
+            }
+            if not errados:
+                self.log_test("Concurrent Start/Stop Storage", True,
+                              f"{tentativas} simultaneous starts and stops: one session ({', '.join(resultados)})")
+                return True
+            else:
+                self.log_test("Concurrent Start/Stop Storage", False, "Starts or stops were not exactly-once", errados)
+                return False
+        except Exception as e:
+            self.log_test("Concurrent Start/Stop Storage", False, f"Error: {str(e)}")
+            return False
+    
+    def test_offline_sync(self):
+        """Test POST /api/sync - Ordered offline events in one batch, deduplicated on replay"""
+        try:
+            usuario = {"X-Usuario-Id": f"sync-{uuid.uuid4().hex[:8]}"}
+            disciplina_id = self.session.get(f"{self.base_url}/disciplinas", headers=usuario).json()[0]["id"]
+            tarefa = self.session.post(f"{self.base_url}/desempenho/2024-01-01/segunda/tarefas",
+                                       json={"horario": "09:00", "descricao": "Revisão"}, headers=usuario).json()
+            eventos = [
+                {"chave": "e1", "tipo": "iniciar", "em": "2024-01-01T10:00:00Z", "disciplina_id": disciplina_id},
+                {"chave": "e2", "tipo": "parar", "em": "2024-01-01T10:30:00Z", "disciplina_id": disciplina_id},
+                {"chave": "e3", "tipo": "tarefa", "em": "2024-01-01T10:31:00Z", "semana_inicio": "2024-01-01",
+                 "dia": "segunda", "tarefa_id": tarefa["id"]},
+                {"chave": "e4", "tipo": "parar", "em": "2024-01-01T10:32:00Z", "disciplina_id": disciplina_id},
+                {"chave": "e5", "tipo": "iniciar", "em": "2024-01-01T11:00:00Z", "disciplina_id": disciplina_id},
+            ]
+            primeiro = self.session.post(f"{self.base_url}/sync", json={"eventos": eventos}, headers=usuario).json()
+            replay = self.session.post(f"{self.base_url}/sync", json={"eventos": eventos}, headers=usuario).json()
+            resumo = self.session.get(f"{self.base_url}/timer/resumo", params={"de": "2024-01-01", "ate": "2024-01-01"},
+                                      headers=usuario).json()
+            self.session.put(f"{self.base_url}/timer/parar/{disciplina_id}", headers=usuario)
+            
+            status = [r["status"] for r in primeiro["resultados"]]
+            if status == ["aplicado", "aplicado", "aplicado", "rejeitado", "aplicado"] \
+                    and all(r["duplicado"] for r in replay["resultados"]) \
+                    and [r["status"] for r in replay["resultados"]] == status \
+                    and primeiro["cronometros"][disciplina_id]["ativo"] \
+                    and primeiro["semanas"][0]["segunda"][0]["concluida"] \
+                    and [r["total_segundos"] for r in resumo] == [1800]:
+                self.log_test("Offline Sync", True, f"{len(eventos)} events in one request, replay deduplicated")
+                return True
+            else:
+                self.log_test("Offline Sync", False, "Unexpected sync results",
+                              {"primeiro": primeiro["resultados"], "replay": replay["resultados"], "resumo": resumo})
+                return False
+        except Exception as e:
+            self.log_test("Offline Sync", False, f"Error: {str(e)}")
+            return False
+    
+    def test_session_compaction(self):
+        """Test POST /api/admin/compactacao - Old sessions move to monthly buckets with identical reads"""
+        try:
+            usuario = {"X-Usuario-Id": f"compactacao-{uuid.uuid4().hex[:8]}"}
+            disciplina_id = self.session.get(f"{self.base_url}/disciplinas", headers=usuario).json()[0]["id"]
+            eventos = []
+            for i in range(6):
+                dia = f"2024-{1 + i % 2:02d}-{10 + i}"
+                eventos += [
+                    {"chave": f"i{i}", "tipo": "iniciar", "em": f"{dia}T08:00:00Z", "disciplina_id": disciplina_id},
+                    {"chave": f"p{i}", "tipo": "parar", "em": f"{dia}T08:{25 + i}:00Z", "disciplina_id": disciplina_id},
+                ]
+            self.session.post(f"{self.base_url}/sync", json={"eventos": eventos}, headers=usuario)
+            
+            url = f"{self.base_url}/timer/sessoes/{disciplina_id}"
+            periodo = {"de": "2024-01-01", "ate": "2024-02-29"}
+            ler = lambda: (
+                [json.loads(linha)["id"] for linha in self.session.get(
+                    url, headers={**usuario, "Accept": "application/x-ndjson"}).text.splitlines() if linha],
+                self.session.get(f"{self.base_url}/timer/resumo", params=periodo, headers=usuario).json(),
+            )
+            historico, resumo = ler()
+            
+            # Lossy: needs the admin token, never goes below COMPACTAR_APOS_DIAS, and only compacts this user
+            admin = {**usuario, "X-Admin-Token": os.environ.get("ADMIN_TOKEN", "")}
+            sem_token = self.session.post(f"{self.base_url}/admin/compactacao", headers=usuario)
+            recente = self.session.post(f"{self.base_url}/admin/compactacao", params={"dias": 0}, headers=admin)
+            # The report holds every tenant's storage sizes
+            relatorio_sem_token = self.session.get(f"{self.base_url}/admin/compactacao", headers=usuario)
+            if sem_token.status_code != 403 or recente.status_code != 400 or relatorio_sem_token.status_code != 403:
+                self.log_test("Session Compaction", False, "Compaction not restricted",
+                              {"sem_token": sem_token.status_code, "dias_0": recente.status_code,
+                               "relatorio_sem_token": relatorio_sem_token.status_code})
+                return False
+            response = self.session.post(f"{self.base_url}/admin/compactacao", headers=admin)
+            if response.status_code != 200:
+                self.log_test("Session Compaction", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+            compactacao = response.json()
+            camadas = compactacao["camadas"]
+            
+            historico_depois, resumo_depois = ler()
+            pagina = self.session.get(url, params={"limite": 4}, headers=usuario).json()
+            seguinte = self.session.get(url, params={"limite": 4, "cursor": pagina["next_cursor"]}, headers=usuario).json()
+            paginadas = [sessao["id"] for sessao in pagina["sessoes"] + seguinte["sessoes"]]
+            verificacao = self.session.get(f"{self.base_url}/admin/rollups/verificar", params=periodo,
+                                           headers=usuario).json()
+            
+            if len(historico) == 6 and historico_depois == historico == paginadas and resumo_depois == resumo \
+                    and verificacao["consistente"] and compactacao["sessoes"] == 6 \
+                    and camadas["reducao"]["percentual"] > 0:
+                self.log_test("Session Compaction", True,
+                              f"Reads unchanged, {camadas['reducao']['percentual']}% smaller per compacted session")
+                return True
+            else:
+                self.log_test("Session Compaction", False, "Reads changed or no reduction after compaction",
+                              {"historico": [historico, historico_depois, paginadas], "resumo": [resumo, resumo_depois],
+                               "verificacao": verificacao, "camadas": camadas})
+                return False
+        except Exception as e:
+            self.log_test("Session Compaction", False, f"Error: {str(e)}")
+            return False
+    
+    def test_legacy_string_history(self):
+        """Test SessaoRepository.historico - Paging reaches sessions whose inicio was stored as text"""
+        usuario_id = f"legado-{uuid.uuid4().hex[:8]}"
+        sessoes = []
+        for i in range(12):
+            inicio = datetime(2024, 3, 1, 8) + timedelta(hours=i * 5)
+            sessoes.append({"id": str(uuid.uuid4()), "disciplina_id": "d0", "inicio": inicio,
+                            "fim": inicio + timedelta(minutes=30), "ativa": False, "duracao_segundos": 1800})
+        esperado = [sessao["id"] for sessao in sorted(sessoes, key=lambda s: s["inicio"], reverse=True)]
+        
+        async def semear_legado(storage):
+            # Every other session as older versions wrote it: usuario_id set, inicio an ISO string
+            await storage.db.sessoes_estudo.insert_many([
+                {**sessao, "usuario_id": usuario_id,
+                 "inicio": sessao["inicio"].isoformat() + ("Z" if i % 4 == 1 else "") if i % 2 else sessao["inicio"]}
+                for i, sessao in enumerate(sessoes)
+            ])
+        
+        async def paginar(storage):
+            from storage import posicao_sessao
+            repo = storage.do_usuario(usuario_id).sessoes
+            if storage.nome != "mongo":
+                await repo.upsert_muitos([dict(sessao) for sessao in sessoes])
+            ids, apos = [], None
+            while True:
+                pagina = [sessao async for sessao in repo.historico("d0", apos=apos, limite=5)]
+                ids.extend(sessao["id"] for sessao in pagina)
+                if len(pagina) < 5:
+                    return ids
+                inicio, ultimo_id = posicao_sessao(pagina[-1])
+                apos = {"inicio": inicio, "id": ultimo_id}
+        
+        try:
+            resultados = executar_nos_storages(paginar, semear_legado)
+            errados = {backend: ids for backend, ids in resultados.items() if ids != esperado}
+            if not errados:
+                self.log_test("Legacy String History", True,
+                              f"12 sessions paged five at a time in order ({', '.join(resultados)})")
+                return True
+            else:
+                self.log_test("Legacy String History", False, "Sessions missing or out of order",
+                              {"esperado": esperado, **errados})
+                return False
+        except Exception as e:
+            self.log_test("Legacy String History", False, f"Error: {str(e)}")
+            return False
+    
+    def test_concurrent_compaction(self):
+        """Test SessaoRepository.compactar - Overlapping runs fold every session into its bucket exactly once"""
+        async def compactar_em_paralelo(storage):
+            usuario_id = f"compactacao-{uuid.uuid4().hex[:8]}"
+            sessoes = []
+            for i in range(40):
+                inicio = datetime(2024, 1, 1, 8) + timedelta(days=i * 2)
+                sessoes.append({"id": str(uuid.uuid4()), "disciplina_id": f"d{i % 2}", "inicio": inicio,
+                                "fim": inicio + timedelta(minutes=i + 1), "ativa": False,
+                                "duracao_segundos": 60 * (i + 1)})
+            await storage.do_usuario(usuario_id).sessoes.upsert_muitos(sessoes)
+            # Two runs with small batches, as the periodic task and the admin endpoint would overlap
+            execucoes = await asyncio.gather(*(
+                storage.do_usuario(usuario_id).sessoes.compactar(datetime(2025, 1, 1), lote=7) for _ in range(2)
+            ))
+            repo = storage.do_usuario(usuario_id).sessoes
+            totais = await repo.totais_por_dia()
+            ids = [sessao["id"] for d in ("d0", "d1") async for sessao in repo.historico(d)]
+            return {
+                "compactadas": sum(execucao["sessoes"] for execucao in execucoes),
+                "segundos": sum(total["total_segundos"] for total in totais),
+                "sessoes": sum(total["sessoes"] for total in totais),
+                "ids": len(ids),
+                "ids_unicos": len(set(ids) & {sessao["id"] for sessao in sessoes}),
+                "esperado": (40, sum(sessao["duracao_segundos"] for sessao in sessoes)),
+            }
+        
+        try:
+            resultados = executar_nos_storages(compactar_em_paralelo)
+            errados = {
+                backend: r for backend, r in resultados.items()
+                if (r["compactadas"], r["segundos"]) != r["esperado"]
+                or not r["sessoes"] == r["ids"] == r["ids_unicos"] == 40
+            }
+            if not errados:
+                self.log_test("Concurrent Compaction", True,
+                              f"Two overlapping runs compacted 40 sessions once ({', '.join(resultados)})")
+                return True
+            else:
+                self.log_test("Concurrent Compaction", False, "Sessions lost or counted twice", errados)
+                return False
+        except Exception as e:
+            self.log_test("Concurrent Compaction", False, f"Error: {str(e)}")
+            return False
+    
+    def test_abandoned_session_reaper(self):
+        """Test POST /api/timer/sinal/{id} and the reaper - Stale sessions close at their last heartbeat"""
+        try:
+            usuario = {"X-Usuario-Id": f"reaper-{uuid.uuid4().hex[:8]}"}
+            disciplinas = self.session.get(f"{self.base_url}/disciplinas", headers=usuario).json()
+            disciplina_id, sem_sinal_id = disciplinas[0]["id"], disciplinas[1]["id"]
+            self.session.post(f"{self.base_url}/timer/iniciar", json={"disciplina_id": disciplina_id}, headers=usuario)
+            sinal = self.session.post(f"{self.base_url}/timer/sinal/{disciplina_id}", headers=usuario)
+            # A timer left open two days ago by a client that never sent a heartbeat
+            anteontem = (datetime.utcnow() - timedelta(days=2)).isoformat() + "Z"
+            self.session.post(f"{self.base_url}/sync", headers=usuario, json={"eventos": [
+                {"chave": "sem-sinal", "tipo": "iniciar", "em": anteontem, "disciplina_id": sem_sinal_id}
+            ]})
+            
+            # Someone else's stale timer is out of reach of this user's manual run
+            outro = {"X-Usuario-Id": f"reaper-{uuid.uuid4().hex[:8]}"}
+            outra_id = self.session.get(f"{self.base_url}/disciplinas", headers=outro).json()[0]["id"]
+            self.session.post(f"{self.base_url}/timer/iniciar", json={"disciplina_id": outra_id}, headers=outro)
+            self.session.post(f"{self.base_url}/timer/sinal/{outra_id}", headers=outro)
+            time.sleep(1.5)
+            
+            encerramento = self.session.post(f"{self.base_url}/admin/sessoes/encerrar-abandonadas",
+                                             params={"segundos": 1}, headers=usuario).json()
+            outra_status = self.session.get(f"{self.base_url}/timer/status/{outra_id}", headers=outro).json()
+            self.session.put(f"{self.base_url}/timer/parar/{outra_id}", headers=outro)
+            status = self.session.get(f"{self.base_url}/timer/status/{disciplina_id}", headers=usuario).json()
+            sinal_depois = self.session.post(f"{self.base_url}/timer/sinal/{disciplina_id}", headers=usuario)
+            sessao = self.session.get(f"{self.base_url}/timer/sessoes/{disciplina_id}", headers=usuario).json()["sessoes"][0]
+            sem_sinal = self.session.get(f"{self.base_url}/timer/sessoes/{sem_sinal_id}", headers=usuario).json()["sessoes"][0]
+            reiniciado = self.session.post(f"{self.base_url}/timer/iniciar", json={"disciplina_id": disciplina_id},
+                                           headers=usuario)
+            self.session.put(f"{self.base_url}/timer/parar/{disciplina_id}", headers=usuario)
+            
+            if sinal.status_code == 200 and sinal.json()["sessao"]["visto_em"] and encerramento["sessoes"] == 2 \
+                    and encerramento["usuarios"] == 1 and outra_status["ativo"] \
+                    and not status["ativo"] and sinal_depois.status_code == 404 \
+                    and sessao["fim"] == sessao["visto_em"] and sessao["duracao_segundos"] < 1.5 \
+                    and sessao["encerramento_automatico"] and reiniciado.status_code == 200 \
+                    and not sem_sinal["ativa"] and sem_sinal["fim"] == sem_sinal["inicio"] \
+                    and sem_sinal["duracao_segundos"] == 0:
+                self.log_test("Abandoned Session Reaper", True,
+                              f"Session closed at its last heartbeat after {sessao['duracao_segundos']}s")
+                return True
+            else:
+                self.log_test("Abandoned Session Reaper", False, "Stale session not closed at its heartbeat",
+                              {"sinal": sinal.status_code, "encerramento": encerramento, "status": status, "outra": outra_status,
+                               "sinal_depois": sinal_depois.status_code, "sessao": sessao, "sem_sinal": sem_sinal})
+                return False
+        except Exception as e:
+            self.log_test("Abandoned Session Reaper", False, f"Error: {str(e)}")
+            return False
+    
+    def test_aggregate_cache(self):
+        """Test GET /api/timer/resumo-semanal and /api/desempenho - Coalesced, cached, invalidated on writes"""
+        try:
+            usuario = {"X-Usuario-Id": f"agregados-{uuid.uuid4().hex[:8]}"}
+            disciplina_id = self.session.get(f"{self.base_url}/disciplinas", headers=usuario).json()[0]["id"]
+            antes = self.session.get(f"{self.base_url}/admin/cache").json()["resumos"]
+            ler_resumo = lambda _: requests.get(f"{self.base_url}/timer/resumo-semanal", headers=usuario).json()
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                resumos = list(executor.map(ler_resumo, range(10)))
+            depois = self.session.get(f"{self.base_url}/admin/cache").json()["resumos"]
+            
+            # A revalidation is answered from the ETag alone, without touching the cache
+            etag = self.session.get(f"{self.base_url}/timer/resumo-semanal", headers=usuario).headers["ETag"]
+            antes_304 = self.session.get(f"{self.base_url}/admin/cache").json()["resumos"]
+            revalidado = self.session.get(f"{self.base_url}/timer/resumo-semanal",
+                                          headers={**usuario, "If-None-Match": etag})
+            depois_304 = self.session.get(f"{self.base_url}/admin/cache").json()["resumos"]
+            
+            self.session.post(f"{self.base_url}/timer/iniciar", json={"disciplina_id": disciplina_id}, headers=usuario)
+            time.sleep(1.1)
+            self.session.put(f"{self.base_url}/timer/parar/{disciplina_id}", headers=usuario)
+            resumo = ler_resumo(None)
+            
+            self.session.get(f"{self.base_url}/desempenho", headers=usuario)
+            semana = {"semana_inicio": "2024-03-04", "segunda": [{"horario": "08:00", "descricao": "Cache"}]}
+            self.session.post(f"{self.base_url}/desempenho", json=semana, headers=usuario)
+            semanas = self.session.get(f"{self.base_url}/desempenho", headers=usuario).json()
+            
+            misses = depois["misses"] - antes["misses"]
+            servidas = depois["hits"] + depois["coalescidas"] - antes["hits"] - antes["coalescidas"]
+            if misses == 1 and servidas == 9 and all(r == resumos[0] for r in resumos) \
+                    and revalidado.status_code == 304 and depois_304 == antes_304 \
+                    and [r["disciplina_id"] for r in resumo] == [disciplina_id] \
+                    and [s["semana_inicio"] for s in semanas] == ["2024-03-04"]:
+                self.log_test("Aggregate Cache", True,
+                              f"10 concurrent summaries ran 1 query ({depois['coalescidas'] - antes['coalescidas']} coalesced, "
+                              f"{depois['hits'] - antes['hits']} hits), writes invalidate")
+                return True
+            else:
+                self.log_test("Aggregate Cache", False, "Unexpected cache behaviour",
+                              {"antes": antes, "depois": depois, "revalidado": revalidado.status_code,
+                               "cache_304": [antes_304, depois_304], "resumo": resumo, "semanas": semanas})
+                return False
+        except Exception as e:
+            self.log_test("Aggregate Cache", False, f"Error: {str(e)}")
+            return False
+    
+    def test_cache_single_flight(self):
+        """Test CacheCoalescente.obter - Simultaneous requests share one in-flight producer call"""
+        if str(BACKEND_DIR) not in sys.path:
+            sys.path.insert(0, str(BACKEND_DIR))
+        
+        async def pedir_juntos():
+            from cache import CacheCoalescente
+            cache = CacheCoalescente("teste", ttl=60)
+            chamadas = []
+            
+            async def produzir():
+                chamadas.append(1)
+                # Slow enough that every request arrives while the first is still in flight
+                await asyncio.sleep(0.2)
+                return {"total": len(chamadas)}
+            
+            valores = await asyncio.gather(*(cache.obter("u1", "resumo", produzir) for _ in range(10)))
+            return valores, len(chamadas), cache.estatisticas()
+        
+        try:
+            valores, chamadas, estatisticas = asyncio.run(pedir_juntos())
+            if chamadas == 1 and estatisticas["misses"] == 1 and estatisticas["coalescidas"] == 9 \
+                    and estatisticas["hits"] == 0 and all(valor == {"total": 1} for valor in valores):
+                self.log_test("Cache Single-Flight", True, "10 simultaneous requests: 1 producer call, 9 coalesced")
+                return True
+            else:
+                self.log_test("Cache Single-Flight", False, "Requests were not coalesced",
+                              {"chamadas": chamadas, "estatisticas": estatisticas, "valores": valores})
+                return False
+        except Exception as e:
+            self.log_test("Cache Single-Flight", False, f"Error: {str(e)}")
+            return False
+    
     def run_all_tests(self):
         """Run all backend tests in sequence"""
         print("=" * 60)
@@ -336,16 +1484,49 @@ class BackendTester:
         # Core API tests
         print("🔍 Testing Core APIs...")
         self.test_api_root()
+        self.test_health_probes()
         self.test_get_disciplinas()
         self.test_update_disciplina()
+        self.test_bulk_update_disciplinas()
+        self.test_catalog_cache()
+        self.test_export_import_roundtrip()
+        self.test_import_errors()
         self.test_desempenho_semanal()
+        self.test_task_level_writes()
+        self.test_desempenho_range()
+        self.test_desempenho_statistics()
+        self.test_conditional_get()
+        self.test_tenant_isolation()
+        self.test_week_etag_per_user()
         
         print("\n⏱️  Testing Cronometer APIs (High Priority)...")
         self.test_cronometer_start()
         self.test_cronometer_status()
+        self.test_cronometer_status_batch()
         self.test_cronometer_stop()
         self.test_weekly_summary()
+        self.test_range_summaries()
+        self.test_rollup_consistency()
+        self.test_rollup_rebuild()
+        self.test_analytics()
+        self.test_session_history_pagination()
+        self.test_timer_stream()
         self.test_prevent_overlapping_sessions()
+        self.test_concurrent_start_stop()
+        self.test_concurrent_start_stop_storage()
+        self.test_offline_sync()
+        self.test_session_compaction()
+        self.test_legacy_string_history()
+        self.test_concurrent_compaction()
+        self.test_abandoned_session_reaper()
+        self.test_aggregate_cache()
+        self.test_cache_single_flight()
+        
+        print("\n📇 Testing Indexes & Metrics...")
+        self.test_index_plans()
+        self.test_storage_index_plans()
+        self.test_metrics()
+        self.test_diagnostics()
         
         # Summary
         print("\n" + "=" * 60)
@@ -369,6 +1550,8 @@ class BackendTester:
         return passed == total
 
 if __name__ == "__main__":
+    if not BASE_URL:
+        BASE_URL = start_local_backend()
     tester = BackendTester()
     success = tester.run_all_tests()
     
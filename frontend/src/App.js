@@ -1,9 +1,11 @@
-import React, { useState, useEffect, useCallback } from "react";
+import React, { useState, useEffect } from "react";
 import "./App.css";
 import axios from "axios";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+// Well under the server's SINAL_EXPIRA_SEGUNDOS (300 s by default)
+const SINAL_INTERVALO_MS = 60 * 1000;
 
 function App() {
   const [disciplinas, setDisciplinas] = useState([]);
@@ -35,33 +37,44 @@ function App() {
     loadResumoTempo();
   }, [semanaAtual]);
 
-  // Check timer status for all disciplines
-  const checkTimerStatus = useCallback(async () => {
-    if (disciplinas.length === 0) return;
-    
-    const timerPromises = disciplinas.map(async (disciplina) => {
-      try {
-        const response = await axios.get(`${API}/timer/status/${disciplina.id}`);
-        return { disciplinaId: disciplina.id, status: response.data };
-      } catch (error) {
-        console.error(`Erro ao verificar timer da disciplina ${disciplina.id}:`, error);
-        return { disciplinaId: disciplina.id, status: { ativo: false } };
-      }
+  // Convert a timer status payload from the API into local timer state
+  const timerFromStatus = (status) => ({
+    ativo: status.ativo,
+    duracaoAtual: status.duracao_atual_segundos || 0,
+    inicio: status.sessao?.inicio || null
+  });
+
+  // Subscribe once to server-pushed timer updates instead of polling
+  useEffect(() => {
+    const eventSource = new EventSource(`${API}/timer/stream`);
+
+    eventSource.addEventListener('snapshot', (event) => {
+      const statusPorDisciplina = JSON.parse(event.data);
+      const newTimers = {};
+      Object.entries(statusPorDisciplina).forEach(([disciplinaId, status]) => {
+        newTimers[disciplinaId] = timerFromStatus(status);
+      });
+      setTimers(newTimers);
     });
 
-    const results = await Promise.all(timerPromises);
-    const newTimers = {};
-    
-    results.forEach(({ disciplinaId, status }) => {
-      newTimers[disciplinaId] = {
-        ativo: status.ativo,
-        duracaoAtual: status.duracao_atual_segundos || 0,
-        inicio: status.sessao?.inicio || null
-      };
+    eventSource.addEventListener('timer', (event) => {
+      const status = JSON.parse(event.data);
+      setTimers(prev => ({
+        ...prev,
+        [status.disciplina_id]: timerFromStatus(status)
+      }));
+      if (!status.ativo) {
+        loadResumoTempo();
+      }
     });
-    
-    setTimers(newTimers);
-  }, [disciplinas]);
+
+    eventSource.onerror = (error) => {
+      // EventSource reconnects on its own, resuming from the last event id
+      console.error('Erro na conexão de atualizações dos cronômetros:', error);
+    };
+
+    return () => eventSource.close();
+  }, []);
 
   // Update timer display every second
   useEffect(() => {
@@ -82,9 +95,22 @@ function App() {
     return () => clearInterval(interval);
   }, []);
 
+  // Heartbeat running timers so the server closes abandoned sessions at the last heartbeat
+  const timersAtivos = Object.keys(timers).filter(id => timers[id].ativo).sort().join(',');
   useEffect(() => {
-    checkTimerStatus();
-  }, [checkTimerStatus]);
+    if (!timersAtivos) return;
+    const enviarSinais = () => {
+      timersAtivos.split(',').forEach(disciplinaId => {
+        axios.post(`${API}/timer/sinal/${disciplinaId}`).catch(error => {
+          console.error('Erro ao enviar sinal do timer:', error);
+        });
+      });
+    };
+    enviarSinais();
+    const interval = setInterval(enviarSinais, SINAL_INTERVALO_MS);
+
+    return () => clearInterval(interval);
+  }, [timersAtivos]);
 
   const loadDisciplinas = async () => {
     try {
@@ -178,23 +204,28 @@ function App() {
     }
   };
 
-  const addTarefa = (dia) => {
+  const tarefasUrl = (dia) => `${API}/desempenho/${semanaAtual}/${dia}/tarefas`;
+
+  const addTarefa = async (dia) => {
     if (!desempenhoSemanal) return;
     
-    const novaTarefa = {
-      id: Date.now().toString(),
-      horario: "09:00",
-      descricao: "Nova tarefa",
-      concluida: false
-    };
+    try {
+      const response = await axios.post(tarefasUrl(dia), {
+        horario: "09:00",
+        descricao: "Nova tarefa"
+      });
 
-    setDesempenhoSemanal(prev => ({
-      ...prev,
-      [dia]: [...(prev[dia] || []), novaTarefa]
-    }));
+      setDesempenhoSemanal(prev => ({
+        ...prev,
+        [dia]: [...(prev[dia] || []), response.data]
+      }));
+    } catch (error) {
+      console.error('Erro ao adicionar tarefa:', error);
+    }
   };
 
-  const updateTarefa = (dia, tarefaId, field, value) => {
+  // Update local state; persist the single changed field unless told otherwise
+  const updateTarefa = async (dia, tarefaId, field, value, persist = true) => {
     setDesempenhoSemanal(prev => ({
       ...prev,
       [dia]: prev[dia].map(tarefa => 
@@ -203,6 +234,25 @@ function App() {
           : tarefa
       )
     }));
+
+    if (!persist) return;
+    try {
+      await axios.patch(`${tarefasUrl(dia)}/${tarefaId}`, { [field]: value });
+    } catch (error) {
+      console.error('Erro ao atualizar tarefa:', error);
+    }
+  };
+
+  const removeTarefa = async (dia, tarefaId) => {
+    try {
+      await axios.delete(`${tarefasUrl(dia)}/${tarefaId}`);
+      setDesempenhoSemanal(prev => ({
+        ...prev,
+        [dia]: prev[dia].filter(tarefa => tarefa.id !== tarefaId)
+      }));
+    } catch (error) {
+      console.error('Erro ao remover tarefa:', error);
+    }
   };
 
   const diasSemana = [
@@ -399,10 +449,19 @@ function App() {
                         <input
                           type="text"
                           value={tarefa.descricao}
-                          onChange={(e) => updateTarefa(key, tarefa.id, 'descricao', e.target.value)}
+                          onChange={(e) => updateTarefa(key, tarefa.id, 'descricao', e.target.value, false)}
+                          onBlur={(e) => updateTarefa(key, tarefa.id, 'descricao', e.target.value)}
                           className="flex-1 border border-gray-300 rounded px-2 py-1 text-sm"
                           placeholder="Descrição da tarefa"
                         />
+
+                        <button
+                          onClick={() => removeTarefa(key, tarefa.id)}
+                          className="text-red-500 hover:text-red-700 px-2"
+                          title="Remover tarefa"
+                        >
+                          ×
+                        </button>
                       </div>
                     ))}
                   </div>